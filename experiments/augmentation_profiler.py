@@ -0,0 +1,45 @@
+import csv
+import os
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback
+
+
+class AugmentationProfilerCallback(Callback):
+    """Logs the per-operation counters of the training augmentation pipeline at the end of every epoch.
+    Counters recorded by every data worker during the epoch are appended to a csv file and written to TensorBoard.
+
+    # Arguments
+        profiler: `OperationProfiler` of the pipeline, see `CustomPipeline.enable_profiling`.
+        filename: Filename of the csv file, rows are appended.
+        log_dir: Optional TensorBoard log directory.
+    """
+
+    def __init__(self, profiler, filename, log_dir=None):
+        super(AugmentationProfilerCallback, self).__init__()
+        self.profiler = profiler
+        self.filename = filename
+        self.log_dir = log_dir
+        self._writer = None
+        self._last_counters = profiler.snapshot()
+
+    def on_epoch_end(self, epoch, logs=None):
+        counters = self.profiler.snapshot()
+        rows = self.profiler.report(counters - self._last_counters)
+        self._last_counters = counters
+
+        write_header = not os.path.exists(self.filename)
+        with open(self.filename, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['epoch'] + list(rows[0].keys()))
+            if write_header:
+                writer.writeheader()
+            for row in rows:
+                writer.writerow(dict(row, epoch=epoch))
+
+        if self.log_dir is not None:
+            if self._writer is None:
+                self._writer = tf.summary.create_file_writer(self.log_dir)
+            with self._writer.as_default():
+                for row in rows:
+                    for key in ('fired_rate', 'seconds', 'ms_per_fired', 'mean_input_megapixels', 'mean_output_megapixels'):
+                        tf.summary.scalar('augmentation/{}/{}'.format(row['operation'], key), row[key], step=epoch)
+            self._writer.flush()
@@ -0,0 +1,108 @@
+"""Compact in-memory store of pregenerated augmented images.
+
+The images are kept as rows of one contiguous uint8 array instead of a list of PIL images,
+optionally backed by a memory-mapped file. When a byte budget is set and the images do not
+all fit, the least recently used images are evicted and generated again on their next access.
+
+The store is filled by the process creating it, before data workers are forked. Forked workers
+only read it and generate the images it does not hold without storing them, so the budget also
+holds with multiprocessing workers.
+"""
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class AugmentedImageStore():
+    """Byte-budgeted store of augmented images with LRU eviction.
+
+    # Arguments
+        num_images: Integer, number of images.
+        image_shape: Shape of every stored image, e.g. `(height, width, channels)`.
+        generate_function: Function returning the augmented image `i` as a PIL Image or uint8 array.
+        max_bytes: Optional budget in bytes of the stored pixels, all images are stored if None.
+        spill_folder: Optional folder of a temporary memory-mapped file holding the images instead of RAM.
+    """
+
+    def __init__(self, num_images, image_shape, generate_function, max_bytes=None, spill_folder=None):
+        self.num_images = num_images
+        self.image_shape = tuple(image_shape)
+        self.generate_function = generate_function
+        self.image_bytes = int(np.prod(self.image_shape))
+
+        self.capacity = num_images
+        if max_bytes is not None:
+            self.capacity = min(num_images, max_bytes // self.image_bytes)
+            if self.capacity < 1:
+                raise ValueError(
+                    '`max_bytes` = {} cannot hold a single image of {} bytes'
+                    .format(max_bytes, self.image_bytes)
+                )
+
+        shape = (self.capacity,) + self.image_shape
+        self.spill_folder = spill_folder
+        if spill_folder is None:
+            self._images = np.empty(shape, dtype=np.uint8)
+        else:
+            os.makedirs(spill_folder, exist_ok=True)
+            # The file is deleted on close, the mapping keeps its pages until the store is released
+            with tempfile.NamedTemporaryFile(dir=spill_folder, prefix='augmented_images_') as f:
+                self._images = np.memmap(f, dtype=np.uint8, mode='w+', shape=shape)
+
+        self._slots = OrderedDict() # image index -> row of `_images`, least recently used first
+        self._free_slots = list(reversed(range(self.capacity)))
+        self._lock = threading.Lock()
+        self._owner_pid = os.getpid()
+
+    @property
+    def nbytes(self):
+        return self._images.nbytes
+
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, i):
+        """uint8 array of the augmented image `i`, generated again if it was evicted."""
+        with self._lock:
+            slot = self._slots.get(i)
+            if slot is not None:
+                self._slots.move_to_end(i)
+                if self.capacity < self.num_images:
+                    # Another thread may evict the image and reuse its row while the caller reads it
+                    return self._images[slot].copy()
+                return self._images[slot]
+
+        x = self._to_array(self.generate_function(i), i)
+        if self._can_insert():
+            self.put(i, x)
+        return x
+
+    def put(self, i, img):
+        """Stores the augmented image `i`, evicting the least recently used image if the store is full."""
+        x = self._to_array(img, i)
+        with self._lock:
+            if i in self._slots:
+                self._slots.move_to_end(i)
+                return
+            if self._free_slots:
+                slot = self._free_slots.pop()
+            else:
+                _, slot = self._slots.popitem(last=False)
+            self._images[slot] = x
+            self._slots[i] = slot
+
+    def _can_insert(self):
+        # Only the owner process writes to the store. Forked workers share its pages, of the memory-mapped
+        # file or copy-on-write RAM: writing would give every worker its own copy of the budget
+        return os.getpid() == self._owner_pid
+
+    def _to_array(self, img, i):
+        x = np.asarray(img, dtype=np.uint8)
+        if x.shape != self.image_shape:
+            raise ValueError(
+                'Augmented image {} has shape {} but the store expects {}'
+                .format(i, x.shape, self.image_shape)
+            )
+        return x
@@ -1,5 +1,10 @@
+import copy
+import math
+import time
+import numpy as np
 from Augmentor import Operations, Pipeline
 from Augmentor.Operations import *
+from PIL import Image
 
 
 def crop_center(img):
@@ -43,13 +48,244 @@ class CropCenter(Operation):
 
 
 class CustomPipeline(Pipeline):
+    """Augmentor `Pipeline` running the operations of one image at a time.
+
+    # Arguments
+        reorder_operations: Boolean, whether to run the pixel operations that commute with the crops
+            and the final resize on the resized image instead of the source image, see `plan_operations`.
+        distortion_pool_size: Integer, number of precomputed displacement fields of each `Distort`
+            operation (see `DistortionPool`), applied where the operation runs, disabled if 0.
+    """
+
+    def __init__(self, reorder_operations=False, distortion_pool_size=0, **kwargs):
+        Pipeline.__init__(self, **kwargs)
+        self.reorder_operations = reorder_operations
+        self.distortion_pool_size = distortion_pool_size
+        self._distortion_pools = [] # (operation, DistortionPool)
+        self.profiler = None
+
+    # Profiled steps besides the operations
+    profiled_steps = ('Decode',)
+
+    def enable_profiling(self):
+        """Records counters of every operation class in shared memory, see `OperationProfiler`.
+        Call it once the operations are added and before the data workers are forked."""
+        from data.operation_profiler import OperationProfiler
+        self.profiler = OperationProfiler([type(operation).__name__ for operation in self.operations] + list(self.profiled_steps))
+        return self.profiler
+
+    def plan_operations(self):
+        """Operations run on the source image and deferred operations run on the resized image."""
+        if self.reorder_operations:
+            return plan_operations(self.operations)
+        return self.operations, []
+
+    def get_distortion_pool(self, operation):
+        """`DistortionPool` of a `Distort` operation, None without `distortion_pool_size`."""
+        if not self.distortion_pool_size:
+            return None
+        for distort, pool in self._distortion_pools:
+            if distort is operation:
+                return pool
+        # Imported here as data_sampler.py imports this module from the data folder
+        from data.distortion_pool import DistortionPool
+        pool = DistortionPool(operation, self.distortion_pool_size)
+        self._distortion_pools.append((operation, pool))
+        return pool
+
     def perform_operations(self, image):
+        operations, deferred = self.plan_operations()
         augmented_image = image
-        for operation in self.operations:
+        if self.profiler is not None:
+            # Otherwise the first operation decodes the lazily opened image
+            start = time.perf_counter()
+            augmented_image.load()
+            self.profiler.record('Decode', True, time.perf_counter() - start, augmented_image.size, augmented_image.size)
+        scale = 1.0
+        for operation in operations:
             r = round(random.uniform(0, 1), 1)
             if r <= operation.probability:
-                augmented_image = operation.perform_operation([augmented_image])[0]
-        return augmented_image
+                size = augmented_image.size
+                start = time.perf_counter()
+                pool = self.get_distortion_pool(operation) if isinstance(operation, Operations.Distort) else None
+                if pool is not None:
+                    augmented_image = pool.distort(augmented_image)
+                else:
+                    augmented_image = operation.perform_operation([augmented_image])[0]
+                if self.profiler is not None:
+                    self.profiler.record(type(operation).__name__, True, time.perf_counter() - start, size, augmented_image.size)
+                if isinstance(operation, Operations.Resize):
+                    scale *= math.sqrt(augmented_image.width * augmented_image.height / float(size[0] * size[1]))
+            elif self.profiler is not None:
+                self.profiler.record(type(operation).__name__, False)
+        return perform_deferred_operations(deferred, augmented_image, scale, self.get_distortion_pool, self.profiler)
+
+
+# Pixel operations commuting with crops, resizes, flips and 90 degree rotations (up to the
+# resampling), which `plan_operations` moves after the final resize
+INTENSITY_OPERATIONS = (
+    Operations.RandomBrightness,
+    Operations.RandomColor,
+    Operations.RandomContrast,
+)
+# Pixel operations placing grids or rectangles relative to the image, they only commute with
+# flips, rotations and resizes: a later crop would cut them
+SPATIAL_OPERATIONS = (
+    Operations.Distort,
+    Operations.RandomErasing,
+)
+DEFERRABLE_OPERATIONS = INTENSITY_OPERATIONS + SPATIAL_OPERATIONS
+CROP_OPERATIONS = (
+    CropCenter,
+    Operations.CropPercentage,
+)
+COMMUTING_OPERATIONS = CROP_OPERATIONS + (
+    Operations.Rotate,
+    Operations.Flip,
+    Operations.Resize,
+)
+
+
+def plan_operations(operations):
+    """Moves the pixel operations of a pipeline ending with a resize after the resize, when only
+    crops, resizes, flips and 90 degree rotations follow them, and no crops follow `Distort` and
+    `RandomErasing`.
+
+    They then run on images of the input size of the network instead of the source images. Each
+    image follows the same distribution up to the resampling: `Distort` displaces the pixels of the
+    resized image by proportionally fewer pixels, `RandomErasing` noise is resampled to the same
+    resolution, and `RandomContrast` uses the mean luminance of the crop instead of the whole image.
+    A crop after `Distort` or `RandomErasing` would change where their grid or rectangle lies in the
+    output (e.g. crop the rectangle out), so they stay on the source image then.
+
+    # Returns
+        Tuple of the operations to run on the source image and the deferred operations to run after them.
+    """
+    if not operations or not isinstance(operations[-1], Operations.Resize):
+        return list(operations), []
+    # From the end, as an operation can only be deferred past operations that commute or are deferred too
+    is_deferred = [False] * len(operations)
+    for i in reversed(range(len(operations))):
+        operation, following = operations[i], range(i + 1, len(operations))
+        is_deferred[i] = isinstance(operation, DEFERRABLE_OPERATIONS) and all(
+            isinstance(operations[j], COMMUTING_OPERATIONS) or is_deferred[j] for j in following
+        ) and not (
+            isinstance(operation, SPATIAL_OPERATIONS) and any(isinstance(operations[j], CROP_OPERATIONS) for j in following)
+        )
+    source_operations = [operation for operation, deferred in zip(operations, is_deferred) if not deferred]
+    deferred = [operation for operation, deferred in zip(operations, is_deferred) if deferred]
+    return source_operations, deferred
+
+
+def perform_deferred_operations(operations, image, scale=1.0, get_distortion_pool=None, profiler=None):
+    """Runs the operations deferred by `plan_operations` on `image`, resized by `scale` from the source image.
+    `get_distortion_pool` optionally returns the `DistortionPool` of a `Distort` operation and
+    `profiler` is an optional `OperationProfiler`."""
+    for operation in operations:
+        if round(random.uniform(0, 1), 1) > operation.probability:
+            if profiler is not None:
+                profiler.record(type(operation).__name__, False)
+            continue
+        size = image.size
+        start = time.perf_counter()
+        pool = get_distortion_pool(operation) if get_distortion_pool and isinstance(operation, Operations.Distort) else None
+        if pool is not None:
+            # Augmentor displaces the grid points by up to `magnitude` pixels of the image
+            image = pool.distort(image, operation.magnitude * scale)
+        elif isinstance(operation, Operations.Distort) and scale < 1:
+            operation = copy.copy(operation)
+            operation.magnitude = max(1, int(round(operation.magnitude * scale)))
+            image = operation.perform_operation([image])[0]
+        elif isinstance(operation, Operations.RandomErasing) and scale < 1:
+            image = erase_random_rectangle(image, operation.rectangle_area, scale)
+        else:
+            image = operation.perform_operation([image])[0]
+        if profiler is not None:
+            profiler.record(type(operation).__name__, True, time.perf_counter() - start, size, image.size)
+    return image
+
+
+def erase_random_rectangle(image, rectangle_area, scale=1.0):
+    """Same rectangle as `Operations.RandomErasing`, filled with noise drawn at the source
+    resolution and resized by `scale`, as it would be when erasing the source image."""
+    w, h = image.size
+    w_occlusion = random.randint(int(w * 0.1), int(w * rectangle_area))
+    h_occlusion = random.randint(int(h * 0.1), int(h * rectangle_area))
+    random_position_x = random.randint(0, w - w_occlusion)
+    random_position_y = random.randint(0, h - h_occlusion)
+
+    bands = len(image.getbands())
+    # Augmentor's noise array is (w_occlusion, h_occlusion), i.e. a transposed rectangle
+    noise_shape = (max(1, int(round(w_occlusion / scale))), max(1, int(round(h_occlusion / scale))))
+    noise = np.uint8(np.random.rand(*(noise_shape if bands == 1 else noise_shape + (bands,))) * 255)
+    rectangle = Image.fromarray(noise).resize((h_occlusion, w_occlusion), Image.BICUBIC)
+    image.paste(rectangle, (random_position_x, random_position_y))
+    return image
+
+
+def get_source_operations(pipeline):
+    """Operations `pipeline` runs on the source image, e.g. to compute its draft size."""
+    if isinstance(pipeline, CustomPipeline):
+        return pipeline.plan_operations()[0]
+    return pipeline.operations
+
+
+# Operations whose output distribution does not depend on the resolution of the input image
+SCALE_INVARIANT_OPERATIONS = (
+    CropCenter,
+    Operations.Rotate,
+    Operations.Flip,
+    Operations.Shear,
+    Operations.Skew,
+    Operations.RandomErasing,
+    Operations.RandomBrightness,
+    Operations.RandomColor,
+    Operations.RandomContrast,
+)
+
+
+def get_draft_size(operations):
+    """Smallest decoded image size that still feeds the final resize of a pipeline at full resolution.
+
+    Random crops read a smaller area of the source image, so the required size grows with the
+    smallest crop they can sample. Returns None when the pipeline does not end with a resize or uses
+    operations whose result depends on the source resolution (e.g. `Distort`, which displaces pixels
+    by an absolute amount).
+    """
+    crop_fraction = 1.0
+    for operation in operations:
+        if isinstance(operation, Operations.Resize):
+            if operation.probability < 1:
+                return None
+            side = int(math.ceil(max(operation.width, operation.height) / crop_fraction))
+            return (side, side)
+        elif isinstance(operation, Operations.CropPercentage):
+            # Augmentor samples the random crop area between 10% and `percentage_area`
+            crop_fraction *= 0.1 if operation.randomise_percentage_area else operation.percentage_area
+        elif not isinstance(operation, SCALE_INVARIANT_OPERATIONS):
+            return None
+    return None
+
+
+def open_image(filename, draft_size=None):
+    """Open an image, decoding JPEG files at the smallest DCT scale (1/2, 1/4 or 1/8) whose
+    width and height are still at least `draft_size`. Decoded PIL images are returned as they are."""
+    if isinstance(filename, Image.Image):
+        return filename
+    img = Image.open(filename)
+    if draft_size is not None:
+        img.draft(img.mode, tuple(draft_size))
+    return img
+
+
+def get_pipeline_signature(pipeline):
+    """Describe every operation of a pipeline (class name and parameters) as a string, e.g. to key caches."""
+    return "|".join(
+        "{}({})".format(
+            type(operation).__name__,
+            ",".join("{}={}".format(k, v) for k, v in sorted(vars(operation).items()))
+        ) for operation in pipeline.operations
+    )
 
 
 def get_augmentation_group(data_aug_group, input_size, center=True, resize=True): 
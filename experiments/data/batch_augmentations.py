@@ -0,0 +1,214 @@
+"""Batch augmentation engine for uint8 numpy batches.
+
+`CustomPipeline` transforms one PIL image at a time, every operation at the full source
+resolution. For pipelines made of the operations of augmentation groups 0 to 2, `BatchAugmenter`
+only crops and resizes each image once (a single PIL resize of the crop box) and applies the
+90 degree rotations, flips, brightness, color and contrast changes to the whole resized batch
+with per-sample masks.
+
+The random parameters follow the same distributions as `CustomPipeline` and the Augmentor
+operations. Rotations and flips commute with the (centered) crop and the square resize, and the
+pixel intensity operations are per-pixel blends, so only their rounding differs. Contrast blends
+with the mean luminance of the whole image before the crop, after the preceding brightness and color
+changes, as `PIL.ImageEnhance.Contrast` does within `CustomPipeline`.
+"""
+import math
+import os
+import numpy as np
+from PIL import Image
+from Augmentor import Operations
+from data.augmentations import CropCenter, open_image
+
+GEOMETRIC_OPERATIONS = (Operations.Rotate, Operations.Flip)
+INTENSITY_OPERATIONS = (Operations.RandomBrightness, Operations.RandomColor, Operations.RandomContrast)
+
+
+def supports(pipeline):
+    """Whether `BatchAugmenter` can run `pipeline`: the operations of augmentation groups 0 to 2
+    on square images, ending with a resize that always fires."""
+    if pipeline is None or not pipeline.operations:
+        return False
+    *operations, resize = pipeline.operations
+    if not isinstance(resize, Operations.Resize) or resize.probability < 1 or resize.width != resize.height:
+        return False
+    for operation in operations:
+        if isinstance(operation, Operations.Rotate) and operation.rotation not in (-1, 90, 180, 270):
+            return False
+        if not isinstance(operation, (CropCenter, Operations.CropPercentage) + GEOMETRIC_OPERATIONS + INTENSITY_OPERATIONS):
+            return False
+    return True
+
+
+def luminance(x):
+    """Same integer conversion as PIL's `convert('L')` of RGB images: L = R * 299/1000 + G * 587/1000 + B * 114/1000."""
+    x = x.astype(np.uint32)
+    return ((x[..., 0] * 19595 + x[..., 1] * 38470 + x[..., 2] * 7471 + 0x8000) >> 16).astype(np.float32)
+
+
+def blend(degenerate, x, factor):
+    """Same blend as `PIL.Image.blend` (truncated to uint8): degenerate + factor * (x - degenerate)."""
+    out = degenerate + factor * (x.astype(np.float32) - degenerate)
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+
+
+class BatchAugmenter():
+    """Runs a `CustomPipeline` of augmentation groups 0 to 2 on batches, see `supports`.
+
+    # Arguments
+        pipeline: `CustomPipeline`, e.g. `LesionClassifier.create_aug_pipeline(2, (224, 224), True)`.
+    """
+
+    def __init__(self, pipeline):
+        if not supports(pipeline):
+            raise ValueError('The batch augmentation engine does not support the operations of this pipeline.')
+        *self.operations, resize = pipeline.operations
+        self.target_size = (resize.width, resize.height)
+        self.resample = getattr(Image, resize.resample_filter)
+        self.num_contrasts = sum(isinstance(operation, Operations.RandomContrast) for operation in self.operations)
+        self.needs_mean = self.num_contrasts > 0
+        self._random_state = None
+        self._random_state_pid = None
+
+    def sample(self, n):
+        """Draws the random parameters of `n` images: for every operation whether it fires and its parameters."""
+        rng = self._get_random_state()
+        params = []
+        for operation in self.operations:
+            # Same test as `CustomPipeline.perform_operations`: round(uniform(0, 1), 1) <= probability
+            fires = np.round(rng.uniform(0, 1, n), 1) <= operation.probability
+            if isinstance(operation, Operations.Rotate):
+                if operation.rotation == -1:
+                    values = rng.randint(1, 4, n)
+                else:
+                    values = np.full(n, operation.rotation // 90)
+            elif isinstance(operation, Operations.Flip):
+                values = rng.randint(0, 2, n)
+            elif isinstance(operation, Operations.CropPercentage):
+                if operation.randomise_percentage_area:
+                    values = np.round(rng.uniform(0.1, operation.percentage_area, n), 2)
+                else:
+                    values = np.full(n, operation.percentage_area)
+            elif isinstance(operation, INTENSITY_OPERATIONS):
+                values = rng.uniform(operation.min_factor, operation.max_factor, n)
+            else:
+                values = None
+            params.append((fires, values))
+        return params
+
+    def load(self, filename, params, i):
+        """Decodes image `i` of a batch, crops and resizes it in one step.
+        # Returns
+            Tuple of the uint8 array of the resized image and the mean luminances of the whole image
+            seen by the contrast operations (see `contrast_means`, None without contrast operations).
+        """
+        # The crop area of this image is already known, so the JPEG is decoded at the smallest
+        # DCT scale that still covers the target size after the crop
+        crop_fraction = 1.0
+        for operation, (fires, values) in zip(self.operations, params):
+            if fires[i] and isinstance(operation, Operations.CropPercentage):
+                crop_fraction *= values[i]
+        side = int(math.ceil(max(self.target_size) / crop_fraction))
+
+        img = open_image(filename, (side, side))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        means = None
+        if self.needs_mean:
+            means = self.contrast_means(np.asarray(img), params, i)
+
+        # Rotations and flips commute with the crops, so the crop box is computed in the source image
+        left, upper, right, lower = 0., 0., float(img.width), float(img.height)
+        rng = self._get_random_state()
+        for operation, (fires, values) in zip(self.operations, params):
+            if not fires[i]:
+                continue
+            width, height = right - left, lower - upper
+            if isinstance(operation, CropCenter):
+                length = min(width, height)
+                left, upper = left + (width - length) // 2, upper + (height - length) // 2
+                right, lower = left + length, upper + length
+            elif isinstance(operation, Operations.CropPercentage):
+                new_width = math.floor(width * values[i])
+                new_height = math.floor(height * values[i])
+                if operation.centre:
+                    left, upper = left + width / 2 - new_width / 2, upper + height / 2 - new_height / 2
+                else:
+                    left += rng.randint(0, int(width - new_width) + 1)
+                    upper += rng.randint(0, int(height - new_height) + 1)
+                right, lower = left + new_width, upper + new_height
+
+        # PIL's crop rounds the box, so resizing the rounded box gives the same pixels
+        box = tuple(int(round(v)) for v in (left, upper, right, lower))
+        return np.asarray(img.resize(self.target_size, self.resample, box=box)), means
+
+    def contrast_means(self, x, params, i):
+        """Mean luminances of the whole image `x` (uint8 array) of image `i` of a batch when each contrast
+        operation runs, i.e. after the pixel intensity operations before it, one value per contrast operation.
+        Same rounding as `PIL.ImageEnhance.Contrast`."""
+        means = []
+        for operation, (fires, values) in zip(self.operations, params):
+            if not isinstance(operation, INTENSITY_OPERATIONS):
+                continue
+            if isinstance(operation, Operations.RandomContrast):
+                means.append(int(luminance(x).mean(dtype=np.float64) + 0.5))
+                if len(means) == self.num_contrasts:
+                    break
+            if not fires[i]:
+                continue
+            if isinstance(operation, Operations.RandomBrightness):
+                x = blend(np.float32(0), x, np.float32(values[i]))
+            elif isinstance(operation, Operations.RandomColor):
+                x = blend(luminance(x)[..., np.newaxis], x, np.float32(values[i]))
+            else:
+                x = blend(np.float32(means[-1]), x, np.float32(values[i]))
+        return means
+
+    def apply(self, batch, params, means=None):
+        """Applies the rotations, flips and pixel intensity operations in place.
+        # Arguments
+            batch: uint8 array of shape `(n, height, width, 3)` of the loaded images.
+            params: Parameters returned by `sample(n)`.
+            means: Mean luminances returned by `load` for every image, required for contrast operations.
+        # Returns
+            The augmented batch.
+        """
+        contrast_index = -1
+        for operation, (fires, values) in zip(self.operations, params):
+            if isinstance(operation, Operations.RandomContrast):
+                contrast_index += 1
+            if not fires.any():
+                continue
+            if isinstance(operation, Operations.Rotate):
+                # PIL and numpy both rotate counter clockwise
+                for k in (1, 2, 3):
+                    index = np.flatnonzero(fires & (values == k))
+                    if len(index):
+                        batch[index] = np.rot90(batch[index], k, axes=(1, 2))
+            elif isinstance(operation, Operations.Flip):
+                axis = {'TOP_BOTTOM': 0, 'LEFT_RIGHT': 1}.get(operation.top_bottom_left_right)
+                for flip_axis in (0, 1):
+                    # The random axis of 'RANDOM' flips is 0 for left/right and 1 for top/bottom
+                    mask = fires & (values == 1 - flip_axis) if axis is None else fires & (axis == flip_axis)
+                    index = np.flatnonzero(mask)
+                    if len(index):
+                        batch[index] = np.flip(batch[index], axis=1 + flip_axis)
+            elif isinstance(operation, INTENSITY_OPERATIONS):
+                index = np.flatnonzero(fires)
+                x = batch[index]
+                factor = values[index].astype(np.float32)[:, np.newaxis, np.newaxis, np.newaxis]
+                if isinstance(operation, Operations.RandomBrightness):
+                    degenerate = np.float32(0)
+                elif isinstance(operation, Operations.RandomColor):
+                    degenerate = luminance(x)[..., np.newaxis]
+                else:
+                    degenerate = np.asarray(means, dtype=np.float32)[index, contrast_index][:, np.newaxis, np.newaxis, np.newaxis]
+                batch[index] = blend(degenerate, x, factor)
+        return batch
+
+    def _get_random_state(self):
+        # Forked workers would otherwise draw the same numbers
+        if self._random_state is None or self._random_state_pid != os.getpid():
+            self._random_state = np.random.RandomState()
+            self._random_state_pid = os.getpid()
+        return self._random_state
@@ -1,7 +1,9 @@
 import pandas as pd
 import numpy as np
 import os
-from pathlib import Path
+import pickle
+import warnings
+from PIL import Image
 from sklearn.model_selection import train_test_split
 from sklearn.utils import class_weight
 
@@ -12,7 +14,7 @@ def load_isic_training_data(image_folder, ground_truth_file, test=False):
     unknown_category_name = df_ground_truth.columns.values[9]
     
     # Add path and category columns
-    df_ground_truth['path'] = df_ground_truth.apply(lambda row : os.path.join(image_folder, row['image']+'.jpg'), axis=1)
+    df_ground_truth['path'] = os.path.join(image_folder, '') + df_ground_truth['image'] + '.jpg'
     df_ground_truth['category'] = np.argmax(np.array(df_ground_truth.iloc[:,1:10]), axis=1)
 
     res=df_ground_truth
@@ -31,7 +33,7 @@ def load_isic_training_and_out_dist_data(isic_image_folder, ground_truth_file, o
     unknown_category_name = df_ground_truth.columns.values[9]
     
     # Add path and category columns
-    df_ground_truth['path'] = df_ground_truth.apply(lambda row : os.path.join(isic_image_folder, row['image']+'.jpg'), axis=1)
+    df_ground_truth['path'] = os.path.join(isic_image_folder, '') + df_ground_truth['image'] + '.jpg'
     
     df_out_dist = get_dataframe_from_img_folder(out_dist_image_folder, has_path_col=True)
     for name in known_category_names:
@@ -55,8 +57,99 @@ def compute_class_weight_dict(df):
     class_weights = class_weight.compute_class_weight("balanced", np.unique(df['category']), df['category'])
     return dict(enumerate(class_weights))
 
+MANIFEST_FILENAME = '.image_manifest.pkl'
+MANIFEST_COLUMNS = ['directory', 'relative_path', 'image', 'size', 'mtime', 'width', 'height']
+
+
+def _scan_directory(folder, directory, previous_files):
+    """Rows of the JPEG files and the subdirectories of a directory, rows of unchanged files are reused.
+    # Returns
+        Tuple of the rows, the subdirectories and whether any file was added, removed or modified.
+    """
+    previous_rows = {row['relative_path']: row for row in previous_files.to_dict('records')}
+    rows = []
+    subdirectories = []
+    changed = False
+    with os.scandir(os.path.join(folder, directory)) as entries:
+        for entry in entries:
+            relative_path = os.path.join(directory, entry.name)
+            if entry.is_dir():
+                subdirectories.append(relative_path)
+            elif entry.name.endswith('.jpg') and entry.is_file():
+                stat = entry.stat()
+                row = previous_rows.get(relative_path)
+                if row is None or row['size'] != stat.st_size or row['mtime'] != stat.st_mtime_ns:
+                    # Only the header is read
+                    try:
+                        with Image.open(entry.path) as img:
+                            width, height = img.size
+                    except OSError as e:
+                        # e.g. truncated or non-image files, listed without dimensions
+                        warnings.warn('Cannot read the header of {}: {}'.format(entry.path, e))
+                        width, height = None, None
+                    row = dict(
+                        directory=directory, relative_path=relative_path, image=entry.name[:-len('.jpg')],
+                        size=stat.st_size, mtime=stat.st_mtime_ns, width=width, height=height
+                    )
+                    changed = True
+                rows.append(row)
+    return rows, subdirectories, changed or len(rows) != len(previous_rows)
+
+
+def load_image_manifest(img_folder):
+    """Manifest of the JPEG files of an image folder and its subfolders.
+
+    The manifest (image id, relative path, file size and modification time, image dimensions) is
+    cached in the folder. Every load still lists the folders and stats every file (files overwritten
+    in place do not change the modification time of their directory), the manifest saves reading the
+    headers of the unchanged files. Files whose header cannot be read are listed without dimensions.
+
+    # Returns
+        A DataFrame with the columns of `MANIFEST_COLUMNS` and `path`, sorted by path.
+    """
+    manifest_file = os.path.join(img_folder, MANIFEST_FILENAME)
+    files = pd.DataFrame(columns=MANIFEST_COLUMNS)
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'rb') as f:
+            cached = pickle.load(f)
+        # Manifests of the former format are rebuilt
+        if isinstance(cached, pd.DataFrame):
+            files = cached
+
+    # Walk the directory tree, the rows of unchanged files are reused
+    previous_files = dict(tuple(files.groupby('directory')))
+    directories = set()
+    rows = []
+    changed = False
+    stack = ['']
+    while stack:
+        directory = stack.pop()
+        directory_rows, subdirectories, directory_changed = _scan_directory(
+            img_folder, directory, previous_files.get(directory, files.iloc[:0]))
+        rows += directory_rows
+        changed = changed or directory_changed
+        directories.add(directory)
+        stack.extend(subdirectories)
+
+    if changed or not directories.issuperset(previous_files.keys()):
+        files = pd.DataFrame(rows, columns=MANIFEST_COLUMNS).sort_values('relative_path').reset_index(drop=True)
+        try:
+            tmp_file = '{}.{}.tmp'.format(manifest_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(files, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, manifest_file)
+        except OSError as e:
+            warnings.warn('The image manifest of {} cannot be cached: {}'.format(img_folder, e))
+
+    files = files.copy()
+    files['path'] = os.path.join(img_folder, '') + files['relative_path']
+    return files
+
+
 def get_dataframe_from_img_folder(img_folder, has_path_col=True):
+    """Image ids (and paths) of the JPEG files of an image folder and its subfolders, sorted by path."""
+    manifest = load_image_manifest(img_folder)
     if has_path_col:
-        return pd.DataFrame([[Path(x).stem, x] for x in sorted(Path(img_folder).glob('**/*.jpg'))], columns=['image', 'path'], dtype=np.str)
+        return manifest[['image', 'path']].reset_index(drop=True)
     else:
-        return pd.DataFrame([Path(x).stem for x in sorted(Path(img_folder).glob('**/*.jpg'))], columns=['image'], dtype=np.str)
+        return manifest[['image']].reset_index(drop=True)
@@ -1,13 +1,18 @@
 import argparse
+import functools
+import hashlib
 import itertools
 import math
+import multiprocessing
 import os
 import random
 import shutil
 import json
 import time
+import zlib
 from collections import Counter
 from math import floor
+from typing import NamedTuple
 import numpy as np
 import pandas as pd
 import PIL
@@ -15,16 +20,20 @@ import sklearn.model_selection
 import tensorflow as tf
 from tqdm import tqdm
 from data_loader import load_isic_training_data, load_isic_training_and_out_dist_data, train_validation_split, get_dataframe_from_img_folder
-from augmentations import get_augmentation_group, crop_center
+from augmentations import get_augmentation_group, get_draft_size, crop_center, open_image
+from image_shards import write_index, write_shard
 
 
-def load_image(filename, target_size=None, center_crop=True):
+def load_image(filename, target_size=None, center_crop=True, draft_size=None):
 
     def _resize(img, target_size):
         assert target_size[0] == target_size[1]
         return img.resize(target_size, PIL.Image.BICUBIC)
 
-    img = PIL.Image.open(filename).convert('RGB')
+    if draft_size is None:
+        # Center crop and resize never need more pixels than the target size
+        draft_size = target_size
+    img = open_image(filename, draft_size).convert('RGB')
     if center_crop:
         img = crop_center(img)
     if target_size is not None:
@@ -32,66 +41,100 @@ def load_image(filename, target_size=None, center_crop=True):
     return img
 
 
-def augment(source_dataframe, operations, n, img_size):
-    n = n - source_dataframe.shape[0] 
+def load_original(filename, img_size, cache_folder=None):
+    """Center cropped, resized image, read from a content-addressed cache shared by data_sampler runs if `cache_folder` is set.
+    Cached images are keyed by the SHA-1 of the source file and the target size, so renamed or
+    copied originals still hit the cache and modified ones never serve stale images.
+    """
+    if cache_folder is None:
+        return load_image(filename, target_size=img_size, center_crop=True)
+
+    with open(filename, 'rb') as f:
+        key = hashlib.sha1(f.read()).hexdigest()
+    cache_path = os.path.join(cache_folder, '{}x{}'.format(*img_size), key[:2], key + '.npy')
+    if os.path.exists(cache_path):
+        return PIL.Image.fromarray(np.load(cache_path))
+
+    img = load_image(filename, target_size=img_size, center_crop=True)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Write to a temporary file first so concurrent workers and runs never read a partial image
+    tmp_path = '{}.{}.tmp.npy'.format(cache_path, os.getpid())
+    np.save(tmp_path, np.asarray(img))
+    os.replace(tmp_path, cache_path)
+    return img
+
+
+def load_samples(df, img_size, cache_folder=None):
+    """Yields the record (without path) and the center cropped, resized image of every row, one at a time."""
+    for record in df.to_dict('records'):
+        img = load_original(record.pop('path'), img_size, cache_folder)
+        yield record, img
+
+
+def augment_samples(df, operations, img_size):
+    """Yields the record and the augmented image of every row, one at a time."""
+    draft_size = get_draft_size(operations)
+    for record in df.to_dict('records'):
+        augmented_image = load_image(record.pop('path'), center_crop=False, draft_size=draft_size)
+        for operation in operations:
+            r = round(random.uniform(0, 1), 1)
+            if r <= operation.probability:
+                augmented_image = operation.perform_operation([augmented_image])[0]
+
+        record['image'] = f"{record['image']}_{random.randrange(1000000)}"
+        yield record, augmented_image
+
 
-    # Load original images
-    source_dataframe['img'] = source_dataframe.apply(lambda row: load_image(row.path, center_crop=True, target_size=img_size), axis=1)
+def derive_seed(seed, *keys):
+    """Deterministic 32-bit seed of a task, e.g. `derive_seed(seed, category, chunk)`."""
+    return zlib.crc32(repr((seed,) + keys).encode())
 
-    # Chose random samples to augment
-    augmentor_df = source_dataframe.sample(n=n, replace=True)
 
-    # Augment random samples
-    with tqdm(total=augmentor_df.shape[0], desc="Executing Pipeline", unit=" Samples") as progress_bar:
-        for _, row in augmentor_df.iterrows():
+# Rows of a chunk of samples, augmented with the data augmentation group `dg_group` or only
+# center cropped and resized if None, the seed of the random draws of the augmentations and
+# the optional cache folder of the center cropped, resized originals
+SampleTask = NamedTuple('SampleTask', [('df', pd.DataFrame), ('img_size', tuple), ('dg_group', int), ('seed', int), ('cache_folder', str)])
 
-            augmented_image = load_image(row.path, center_crop=False)
-            for operation in operations:
-                r = round(random.uniform(0, 1), 1)
-                if r <= operation.probability:
-                    augmented_image = operation.perform_operation([augmented_image])[0]
 
-            row['img'] = augmented_image
-            row['image'] = f"{row['image']}_{random.randrange(1000000)}"
+def split_tasks(df, img_size, dg_group, seed, *keys, chunk_size=256, cache_folder=None):
+    """Splits the rows into tasks of `chunk_size` rows, whose seeds only depend on `seed`, `keys` and the chunk index."""
+    return [
+        SampleTask(df.iloc[start:start + chunk_size], img_size, dg_group, derive_seed(seed, *keys, start // chunk_size), cache_folder)
+        for start in range(0, df.shape[0], chunk_size)
+    ]
 
-            source_dataframe = source_dataframe.append(row)
-            
-            progress_bar.set_description("Processing %s" % os.path.basename(row["image"]))
-            progress_bar.update(1)
 
-    # Return original + augmented samples
-    return source_dataframe
+def generate_samples(task):
+    """Yields the record and image of every sample of a task, one at a time."""
+    random.seed(task.seed)
+    np.random.seed(task.seed)
+    if task.dg_group is None:
+        return load_samples(task.df, task.img_size, task.cache_folder)
+    return augment_samples(task.df, get_augmentation_group(task.dg_group, task.img_size), task.img_size)
 
 
-def sample(df_ground_truth, images_path, count_per_category, dg_group, img_size=(224,224)):
-    result = pd.DataFrame()
+def sample(df_ground_truth, count_per_category, dg_group, img_size=(224,224), seed=0, cache_folder=None):
+    """Tasks generating the sampled training set, category after category."""
+    tasks = []
     for i, _ in enumerate(count_per_category):
         category_samples = df_ground_truth.loc[df_ground_truth['category'] == i]
+        random_state = np.random.RandomState(derive_seed(seed, i))
         if(count_per_category[i] > category_samples.shape[0]):
             # oversample
             print(f'Augmenting {category_samples.shape[0]} samples from class {i} into approximately {count_per_category[i]} samples...')
-            data_augmentations = get_augmentation_group(dg_group, img_size)
-            samples = augment(
-                category_samples, 
-                data_augmentations, 
-                count_per_category[i],
-                img_size
-            )
+            # Chose random samples to augment
+            augmentor_df = category_samples.sample(n=count_per_category[i] - category_samples.shape[0], replace=True, random_state=random_state)
+            tasks += split_tasks(category_samples, img_size, None, seed, i, 'original', cache_folder=cache_folder)
+            tasks += split_tasks(augmentor_df, img_size, dg_group, seed, i, 'augmented')
         elif(count_per_category[i] < category_samples.shape[0]):
             # keep undersample 
             print(f'Undersampling {category_samples.shape[0]} samples from class {i} into approximately {count_per_category[i]} samples...')
-            samples = category_samples.sample(n=count_per_category[i])
-            samples['img'] = samples.apply(lambda row: load_image(os.path.join(images_path, row.image+'.jpg'), target_size=img_size, center_crop=True), axis=1)
+            tasks += split_tasks(category_samples.sample(n=count_per_category[i], random_state=random_state), img_size, None, seed, i, cache_folder=cache_folder)
         else:
             # Keep original samples
             print(f'Keeping original {category_samples.shape[0]} samples from class {i} ...')
-            samples = category_samples.copy()
-            samples['img'] = category_samples.apply(lambda row: load_image(os.path.join(images_path, row.image+'.jpg'), target_size=img_size, center_crop=True), axis=1)
-        
-        result = result.append(samples) 
-
-    # Shuffle rows and return result
-    return result.sample(frac=1).reset_index(drop=True) 
+            tasks += split_tasks(category_samples, img_size, None, seed, i, cache_folder=cache_folder)
+    return tasks
 
 
 def process(
@@ -104,7 +147,9 @@ def process(
     min_samples,
     data_augmentation_group,
     unknown_images_path=None,
-    unknown_train=False
+    unknown_train=False,
+    seed=0,
+    cache_folder=None
 ):
 
     if unknown_images_path and unknown_train is True:
@@ -126,7 +171,7 @@ def process(
         df_out_dist["category"] = 8
         # Change the order of columns
         df_out_dist = df_out_dist[df_train.columns.values]
-        df_test = df_test.append(df_out_dist)
+        df_test = pd.concat([df_test, df_out_dist])
 
 
     # Process train set + oversample/undersample class samples
@@ -159,26 +204,45 @@ def process(
             samples_per_category[-1] = samples_per_category[-1] + (training_samples - sum(samples_per_category)) 
     
     print(f'Turning {total_sample_count} samples into {sum(samples_per_category)} samples...')
-    result = sample(
+    train_tasks = sample(
         df_train,
-        images_path, 
         samples_per_category,
         data_augmentation_group,
-        img_size = target_img_size
+        img_size = target_img_size,
+        seed = seed,
+        cache_folder = cache_folder
     )
 
     # Process test set
-    df_test = df_test.sample(frac=1).reset_index(drop=True)
-    df_test['img'] = df_test.apply(lambda row: load_image(row.path, target_size=target_img_size), axis=1)
+    test_tasks = split_tasks(df_test, target_img_size, None, seed, 'test', cache_folder=cache_folder)
 
-    # Removing unnecessary path column
-    del result['path']
-    del df_test['path']
+    # Samples are generated by save
+    return train_tasks, test_tasks
 
-    return result, df_test
 
-
-def save(df, images_path, descriptions_path):
+def save_samples(shard_task, images_path, image_format='jpeg'):
+    """Writes every image of a task as soon as it is produced, or the shard of the task, and returns the records of the samples."""
+    shard, task = shard_task
+    records = []
+    images = []
+    for record, img in generate_samples(task):
+        if image_format == 'shards':
+            images.append(img)
+        else:
+            img.save(os.path.join(images_path, f'{record["image"]}.jpg'))
+        records.append(record)
+    if image_format == 'shards':
+        write_shard(images_path, shard, images, task.img_size)
+    return records
+
+
+def save(tasks, images_path, descriptions_path, workers=1, seed=0, image_format='jpeg'):
+    """Generates and writes the images of the tasks with a process pool and the ground truth csv file of their records.
+    The output only depends on the tasks and `seed`, not on the number of workers.
+    With `image_format` 'shards', the images of every task are packed into one shard (see `image_shards`).
+    # Returns
+        The shuffled ground truth DataFrame, including the category column.
+    """
     if os.path.exists(images_path):
         shutil.rmtree(images_path)
 
@@ -186,17 +250,31 @@ def save(df, images_path, descriptions_path):
     if os.path.exists(descriptions_path):
         os.remove(descriptions_path)
 
-    for _, row in df.iterrows():
-        row["img"].save(os.path.join(images_path, f'{row["image"]}.jpg'))
-    
-    del df['img']
-    del df['category']
-
-    df.to_csv(descriptions_path, index=False)
+    records = []
+    shard_records = []
+    with multiprocessing.Pool(workers) as pool, \
+            tqdm(total=sum(task.df.shape[0] for task in tasks), desc=os.path.basename(images_path), unit=" Samples") as progress_bar:
+        # Records are collected in task order
+        save_task = functools.partial(save_samples, images_path=images_path, image_format=image_format)
+        for shard, task_records in enumerate(pool.imap(save_task, enumerate(tasks))):
+            records += task_records
+            if image_format == 'shards':
+                shard_records += [
+                    dict({key: record[key] for key in ('image', 'category') if key in record}, shard=shard, row=row)
+                    for row, record in enumerate(task_records)
+                ]
+            progress_bar.update(len(task_records))
+
+    if image_format == 'shards':
+        write_index(images_path, shard_records)
+
+    # Shuffle rows
+    df = pd.DataFrame.from_records(records).sample(frac=1, random_state=derive_seed(seed, 'shuffle')).reset_index(drop=True)
+    df.drop(columns=['category'], errors='ignore').to_csv(descriptions_path, index=False)
+    return df
 
 def save_no_unknown(df_test, no_unknown_descriptions_file):
     df_test_no_unknown = df_test.copy()
-    del df_test_no_unknown['img']
     df_test_no_unknown = df_test_no_unknown[df_test_no_unknown.category != 8]
     del df_test_no_unknown['category']
     df_test_no_unknown.to_csv(no_unknown_descriptions_file, index=False)
@@ -212,26 +290,49 @@ if __name__ == '__main__':
     parser.add_argument('--target-size', type=int, default=224)
     parser.add_argument('--training-samples', type=int, default=None)
     parser.add_argument('--class-balance', dest='classbalance', action='store_true', default=False)
+    parser.add_argument('--min-samples', dest='min_samples', type=int, default=None)
     parser.add_argument('--data-augmentation-group', dest='dggroup', default=1, type=int)
     parser.add_argument('--output', default="./isic2019/sampled", required=True)
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the sampling and augmentations, the output does not depend on the number of workers (default: %(default)s)')
+    parser.add_argument('--image-format', dest='image_format', choices=['jpeg', 'shards'], default='jpeg', help='Write one JPEG file per sample or packed uint8 shards at --target-size that need no decoding (default: %(default)s)')
+    parser.add_argument('--cache-folder', dest='cache_folder', default=None, help='Folder of the center cropped, resized originals shared by data_sampler runs, disabled if not set (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of processes generating the samples (default: %(default)s)')
     args = parser.parse_args()
 
-    df_train, df_test = process(
+    train_tasks, test_tasks = process(
         args.images, 
         args.test,
         args.descriptions, 
         (args.target_size, args.target_size), 
         args.training_samples, 
         args.classbalance,
+        args.min_samples,
         args.dggroup,
         unknown_images_path=args.unknown_images,
-        unknown_train=args.unknown_train
+        unknown_train=args.unknown_train,
+        seed=args.seed,
+        cache_folder=args.cache_folder
     )
     
     save(
-        df_train, 
+        train_tasks, 
         os.path.join(args.output, 'ISIC_2019_Training_Input'), 
-        os.path.join(args.output, 'ISIC_2019_Training_GroundTruth.csv')
+        os.path.join(args.output, 'ISIC_2019_Training_GroundTruth.csv'),
+        workers=args.workers,
+        seed=args.seed,
+        image_format=args.image_format
+    )
+
+    df_test = save(
+        test_tasks, 
+        os.path.join(args.output, 'ISIC_2019_Test_Input'), 
+        os.path.join(
+            args.output, 
+            'ISIC_2019_Test_GroundTruth_Unknown.csv' if args.unknown_images is not None else 'ISIC_2019_Test_GroundTruth.csv' 
+        ),
+        workers=args.workers,
+        seed=args.seed,
+        image_format=args.image_format
     )
 
     if args.unknown_images is not None:
@@ -241,15 +342,6 @@ if __name__ == '__main__':
             os.path.join(args.output, 'ISIC_2019_Test_GroundTruth.csv')
         )
 
-    save(
-        df_test, 
-        os.path.join(args.output, 'ISIC_2019_Test_Input'), 
-        os.path.join(
-            args.output, 
-            'ISIC_2019_Test_GroundTruth_Unknown.csv' if args.unknown_images is not None else 'ISIC_2019_Test_GroundTruth.csv' 
-        )
-    )
-
     metadata = {
         "path": args.output,
         "target_size": args.target_size,
@@ -259,7 +351,9 @@ if __name__ == '__main__':
         "descriptions_location": args.descriptions, 
         "unknown_images_location": args.unknown_images,
         "unknown_train": args.unknown_train,
-        "data_augmentation_group": args.dggroup
+        "data_augmentation_group": args.dggroup,
+        "seed": args.seed,
+        "image_format": args.image_format
     }
     
     with open(os.path.join(args.output, "metadata.json"), "w") as meta_file:
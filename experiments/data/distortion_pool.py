@@ -0,0 +1,87 @@
+"""Precomputed random distortions of `Operations.Distort`.
+
+Augmentor's `Distort` displaces the inner vertices of a grid over the image by random integers
+in [-magnitude, magnitude] and resamples the image with a mesh transform, which maps every grid
+cell bilinearly. That is a displacement field interpolating the vertex displacements bilinearly.
+`DistortionPool` draws the vertex displacements of a pool of such fields once and distorts an image
+with one random field of the pool, interpolated at the image size, and a single remap.
+"""
+import random
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def _interpolation_weights(length, tiles):
+    """Weights of the grid vertices along one axis at every pixel center, as Augmentor lays out the tiles."""
+    tile = length // tiles
+    vertices = [i * tile for i in range(tiles)] + [length]
+    centers = np.arange(length) + 0.5
+    return np.stack([np.interp(centers, vertices, weights) for weights in np.eye(tiles + 1)])
+
+
+class DistortionPool():
+    """Pool of random displacement fields of a `Distort` operation.
+
+    The pool stores the grid vertex displacements, which do not depend on the image size, and
+    interpolates the field of a vertex grid at the size of every distorted image, so the source
+    images of any size share the pool.
+
+    # Arguments
+        operation: `Operations.Distort`.
+        pool_size: Integer, number of displacement fields.
+        seed: Optional random seed of the fields.
+    """
+
+    def __init__(self, operation, pool_size=64, seed=None):
+        self.grid_width = operation.grid_width
+        self.grid_height = operation.grid_height
+        self.magnitude = operation.magnitude
+        self.pool_size = pool_size
+        rng = np.random.RandomState(seed)
+        # Same draws as Augmentor: independent integers for the inner vertices, the border stays in place,
+        # in units of `magnitude` pixels
+        self.vertices = np.zeros((pool_size, 2, self.grid_height + 1, self.grid_width + 1), dtype=np.float32)
+        self.vertices[:, :, 1:-1, 1:-1] = rng.randint(
+            -self.magnitude, self.magnitude + 1,
+            (pool_size, 2, self.grid_height - 1, self.grid_width - 1)
+        ) / float(max(self.magnitude, 1))
+        self._weights = {} # (length, tiles) -> float32 array (length, tiles + 1)
+        # Images distorted with the pool in this process, see `pipeline_validation.check_distortion_pool`
+        self.distortions = 0
+
+    def _get_weights(self, length, tiles):
+        weights = self._weights.get((length, tiles))
+        if weights is None:
+            weights = np.ascontiguousarray(_interpolation_weights(length, tiles).T, dtype=np.float32)
+            self._weights[(length, tiles)] = weights
+        return weights
+
+    def get_field(self, index, size):
+        """Displacement field `index` of the pool at image `size`, in units of `magnitude` pixels.
+        # Returns
+            float32 array of shape `(2, height, width)` of the x and y displacements.
+        """
+        width, height = size
+        weights_x = self._get_weights(width, self.grid_width)
+        weights_y = self._get_weights(height, self.grid_height)
+        # Bilinear interpolation of the vertices, separable in y and x
+        return np.matmul(np.matmul(weights_y, self.vertices[index]), weights_x.T)
+
+    def distort(self, image, magnitude=None):
+        """Distorts a PIL image with a random field of the pool.
+        # Arguments
+            image: PIL Image.
+            magnitude: Maximum displacement in pixels, `operation.magnitude` if None.
+        # Returns
+            The distorted PIL Image.
+        """
+        if magnitude is None:
+            magnitude = self.magnitude
+        self.distortions += 1
+        x = np.asarray(image)
+        field = self.get_field(random.randrange(self.pool_size), image.size)
+        # The mesh transform samples the source at the displaced pixel centers
+        map_x = field[0] * magnitude + np.arange(image.width, dtype=np.float32)
+        map_y = field[1] * magnitude + np.arange(image.height, dtype=np.float32)[:, np.newaxis]
+        return Image.fromarray(cv2.remap(x, map_x, map_y, cv2.INTER_CUBIC, borderMode=cv2.BORDER_CONSTANT))
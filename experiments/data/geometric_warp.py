@@ -0,0 +1,303 @@
+"""Fused geometric warp for augmentation pipelines made of geometric operations (groups 0, 1 and 3).
+
+Augmentor resamples the full resolution image once per operation: a rotation, two flips, a shear
+(transform, crop and resize), three skews, a crop and the final resize. `FusedWarpPipeline` samples
+the same random parameters, composes every operation into one 3x3 matrix mapping the output pixels
+to the source pixels and resamples the source image once, straight to the input size of the network.
+
+Matrices follow PIL's continuous pixel coordinates (pixel centers at +0.5), in which rotations,
+flips, crops, resizes and PIL's affine and perspective transforms are all exact projective maps.
+"""
+import math
+import random
+import time
+import numpy as np
+from PIL import Image
+from Augmentor import Operations
+from data.augmentations import CropCenter, CustomPipeline, perform_deferred_operations
+
+FUSABLE_OPERATIONS = (
+    CropCenter,
+    Operations.Rotate,
+    Operations.Flip,
+    Operations.Shear,
+    Operations.Skew,
+    Operations.CropPercentage,
+    Operations.Resize,
+)
+
+# Largest source pixels / output pixels ratio resampled directly, larger ratios are first reduced
+# with a box filter since PIL's transforms do not antialias
+MAX_WARP_SCALE = 2.0
+
+
+def supports(operations):
+    """Whether every operation can be fused into a single warp."""
+    for operation in operations:
+        if not isinstance(operation, FUSABLE_OPERATIONS):
+            return False
+        if isinstance(operation, Operations.Rotate) and operation.rotation not in (-1, 90, 180, 270):
+            return False
+        if isinstance(operation, Operations.Skew) and operation.skew_type == 'ALL':
+            return False
+    return True
+
+
+def translate(dx, dy):
+    return np.array([[1., 0., dx], [0., 1., dy], [0., 0., 1.]])
+
+
+def scale(sx, sy):
+    return np.array([[sx, 0., 0.], [0., sy, 0.], [0., 0., 1.]])
+
+
+def _rotate(k, w, h):
+    """Counter clockwise rotation by k * 90 degrees with `expand=True`, as `Image.rotate`."""
+    if k == 1:
+        return np.array([[0., -1., w], [1., 0., 0.], [0., 0., 1.]]), (h, w)
+    if k == 2:
+        return np.array([[-1., 0., w], [0., -1., h], [0., 0., 1.]]), (w, h)
+    return np.array([[0., 1., 0.], [-1., 0., h], [0., 0., 1.]]), (h, w)
+
+
+def _crop(box):
+    left, upper, right, lower = (int(round(v)) for v in box)
+    return translate(left, upper), (right - left, lower - upper)
+
+
+def _shear(operation, w, h):
+    """Same steps as `Operations.Shear`: affine transform to a wider (or taller) image, crop and resize back."""
+    angle_to_shear = int(random.uniform((abs(operation.max_shear_left) * -1) - 1, operation.max_shear_right + 1))
+    if angle_to_shear != -1:
+        angle_to_shear += 1
+    direction = random.choice(['x', 'y'])
+    phi = math.tan(math.radians(angle_to_shear))
+
+    if direction == 'x':
+        shift_in_pixels = phi * h
+        shift_in_pixels = math.ceil(shift_in_pixels) if shift_in_pixels > 0 else math.floor(shift_in_pixels)
+        matrix_offset = shift_in_pixels
+        if angle_to_shear <= 0:
+            shift_in_pixels = abs(shift_in_pixels)
+            matrix_offset = 0
+            phi = abs(phi) * -1
+        affine = np.array([[1., phi, -matrix_offset], [0., 1., 0.], [0., 0., 1.]])
+        crop, (cropped_w, cropped_h) = _crop((abs(shift_in_pixels), 0, w, h))
+    else:
+        shift_in_pixels = phi * w
+        matrix_offset = shift_in_pixels
+        if angle_to_shear <= 0:
+            shift_in_pixels = abs(shift_in_pixels)
+            matrix_offset = 0
+            phi = abs(phi) * -1
+        affine = np.array([[1., 0., 0.], [phi, 1., -matrix_offset], [0., 0., 1.]])
+        crop, (cropped_w, cropped_h) = _crop((0, abs(shift_in_pixels), w, h))
+
+    return affine.dot(crop).dot(scale(cropped_w / w, cropped_h / h)), (w, h)
+
+
+def _skew(operation, w, h):
+    """Same random corners and perspective coefficients as `Operations.Skew`."""
+    x1, x2, y1, y2 = 0, h, 0, w
+    original_plane = [(y1, x1), (y2, x1), (y2, x2), (y1, x2)]
+    skew_amount = random.randint(1, int(math.ceil(max(w, h) * operation.magnitude)))
+
+    if operation.skew_type == 'RANDOM':
+        skew = random.choice(['TILT', 'TILT_LEFT_RIGHT', 'TILT_TOP_BOTTOM', 'CORNER'])
+    else:
+        skew = operation.skew_type
+
+    if skew == 'CORNER':
+        corner = random.randint(0, 7)
+        new_plane = list(original_plane)
+        x, y = new_plane[corner // 2]
+        # Even directions move the corner horizontally, odd ones vertically, outwards
+        sign_x = -1 if x == y1 else 1
+        sign_y = -1 if y == x1 else 1
+        new_plane[corner // 2] = (x + sign_x * skew_amount, y) if corner % 2 == 0 else (x, y + sign_y * skew_amount)
+    else:
+        if skew == 'TILT':
+            skew_direction = random.randint(0, 3)
+        elif skew == 'TILT_LEFT_RIGHT':
+            skew_direction = random.randint(0, 1)
+        else:
+            skew_direction = random.randint(2, 3)
+        new_plane = [
+            [(y1, x1 - skew_amount), (y2, x1), (y2, x2), (y1, x2 + skew_amount)],  # Left tilt
+            [(y1, x1), (y2, x1 - skew_amount), (y2, x2 + skew_amount), (y1, x2)],  # Right tilt
+            [(y1 - skew_amount, x1), (y2 + skew_amount, x1), (y2, x2), (y1, x2)],  # Forward tilt
+            [(y1, x1), (y2, x1), (y2 + skew_amount, x2), (y1 - skew_amount, x2)],  # Backward tilt
+        ][skew_direction]
+
+    matrix = []
+    for p1, p2 in zip(new_plane, original_plane):
+        matrix.append([p1[0], p1[1], 1, 0, 0, 0, -p2[0] * p1[0], -p2[0] * p1[1]])
+        matrix.append([0, 0, 0, p1[0], p1[1], 1, -p2[1] * p1[0], -p2[1] * p1[1]])
+    coefficients = np.dot(np.linalg.pinv(np.array(matrix, dtype=float)), np.array(original_plane).reshape(8))
+    return np.append(coefficients, 1.).reshape(3, 3), (w, h)
+
+
+def plan_warp(operations, size):
+    """Samples the random parameters of `operations` for an image of `size` like `CustomPipeline`
+    and composes them.
+    # Returns
+        Tuple of the 3x3 matrix mapping output to source pixel coordinates, the output size and the
+        area fraction kept by the crops.
+    """
+    matrix = np.eye(3)
+    w, h = size
+    crop_fraction = 1.0
+    for operation in operations:
+        # Same test as `CustomPipeline.perform_operations`
+        if round(random.uniform(0, 1), 1) > operation.probability:
+            continue
+        if isinstance(operation, Operations.Rotate):
+            random_factor = random.randint(1, 3)
+            k = random_factor if operation.rotation == -1 else operation.rotation // 90
+            step, (w, h) = _rotate(k, w, h)
+        elif isinstance(operation, Operations.Flip):
+            random_axis = random.randint(0, 1)
+            lr = operation.top_bottom_left_right == 'LEFT_RIGHT' or (operation.top_bottom_left_right == 'RANDOM' and random_axis == 0)
+            step = np.array([[-1., 0., w], [0., 1., 0.], [0., 0., 1.]]) if lr else np.array([[1., 0., 0.], [0., -1., h], [0., 0., 1.]])
+        elif isinstance(operation, CropCenter):
+            length = min(w, h)
+            left, upper = (w - length) // 2, (h - length) // 2
+            step, (w, h) = _crop((left, upper, left + length, upper + length))
+        elif isinstance(operation, Operations.CropPercentage):
+            if operation.randomise_percentage_area:
+                percentage_area = round(random.uniform(0.1, operation.percentage_area), 2)
+            else:
+                percentage_area = operation.percentage_area
+            w_new = int(math.floor(w * percentage_area))
+            h_new = int(math.floor(h * percentage_area))
+            left_shift = random.randint(0, int(w - w_new))
+            down_shift = random.randint(0, int(h - h_new))
+            if operation.centre:
+                box = ((w / 2) - (w_new / 2), (h / 2) - (h_new / 2), (w / 2) + (w_new / 2), (h / 2) + (h_new / 2))
+            else:
+                box = (left_shift, down_shift, w_new + left_shift, h_new + down_shift)
+            step, (w_crop, h_crop) = _crop(box)
+            crop_fraction *= (w_crop * h_crop) / float(w * h)
+            w, h = w_crop, h_crop
+        elif isinstance(operation, Operations.Shear):
+            step, (w, h) = _shear(operation, w, h)
+        elif isinstance(operation, Operations.Skew):
+            step, (w, h) = _skew(operation, w, h)
+        elif isinstance(operation, Operations.Resize):
+            step = scale(w / float(operation.width), h / float(operation.height))
+            w, h = operation.width, operation.height
+        matrix = matrix.dot(step)
+    return matrix, (w, h), crop_fraction
+
+
+def warp_scale(matrix, size):
+    """Source pixels per output pixel around the center of the output image."""
+    cx, cy = size[0] / 2., size[1] / 2.
+    x, y, z = matrix.dot([cx, cy, 1.])
+    # Jacobian of the projective map at the center
+    jacobian = (matrix[:2, :2] * z - np.outer([x, y], matrix[2, :2])) / (z * z)
+    return math.sqrt(abs(np.linalg.det(jacobian)))
+
+
+def source_box(matrix, size, source_size=None, margin=2):
+    """Box of the source image holding the pixels an output of `size` is sampled from.
+    Integer box expanded by `margin` pixels and clipped to `source_size` if given."""
+    corners = matrix.dot([[0., size[0], size[0], 0.], [0., 0., size[1], size[1]], [1., 1., 1., 1.]])
+    x, y = corners[:2] / corners[2]
+    if source_size is None:
+        return x.min(), y.min(), x.max(), y.max()
+    return (
+        max(0, int(math.floor(x.min())) - margin),
+        max(0, int(math.floor(y.min())) - margin),
+        min(source_size[0], int(math.ceil(x.max())) + margin),
+        min(source_size[1], int(math.ceil(y.max())) + margin),
+    )
+
+
+def is_axis_aligned(matrix):
+    """Whether `matrix` only scales, translates, flips and swaps the axes."""
+    linear = matrix[:2, :2]
+    return not matrix[2, :2].any() and (
+        (linear[0, 1] == 0 and linear[1, 0] == 0) or (linear[0, 0] == 0 and linear[1, 1] == 0)
+    )
+
+
+def orient(img, matrix):
+    """Flips and transposes `img`, resized from the source box of the axis aligned `matrix`, to the output orientation."""
+    if matrix[0, 0] == 0:
+        # Output x follows source y and output y source x
+        if matrix[0, 1] < 0:
+            img = img.transpose(Image.FLIP_LEFT_RIGHT)
+        if matrix[1, 0] < 0:
+            img = img.transpose(Image.FLIP_TOP_BOTTOM)
+        return img.transpose(Image.TRANSPOSE)
+    if matrix[0, 0] < 0:
+        img = img.transpose(Image.FLIP_LEFT_RIGHT)
+    if matrix[1, 1] < 0:
+        img = img.transpose(Image.FLIP_TOP_BOTTOM)
+    return img
+
+
+def warp_image(img, operations):
+    """Applies the geometric `operations` to `img` with a single resampling.
+    Lazily opened JPEG files are decoded at the smallest DCT scale the sampled crop and resize allow.
+    # Returns
+        Tuple of the warped image and its number of pixels per source pixel (along each axis).
+    """
+    original_size = img.size
+    matrix, size, crop_fraction = plan_warp(operations, original_size)
+
+    source_scale = warp_scale(matrix, size)
+    output_scale = 1. / source_scale
+    if getattr(img, 'tile', None):
+        # Not decoded yet, keep at least one source pixel per output pixel for the antialiased
+        # resize of axis aligned warps and MAX_WARP_SCALE for the others
+        reduction = max(1., source_scale if is_axis_aligned(matrix) else source_scale / MAX_WARP_SCALE)
+        img.draft(img.mode, (int(original_size[0] / reduction), int(original_size[1] / reduction)))
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    # Source coordinates of the (drafted) image
+    matrix = scale(img.width / float(original_size[0]), img.height / float(original_size[1])).dot(matrix)
+    if is_axis_aligned(matrix):
+        # Only crops, resizes, flips and 90 degree rotations: one antialiased resize of the source box
+        swapped = matrix[0, 0] == 0
+        box = source_box(matrix, size)
+        img = img.resize(size[::-1] if swapped else size, Image.BICUBIC, box=box)
+        return orient(img, matrix), output_scale
+
+    source_scale = warp_scale(matrix, size)
+    if source_scale > MAX_WARP_SCALE:
+        # Only the source pixels the output is sampled from are reduced
+        box = source_box(matrix, size, img.size)
+        if box[2] > box[0] and box[3] > box[1]:
+            matrix = translate(-box[0], -box[1]).dot(matrix)
+            img = img.crop(box)
+        # Box filter reduction first, so the bicubic warp does not alias
+        factor = source_scale / MAX_WARP_SCALE
+        reduced_size = (max(1, int(round(img.width / factor))), max(1, int(round(img.height / factor))))
+        matrix = scale(reduced_size[0] / float(img.width), reduced_size[1] / float(img.height)).dot(matrix)
+        img = img.resize(reduced_size, Image.BOX)
+
+    matrix = matrix / matrix[2, 2]
+    return img.transform(size, Image.PERSPECTIVE, tuple(matrix.flatten()[:8]), resample=Image.BICUBIC), output_scale
+
+
+class FusedWarpPipeline(CustomPipeline):
+    """`CustomPipeline` resampling each image once for all its geometric operations, see `warp_image`.
+    Pipelines with other operations on the source image (e.g. pixel intensity changes, or `Distort`
+    followed by a crop) run operation by operation."""
+
+    # The warp decodes the image itself, at the scale of its sampled crop
+    profiled_steps = CustomPipeline.profiled_steps + ('FusedWarp',)
+
+    def perform_operations(self, image):
+        operations, deferred = self.plan_operations()
+        if not supports(operations):
+            return super(FusedWarpPipeline, self).perform_operations(image)
+        size = image.size
+        start = time.perf_counter()
+        image, scale = warp_image(image, operations)
+        if self.profiler is not None:
+            self.profiler.record('FusedWarp', True, time.perf_counter() - start, size, image.size)
+        return perform_deferred_operations(deferred, image, scale, self.get_distortion_pool, self.profiler)
@@ -0,0 +1,98 @@
+"""Packed uint8 image shards of sampled datasets.
+
+Instead of one JPEG file per sample, `data_sampler.py --image-format shards` writes the images of an
+image folder into `.npy` shards of fixed-shape uint8 images (n, height, width, 3) and an index csv
+file with the image id, category, shard and row of every image. Readers memory-map the shards and
+use the pixels directly, without decoding anything.
+"""
+import os
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+INDEX_FILENAME = 'index.csv'
+
+
+def shard_filename(shard):
+    return '{:05d}.npy'.format(shard)
+
+
+def is_shard_folder(folder):
+    """Whether an image folder was written as shards."""
+    return os.path.exists(os.path.join(folder, INDEX_FILENAME))
+
+
+def write_shard(folder, shard, images, size):
+    """Writes a list of PIL images, resized to `size` `(width, height)` if needed, into a shard."""
+    x = np.empty((len(images), size[1], size[0], 3), dtype=np.uint8)
+    for i, img in enumerate(images):
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if img.size != tuple(size):
+            img = img.resize(size, Image.BICUBIC)
+        x[i] = np.asarray(img)
+    np.save(os.path.join(folder, shard_filename(shard)), x)
+
+
+def write_index(folder, records):
+    """Writes the index of a shard folder from records with the keys 'image', 'shard', 'row' and optionally 'category'."""
+    pd.DataFrame.from_records(records).to_csv(os.path.join(folder, INDEX_FILENAME), index=False)
+
+
+def read_index(folder):
+    return pd.read_csv(os.path.join(folder, INDEX_FILENAME), dtype={'image': str})
+
+
+def get_dataframe_from_shard_folder(folder, has_path_col=True):
+    """Same as `get_dataframe_from_img_folder` for a shard folder, paths are `<folder>/<image>.jpg`."""
+    df = read_index(folder)[['image']].sort_values('image').reset_index(drop=True)
+    if has_path_col:
+        df['path'] = folder + os.sep + df['image'] + '.jpg'
+    return df
+
+
+class ImageShards():
+    """Images of shard folders, looked up by the image ids of file paths.
+
+    # Arguments
+        image_paths: List of image file paths `<folder>/<image id>.jpg` of shard folders,
+            e.g. the paths `load_isic_training_data` builds.
+    """
+
+    def __init__(self, image_paths):
+        self.shard_paths = []
+        self.locations = np.empty((len(image_paths), 2), dtype=np.int64) # (shard, row) of every image
+        folders = {}
+        for i, path in enumerate(image_paths):
+            folder, filename = os.path.split(path)
+            if folder not in folders:
+                folders[folder] = self._read_folder(folder)
+            self.locations[i] = folders[folder][os.path.splitext(filename)[0]]
+        self._shards = None
+
+    def _read_folder(self, folder):
+        df_index = read_index(folder)
+        # Shards of every folder are numbered after the shards of the folders read before
+        offset = len(self.shard_paths)
+        shards = sorted(df_index['shard'].unique())
+        self.shard_paths += [os.path.join(folder, shard_filename(shard)) for shard in shards]
+        shard_numbers = df_index['shard'].map({shard: offset + i for i, shard in enumerate(shards)})
+        return dict(zip(df_index['image'], zip(shard_numbers, df_index['row'])))
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __getitem__(self, index):
+        """Zero-copy uint8 view of the image at `index` with shape (height, width, channels)."""
+        if self._shards is None:
+            self._shards = [None] * len(self.shard_paths)
+        shard, row = self.locations[index]
+        if self._shards[shard] is None:
+            self._shards[shard] = np.load(self.shard_paths[shard], mmap_mode='r')
+        return self._shards[shard][row]
+
+    def __getstate__(self):
+        # Workers reopen the memory maps instead of pickling their content
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
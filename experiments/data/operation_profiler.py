@@ -0,0 +1,62 @@
+"""Per-operation counters of augmentation pipelines, shared by the data worker processes.
+
+The counters live in shared memory created with the pipeline, so the workers forked by Keras
+(which copy the pipeline) all add to the counters the trainer reads.
+"""
+import multiprocessing
+import numpy as np
+
+FIELDS = ('calls', 'fired', 'seconds', 'input_pixels', 'output_pixels')
+
+
+class OperationProfiler():
+    """Call count, fired count, cumulative wall time and input and output image sizes per operation class.
+
+    # Arguments
+        names: Names of the profiled steps, e.g. the class names of the pipeline operations.
+    """
+
+    def __init__(self, names):
+        self.names = sorted(set(names))
+        self._rows = {name: i for i, name in enumerate(self.names)}
+        self._counters = multiprocessing.Array('d', len(self.names) * len(FIELDS))
+
+    def record(self, name, fired, seconds=0., input_size=None, output_size=None):
+        """Adds a call of the step `name`, `input_size` and `output_size` are `(width, height)` of the images."""
+        offset = self._rows[name] * len(FIELDS)
+        with self._counters.get_lock():
+            self._counters[offset] += 1
+            if fired:
+                self._counters[offset + 1] += 1
+                self._counters[offset + 2] += seconds
+                self._counters[offset + 3] += input_size[0] * input_size[1]
+                self._counters[offset + 4] += output_size[0] * output_size[1]
+
+    def snapshot(self):
+        """Array of the counters, one row per name and one column per field of `FIELDS`."""
+        with self._counters.get_lock():
+            return np.array(self._counters[:]).reshape(len(self.names), len(FIELDS))
+
+    def report(self, counters=None):
+        """Summary of every step.
+        # Arguments
+            counters: Counters returned by `snapshot`, e.g. the difference of two snapshots, current counters if None.
+        # Returns
+            A list of dicts, one per step.
+        """
+        if counters is None:
+            counters = self.snapshot()
+        rows = []
+        for name, row in zip(self.names, counters):
+            calls, fired, seconds, input_pixels, output_pixels = (float(value) for value in row)
+            rows.append({
+                'operation': name,
+                'calls': int(calls),
+                'fired': int(fired),
+                'fired_rate': fired / calls if calls else 0.,
+                'seconds': seconds,
+                'ms_per_fired': 1000 * seconds / fired if fired else 0.,
+                'mean_input_megapixels': input_pixels / fired / 1e6 if fired else 0.,
+                'mean_output_megapixels': output_pixels / fired / 1e6 if fired else 0.,
+            })
+        return rows
@@ -0,0 +1,159 @@
+"""Statistical comparison of the outputs of two augmentation pipelines.
+
+Used to validate optimized pipelines, e.g. `CustomPipeline(reorder_operations=True)`, against the
+original operation order: both pipelines augment the same images with independent random draws and
+the distributions of per-image statistics are compared with two-sample Kolmogorov-Smirnov tests.
+
+`check_distortion_pool` verifies that the `Distort` operations of a pipeline run with their
+precomputed `DistortionPool`.
+
+`BatchAugmenter` draws the parameters of all the operations upfront, so its images are also compared
+one by one with the `CustomPipeline` operations replayed with the same parameters.
+"""
+import copy
+import time
+import numpy as np
+from PIL import Image, ImageEnhance
+from scipy import stats
+from Augmentor import Operations
+from data.augmentations import CropCenter, get_draft_size, get_source_operations, open_image
+from data.batch_augmentations import BatchAugmenter
+
+STATISTICS = ('mean_r', 'mean_g', 'mean_b', 'std_r', 'std_g', 'std_b', 'gradient', 'noisy_fraction')
+# Absolute gray level Laplacian above which a pixel counts as noise, e.g. of a `RandomErasing`
+# rectangle, smooth image content and edges stay well below it
+NOISE_LAPLACIAN = 40
+
+
+def image_statistics(img):
+    """Per-channel mean and standard deviation, mean absolute gradient (sharpness and noise) and
+    fraction of noisy pixels (e.g. the visible area of erased rectangles) of an image."""
+    x = np.asarray(img.convert('RGB'), dtype=np.float32)
+    gradient = (np.abs(np.diff(x, axis=0)).mean() + np.abs(np.diff(x, axis=1)).mean()) / 2
+    gray = x.mean(axis=2)
+    laplacian = 4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1] - gray[1:-1, :-2] - gray[1:-1, 2:]
+    noisy_fraction = (np.abs(laplacian) > NOISE_LAPLACIAN).mean()
+    return list(x.mean(axis=(0, 1))) + list(x.std(axis=(0, 1))) + [gradient, noisy_fraction]
+
+
+def _augment_all(pipeline, image_paths, repeats):
+    draft_size = get_draft_size(get_source_operations(pipeline))
+    values = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for path in image_paths:
+            values.append(image_statistics(pipeline.perform_operations(open_image(path, draft_size))))
+    seconds_per_image = (time.perf_counter() - start) / (repeats * len(image_paths))
+    return np.array(values), seconds_per_image
+
+
+def compare_pipelines(reference, candidate, image_paths, repeats=4, alpha=0.01):
+    """Compares the output distributions of two pipelines on the same images.
+
+    # Arguments
+        reference: Reference `CustomPipeline`.
+        candidate: `CustomPipeline` expected to produce the same distribution of images.
+        image_paths: List of image file paths.
+        repeats: Integer, number of augmentations of every image by each pipeline.
+        alpha: Significance level of the Kolmogorov-Smirnov tests.
+    # Returns
+        A dict with the mean of every statistic for both pipelines, its KS statistic and p-value,
+        the seconds per image of both pipelines and whether no test rejects the equivalence.
+    """
+    reference_values, reference_seconds = _augment_all(reference, image_paths, repeats)
+    candidate_values, candidate_seconds = _augment_all(candidate, image_paths, repeats)
+
+    report = {}
+    for i, name in enumerate(STATISTICS):
+        ks_statistic, p_value = stats.ks_2samp(reference_values[:, i], candidate_values[:, i])
+        report[name] = {
+            'reference_mean': float(reference_values[:, i].mean()),
+            'candidate_mean': float(candidate_values[:, i].mean()),
+            'ks_statistic': float(ks_statistic),
+            'p_value': float(p_value),
+        }
+    return {
+        'statistics': report,
+        'reference_seconds_per_image': reference_seconds,
+        'candidate_seconds_per_image': candidate_seconds,
+        'equivalent': all(values['p_value'] >= alpha for values in report.values()),
+    }
+
+
+def check_distortion_pool(pipeline, image_paths):
+    """Whether every `Distort` operation of a `CustomPipeline` with `distortion_pool_size` distorts the
+    images with its `DistortionPool`. A copy of the pipeline augments every image with all its operations
+    firing, so every pool must distort every image.
+    # Returns
+        Boolean, False if the pipeline has no `Distort` operation or one of them ran without its pool.
+    """
+    pipeline = copy.deepcopy(pipeline)
+    for operation in pipeline.operations:
+        operation.probability = 1
+    draft_size = get_draft_size(get_source_operations(pipeline))
+    for path in image_paths:
+        pipeline.perform_operations(open_image(path, draft_size))
+    pools = [pipeline.get_distortion_pool(operation) for operation in pipeline.operations if isinstance(operation, Operations.Distort)]
+    return len(pools) > 0 and all(pool is not None and pool.distortions == len(image_paths) for pool in pools)
+
+
+def replay_operations(augmenter, filename, params, i):
+    """Runs the operations of a `BatchAugmenter` one by one on the full resolution PIL image, as
+    `CustomPipeline.perform_operations` does, with the parameters drawn for image `i` of a batch."""
+    img = open_image(filename).convert('RGB')
+    for operation, (fires, values) in zip(augmenter.operations, params):
+        if not fires[i]:
+            continue
+        if isinstance(operation, CropCenter):
+            img = operation.perform_operation([img])[0]
+        elif isinstance(operation, Operations.Rotate):
+            img = img.rotate(90 * values[i], expand=True)
+        elif isinstance(operation, Operations.Flip):
+            axis = {'TOP_BOTTOM': 1, 'LEFT_RIGHT': 0}.get(operation.top_bottom_left_right, values[i])
+            img = img.transpose(Image.FLIP_TOP_BOTTOM if axis == 1 else Image.FLIP_LEFT_RIGHT)
+        elif isinstance(operation, Operations.CropPercentage):
+            if not operation.centre:
+                raise ValueError('Random crop positions are drawn while loading, only centred crops can be replayed.')
+            w, h = img.size
+            w_new, h_new = int(np.floor(w * values[i])), int(np.floor(h * values[i]))
+            img = img.crop(((w/2)-(w_new/2), (h/2)-(h_new/2), (w/2)+(w_new/2), (h/2)+(h_new/2)))
+        elif isinstance(operation, Operations.RandomBrightness):
+            img = ImageEnhance.Brightness(img).enhance(values[i])
+        elif isinstance(operation, Operations.RandomColor):
+            img = ImageEnhance.Color(img).enhance(values[i])
+        elif isinstance(operation, Operations.RandomContrast):
+            img = ImageEnhance.Contrast(img).enhance(values[i])
+    return img.resize(augmenter.target_size, augmenter.resample)
+
+
+def compare_batch_augmenter(pipeline, image_paths, repeats=4, fire_all=True):
+    """Mean absolute differences between the images of `BatchAugmenter` and the replayed `CustomPipeline`
+    operations with the same parameters.
+
+    # Arguments
+        pipeline: `CustomPipeline` supported by `BatchAugmenter`, with centred crops.
+        image_paths: List of image file paths.
+        repeats: Integer, number of augmentations of every image.
+        fire_all: Boolean, whether every operation fires, e.g. brightness and color before contrast.
+    # Returns
+        A dict with the mean and maximum over the images of the mean absolute difference in gray levels.
+    """
+    augmenter = BatchAugmenter(pipeline)
+    differences = []
+    for _ in range(repeats):
+        n = len(image_paths)
+        params = augmenter.sample(n)
+        if fire_all:
+            params = [(np.ones(n, dtype=bool), values) for _, values in params]
+        batch = np.empty((n, augmenter.target_size[1], augmenter.target_size[0], 3), dtype=np.uint8)
+        means = [None] * n
+        for i, path in enumerate(image_paths):
+            batch[i], means[i] = augmenter.load(path, params, i)
+        augmenter.apply(batch, params, means)
+        for i, path in enumerate(image_paths):
+            reference = np.asarray(replay_operations(augmenter, path, params, i), dtype=np.float32)
+            differences.append(np.abs(batch[i].astype(np.float32) - reference).mean())
+    return {
+        'mean_absolute_difference': float(np.mean(differences)),
+        'max_mean_absolute_difference': float(np.max(differences)),
+    }
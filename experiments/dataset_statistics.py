@@ -0,0 +1,114 @@
+"""Per-channel mean and standard deviation of image datasets.
+
+Images are processed in chunks by a process pool. Every image gives its pixel count, channel means
+and sums of squared deviations, which are merged with the pairwise update of Chan et al. instead of
+accumulating raw sums of squares. JPEG files can be decoded at reduced scale and a random subset of
+the images can be used, with bootstrap confidence intervals over the images.
+
+The statistics are written to the `metadata.json` file of a data folder, where `main.py` reads them
+for `utils.preprocess_input`, `layers.PreprocessInput` and the ODIN perturbations.
+
+    python dataset_statistics.py DATA_FOLDER --max-side 256 --sample-size 5000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import numpy as np
+from tqdm import tqdm
+from data.augmentations import open_image
+from data.data_loader import get_dataframe_from_img_folder
+
+
+def image_moments(path, max_side=None):
+    """Pixel count, per-channel mean and sum of squared deviations of an RGB image scaled to [0, 1].
+    With `max_side`, JPEG files are decoded at the smallest DCT scale keeping both sides at least `max_side`."""
+    img = open_image(path, None if max_side is None else (max_side, max_side))
+    x = np.asarray(img.convert('RGB'), dtype=np.float64).reshape(-1, 3) / 255.
+    mean = x.mean(axis=0)
+    return np.concatenate([[len(x)], mean, np.square(x - mean).sum(axis=0)])
+
+
+def _chunk_moments(args):
+    paths, max_side = args
+    return np.array([image_moments(path, max_side) for path in paths]).reshape(-1, 7)
+
+
+def merge_moments(moments):
+    """Merges rows of (count, 3 means, 3 sums of squared deviations) into the dataset mean and standard deviation."""
+    counts = moments[:, :1]
+    means = moments[:, 1:4]
+    total = counts.sum()
+    mean = (counts * means).sum(axis=0) / total
+    # Within-image deviations plus the deviations of the image means from the dataset mean
+    m2 = moments[:, 4:7].sum(axis=0) + (counts * np.square(means - mean)).sum(axis=0)
+    return mean, np.sqrt(m2 / total)
+
+
+def compute_statistics(image_paths, workers=None, chunk_size=64, max_side=None, sample_size=None, seed=0, bootstrap=1000, confidence=0.95):
+    """Per-channel RGB mean and standard deviation of the pixels of a set of images, scaled to [0, 1].
+    # Arguments
+        image_paths: List of image file paths.
+        workers: Number of processes, `os.cpu_count()` if None.
+        chunk_size: Number of images per task.
+        max_side: Optional minimum side of the reduced-scale JPEG decoding.
+        sample_size: Optional number of randomly drawn images (without replacement).
+        seed: Seed of the image sample and the bootstrap.
+        bootstrap: Number of bootstrap resamples of the images for the confidence intervals, disabled if 0.
+        confidence: Level of the confidence intervals.
+    # Returns
+        A dict with the 'mean' and 'std' lists, their 'mean_ci' and 'std_ci' as [lower, upper]
+        lists (None without bootstrap) and the number of 'images'.
+    """
+    random_state = np.random.RandomState(seed)
+    image_paths = list(image_paths)
+    if sample_size is not None and sample_size < len(image_paths):
+        image_paths = [image_paths[i] for i in sorted(random_state.choice(len(image_paths), sample_size, replace=False))]
+
+    chunks = [(image_paths[i:i + chunk_size], max_side) for i in range(0, len(image_paths), chunk_size)]
+    with multiprocessing.Pool(workers) as pool:
+        moments = np.concatenate(list(tqdm(pool.imap(_chunk_moments, chunks), total=len(chunks), desc='Image statistics')))
+
+    mean, std = merge_moments(moments)
+    statistics = {'mean': mean.tolist(), 'std': std.tolist(), 'mean_ci': None, 'std_ci': None, 'images': len(moments)}
+    if bootstrap:
+        resampled = [merge_moments(moments[random_state.randint(len(moments), size=len(moments))]) for _ in range(bootstrap)]
+        alpha = 100 * (1 - confidence) / 2
+        for key, values in zip(('mean_ci', 'std_ci'), zip(*resampled)):
+            statistics[key] = np.percentile(np.array(values), [alpha, 100 - alpha], axis=0).T.tolist()
+    return statistics
+
+
+def write_statistics(metadata_filename, statistics):
+    """Writes the statistics into the 'statistics' entry of a dataset metadata file, other entries are kept."""
+    metadata = {}
+    if os.path.exists(metadata_filename):
+        with open(metadata_filename) as f:
+            metadata = json.load(f)
+    metadata['statistics'] = statistics
+    with open(metadata_filename, 'w') as f:
+        json.dump(metadata, f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-channel mean and standard deviation of a training image folder')
+    parser.add_argument('data', metavar='DIR', help='path to data folder')
+    parser.add_argument('--image-folder', dest='image_folder', help='Image folder, the ISIC_2019_Training_Input folder of the data folder if not set (default: %(default)s)', default=None)
+    parser.add_argument('--workers', type=int, help='Number of processes (default: cpu count)', default=None)
+    parser.add_argument('--max-side', dest='max_side', type=int, help='Decode JPEG files at reduced scale keeping both sides at least this size, full resolution if not set (default: %(default)s)', default=None)
+    parser.add_argument('--sample-size', dest='sample_size', type=int, help='Number of randomly drawn images, all images if not set (default: %(default)s)', default=None)
+    parser.add_argument('--seed', type=int, help='Seed of the image sample and the bootstrap (default: %(default)s)', default=0)
+    parser.add_argument('--bootstrap', type=int, help='Number of bootstrap resamples for the confidence intervals, disabled if 0 (default: %(default)s)', default=1000)
+    args = parser.parse_args()
+
+    image_folder = args.image_folder if args.image_folder is not None else os.path.join(args.data, 'ISIC_2019_Training_Input')
+    statistics = compute_statistics(
+        get_dataframe_from_img_folder(image_folder)['path'].tolist(),
+        workers=args.workers,
+        max_side=args.max_side,
+        sample_size=args.sample_size,
+        seed=args.seed,
+        bootstrap=args.bootstrap
+    )
+    print(json.dumps(statistics, indent=4))
+    write_statistics(os.path.join(args.data, 'metadata.json'), statistics)
@@ -0,0 +1,150 @@
+"""Cache of end-of-feature-extraction checkpoints shared by training runs.
+
+Runs that only differ in the fine tuning hyperparameters (`ftlr`, `ft_epochs`) repeat the same
+feature extraction phase. Its result (model weights, optimizer state, the checkpoint files and the
+training log of the feature extraction epochs) is stored under a key made of the backbone, the
+feature extraction fields of `formated_hyperparameters` (including `patience`, which also schedules
+the feature extraction learning rate), the fold, the image files, the input pipeline options and the
+dataset statistics, and restored by later runs with the same key.
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.backend as K
+import utils
+from utils import formated_hyperparameters, get_hyperparameters_from_str
+
+# Fields of `formated_hyperparameters` the feature extraction phase depends on,
+# `patience` is the one of its learning rate schedule
+FE_HYPERPARAMETERS = ['balanced', 'samples', 'feepochs', 'felr', 'lambda', 'dropout', 'batch', 'dggroup', 'patience']
+WEIGHTS_FILENAME = 'weights.h5'
+OPTIMIZER_FILENAME = 'optimizer.pkl'
+CHECKPOINT_BESTS_FILENAME = 'checkpoint_bests.json'
+CHECKPOINTS_FOLDER = 'checkpoints'
+HISTORY_FILENAME = 'training.csv'
+
+
+def formated_fe_hyperparameters(parameters):
+    """The feature extraction fields of `formated_hyperparameters`, in the same format."""
+    hyperparameters = get_hyperparameters_from_str(formated_hyperparameters(parameters))
+    return '-'.join('{}_{}'.format(name, hyperparameters[name]) for name in FE_HYPERPARAMETERS)
+
+
+class FeatureExtractionCache():
+    """End-of-feature-extraction checkpoints stored in a folder, with hit and miss counters.
+
+    # Arguments
+        cache_folder: Folder of the cache entries.
+    """
+
+    def __init__(self, cache_folder):
+        self.cache_folder = cache_folder
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, model_name, parameters, image_paths_train, image_paths_val, k_split=0):
+        """Relative folder of the cache entry of a feature extraction phase.
+        The images of the fold (paths, modification times and sizes), the training options outside `formated_hyperparameters` (input pipeline,
+        online class balancing, stored features) and the dataset statistics normalizing the images
+        are hashed into the last part."""
+        sha1 = hashlib.sha1()
+        sha1.update(repr((
+            parameters.online_balance,
+            parameters.class_proportions,
+            parameters.epoch_samples,
+            parameters.sample_replacement,
+            parameters.unknown_train,
+            None if parameters.feature_cache_folder is None else parameters.feature_cache_views,
+            parameters.data_backend,
+            parameters.image_format,
+            parameters.uint8_batches,
+            parameters.batch_augmentation,
+            parameters.fused_warp,
+            parameters.reorder_operations,
+            parameters.distortion_pool_size,
+            np.asarray(utils.TRAINSET_MEAN).tolist(),
+            np.asarray(utils.TRAINSET_STD).tolist()
+        )).encode('utf-8'))
+        for paths in (image_paths_train, image_paths_val):
+            # Sampling a data folder again writes other images to the same paths
+            for path in paths:
+                stat = (os.path.getmtime(path), os.path.getsize(path)) if os.path.exists(path) else None
+                sha1.update('{}:{}\n'.format(path, stat).encode('utf-8'))
+            sha1.update(b'\0')
+        return os.path.join(model_name, formated_fe_hyperparameters(parameters), str(k_split), sha1.hexdigest())
+
+    def restore(self, key, model, model_path, history_path):
+        """Loads the cached weights and optimizer state into a compiled model and copies the checkpoint
+        files and the training log into the run's folders.
+        # Returns
+            On a cache hit, the best monitored values of the checkpoint files by filename, to seed the
+            checkpoint callbacks with (see `LesionClassifier._create_checkpoint_callbacks`). None on a miss.
+        """
+        entry_path = os.path.join(self.cache_folder, key)
+        if not os.path.exists(entry_path):
+            self.misses += 1
+            print('Feature extraction cache miss: {}'.format(key))
+            return None
+
+        model.load_weights(os.path.join(entry_path, WEIGHTS_FILENAME))
+        with open(os.path.join(entry_path, OPTIMIZER_FILENAME), 'rb') as f:
+            optimizer_state = pickle.load(f)
+        optimizer = model.optimizer
+        # The optimizer creates its slots on its first update, an update with zero gradients
+        # creates them without changing the weights (Adam steps are proportional to the gradients)
+        variables = model.trainable_weights
+        optimizer.apply_gradients(zip([tf.zeros_like(variable) for variable in variables], variables))
+        optimizer.set_weights(optimizer_state['weights'])
+        K.set_value(optimizer.lr, optimizer_state['learning_rate'])
+
+        checkpoints_path = os.path.join(entry_path, CHECKPOINTS_FOLDER)
+        os.makedirs(model_path, exist_ok=True)
+        for filename in os.listdir(checkpoints_path):
+            shutil.copy(os.path.join(checkpoints_path, filename), os.path.join(model_path, filename))
+        history_filename = os.path.join(entry_path, HISTORY_FILENAME)
+        if os.path.exists(history_filename):
+            os.makedirs(history_path, exist_ok=True)
+            shutil.copy(history_filename, os.path.join(history_path, HISTORY_FILENAME))
+
+        with open(os.path.join(entry_path, CHECKPOINT_BESTS_FILENAME)) as f:
+            checkpoint_bests = json.load(f)
+
+        self.hits += 1
+        print('Feature extraction cache hit: {}'.format(key))
+        return checkpoint_bests
+
+    def store(self, key, model, optimizer, model_path, history_path, checkpoint_bests):
+        """Stores the model weights, the optimizer state, the checkpoint files with their best monitored
+        values and the training log at the end of the feature extraction phase."""
+        entry_path = os.path.join(self.cache_folder, key)
+        if os.path.exists(entry_path):
+            return
+        # Write to a temporary folder first so concurrent runs never restore a partial entry
+        tmp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+        os.makedirs(tmp_path)
+
+        model.save_weights(os.path.join(tmp_path, WEIGHTS_FILENAME))
+        with open(os.path.join(tmp_path, OPTIMIZER_FILENAME), 'wb') as f:
+            pickle.dump({'weights': optimizer.get_weights(), 'learning_rate': float(K.get_value(optimizer.lr))}, f)
+        shutil.copytree(model_path, os.path.join(tmp_path, CHECKPOINTS_FOLDER))
+        with open(os.path.join(tmp_path, CHECKPOINT_BESTS_FILENAME), 'w') as f:
+            json.dump(checkpoint_bests, f, indent=4)
+        history_filename = os.path.join(history_path, HISTORY_FILENAME)
+        if os.path.exists(history_filename):
+            shutil.copy(history_filename, os.path.join(tmp_path, HISTORY_FILENAME))
+
+        try:
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Another run stored the same entry meanwhile
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def report(self):
+        """Prints the number of cache hits and misses."""
+        total = self.hits + self.misses
+        print('Feature extraction cache: {} hits, {} misses ({:.0%} hit rate)'.format(
+            self.hits, self.misses, self.hits / total if total > 0 else 0.))
@@ -0,0 +1,144 @@
+"""Memory-mapped store of frozen backbone features for the feature extraction phase.
+
+While the base model is frozen, its pooled output only depends on the input image. The features
+of every image (one or more augmented views of the training images, one view of the validation
+images) are computed once and stored in `.npy` files, then the head (fully connected layers and
+`dense_pred`) is trained on the stored features without running the backbone again.
+"""
+import hashlib
+import os
+import random
+import numpy as np
+from tensorflow.keras.callbacks import Callback
+from tensorflow.keras.utils import Sequence
+from data.augmentations import get_pipeline_signature
+
+
+def feature_cache_key(model_name, image_paths, augmentation_pipeline, input_size, views, normalization=None):
+    """Hash of the backbone, the images (paths and modification times), the pipeline, the input size,
+    the number of views and the normalization (e.g. the dataset mean and standard deviation)."""
+    sha1 = hashlib.sha1()
+    sha1.update('{}|{}|{}|{}\n'.format(model_name, tuple(input_size), views, normalization).encode('utf-8'))
+    if augmentation_pipeline is not None:
+        sha1.update(get_pipeline_signature(augmentation_pipeline).encode('utf-8'))
+    for path in image_paths:
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        sha1.update('{}:{}\n'.format(path, mtime).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def cache_features(feature_model, create_generator, views, filepath, workers=1, use_multiprocessing=False):
+    """Computes the features of `views` passes over a generator into a `.npy` file, unless it exists.
+    # Arguments
+        feature_model: Keras model of the frozen backbone and its pooling layer.
+        create_generator: Function returning a new, unshuffled `ImageIterator` without labels.
+        views: Integer, number of passes, e.g. augmented views of the training images.
+        filepath: Path of the `.npy` file.
+    # Returns
+        Read-only memory-mapped array of shape `(views, num_images, num_features)`.
+    """
+    if not os.path.exists(filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # Write to a temporary file first so concurrent runs never read a partial store
+        tmp_filepath = '{}.{}.tmp.npy'.format(filepath[:-len('.npy')], os.getpid())
+        features = None
+        # The augmentation operations draw from the global generators, their states are restored
+        # afterwards so the rest of the run does not start from the seeds of the views
+        random_state = random.getstate()
+        np_random_state = np.random.get_state()
+        try:
+            for view in range(views):
+                # Every view draws its own augmentations, the same ones in every run
+                random.seed(view)
+                np.random.seed(view)
+                x = feature_model.predict(create_generator(), verbose=1, workers=workers, use_multiprocessing=use_multiprocessing)
+                if features is None:
+                    features = np.lib.format.open_memmap(tmp_filepath, mode='w+', dtype=np.float32, shape=(views,) + x.shape)
+                features[view] = x
+        finally:
+            random.setstate(random_state)
+            np.random.set_state(np_random_state)
+        features.flush()
+        del features
+        os.replace(tmp_filepath, filepath)
+    return np.load(filepath, mmap_mode='r')
+
+
+class CachedFeatureSequence(Sequence):
+    """Batches of stored features and labels, every image uses a random one of its stored views per epoch.
+
+    # Arguments
+        features: Array of shape `(views, num_images, num_features)`.
+        labels: Array of labels of the images.
+        batch_size: Integer, size of a batch.
+        index_sampler: Optional `WeightedIndexSampler` drawing the images of every epoch.
+        shuffle: Boolean, whether to shuffle the images and draw their views, otherwise the images
+            are taken in order with their first view (e.g. for validation).
+    """
+
+    def __init__(self, features, labels, batch_size, index_sampler=None, shuffle=True):
+        self.features = features
+        self.labels = np.asarray(labels)
+        self.batch_size = batch_size
+        self.index_sampler = index_sampler
+        self.shuffle = shuffle
+        self._set_index_array()
+
+    def _set_index_array(self):
+        if self.index_sampler is not None:
+            self.index_array = self.index_sampler.sample()
+        elif self.shuffle:
+            self.index_array = np.random.permutation(self.features.shape[1])
+        else:
+            self.index_array = np.arange(self.features.shape[1])
+        if self.shuffle:
+            self.view_array = np.random.randint(self.features.shape[0], size=len(self.index_array))
+        else:
+            self.view_array = np.zeros(len(self.index_array), dtype=np.int64)
+
+    def __len__(self):
+        return (len(self.index_array) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        batch = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
+        index_array = self.index_array[batch]
+        return np.asarray(self.features[self.view_array[batch], index_array]), self.labels[index_array]
+
+    def on_epoch_end(self):
+        self._set_index_array()
+
+
+class ModelCallbackProxy(Callback):
+    """Runs epoch callbacks with another model than the fitted one, e.g. checkpoints of the
+    whole model while only its head is fitted on stored features."""
+
+    def __init__(self, callbacks, model):
+        super(ModelCallbackProxy, self).__init__()
+        self.callbacks = callbacks
+        self.target_model = model
+
+    def set_model(self, model):
+        super(ModelCallbackProxy, self).set_model(model)
+        for callback in self.callbacks:
+            callback.set_model(self.target_model)
+
+    def set_params(self, params):
+        super(ModelCallbackProxy, self).set_params(params)
+        for callback in self.callbacks:
+            callback.set_params(params)
+
+    def on_train_begin(self, logs=None):
+        for callback in self.callbacks:
+            callback.on_train_begin(logs)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        for callback in self.callbacks:
+            callback.on_epoch_begin(epoch, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        for callback in self.callbacks:
+            callback.on_epoch_end(epoch, logs)
+
+    def on_train_end(self, logs=None):
+        for callback in self.callbacks:
+            callback.on_train_end(logs)
@@ -0,0 +1,138 @@
+"""Persistent cache of decoded images for deterministic augmentation pipelines.
+
+Every image is decoded and transformed once and stored as a row of a memory-mapped uint8
+file of shape (rows, height, width, channels). Later epochs and runs read the pixels straight
+from the page cache without decoding the JPEG files again.
+"""
+import fcntl
+import hashlib
+import os
+import pickle
+import numpy as np
+import PIL
+from tqdm import tqdm
+from data.augmentations import get_draft_size, get_pipeline_signature, open_image
+
+# Changes whenever the decoding of the cached images changes (e.g. reduced-scale JPEG decoding),
+# together with the Pillow version, whose resampling filters differ between releases
+DECODE_VERSION = 'draft-1'
+IMAGES_FILENAME = 'images.bin'
+INDEX_FILENAME = 'index.pkl'
+LOCK_FILENAME = 'lock'
+
+
+class DecodedImageCache():
+    """On-disk cache of images transformed by a deterministic augmentation pipeline.
+
+    The images transformed by the same pipeline operations (center crop, resize) to the same target
+    size and decoded the same way (see `DECODE_VERSION`) share a folder. Its entries are keyed per
+    image by path, modification time and file size, so adding or changing images only decodes those
+    images. The rows of replaced images are not reclaimed, delete the folder to compact it.
+
+    # Arguments
+        cache_folder: String, folder where the cache files are stored.
+        image_paths: List of image file paths.
+        target_size: Tuple `(width, height)` produced by the pipeline.
+        augmentation_pipeline: Deterministic pipeline (e.g. augmentation group 0) applied to every image.
+    """
+
+    def __init__(self, cache_folder, image_paths, target_size, augmentation_pipeline=None):
+        self.cache_folder = cache_folder
+        self.image_paths = image_paths
+        self.target_size = tuple(target_size)
+        self.augmentation_pipeline = augmentation_pipeline
+        self.draft_size = get_draft_size(augmentation_pipeline.operations) if augmentation_pipeline else None
+        self.folder = os.path.join(cache_folder, self._cache_key())
+        self.image_shape = (self.target_size[1], self.target_size[0], 3)
+        self._images = None
+
+        keys = [self._image_key(path) for path in image_paths]
+        index = self._read_index()
+        if any(key not in index for key in keys):
+            index = self._build(keys)
+        self.rows = np.array([index[key] for key in keys], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        """Zero-copy uint8 view of the cached image at `index` with shape (height, width, channels)."""
+        return self.images[self.rows[index]]
+
+    def __getstate__(self):
+        # Workers reopen the memory map instead of pickling its content
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    @property
+    def images(self):
+        if self._images is None:
+            filepath = os.path.join(self.folder, IMAGES_FILENAME)
+            num_rows = os.path.getsize(filepath) // int(np.prod(self.image_shape))
+            self._images = np.memmap(filepath, dtype=np.uint8, mode='r', shape=(num_rows,) + self.image_shape)
+        return self._images
+
+    def _cache_key(self):
+        """Hash of the target size, the pipeline operations and the decoding of the images."""
+        sha1 = hashlib.sha1()
+        sha1.update('{}|{}|{}|{}'.format(self.target_size, self.draft_size, DECODE_VERSION, PIL.__version__).encode('utf-8'))
+        if self.augmentation_pipeline is not None:
+            sha1.update(get_pipeline_signature(self.augmentation_pipeline).encode('utf-8'))
+        return sha1.hexdigest()
+
+    @staticmethod
+    def _image_key(path):
+        stat = os.stat(path)
+        return '{}:{}:{}'.format(path, stat.st_mtime, stat.st_size)
+
+    def _read_index(self):
+        """Row of every cached image by image key."""
+        filepath = os.path.join(self.folder, INDEX_FILENAME)
+        if not os.path.exists(filepath):
+            return {}
+        with open(filepath, 'rb') as f:
+            return pickle.load(f)
+
+    def _build(self, keys):
+        """Appends the images missing from the cache and returns the updated index."""
+        os.makedirs(self.folder, exist_ok=True)
+        # Concurrent runs append one after the other
+        with open(os.path.join(self.folder, LOCK_FILENAME), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self._read_index()
+            missing = {}
+            for path, key in zip(self.image_paths, keys):
+                if key not in index:
+                    missing.setdefault(key, path)
+
+            row_bytes = int(np.prod(self.image_shape))
+            with open(os.path.join(self.folder, IMAGES_FILENAME), 'ab') as f:
+                # Rows partially written by an interrupted run are overwritten
+                row = f.seek(0, os.SEEK_END) // row_bytes
+                f.truncate(row * row_bytes)
+                for key, path in tqdm(missing.items(), desc='Caching decoded images'):
+                    f.write(self._decode(path).tobytes())
+                    index[key] = row
+                    row += 1
+
+            # Readers only see the new index once the rows are written
+            tmp_filepath = os.path.join(self.folder, '{}.{}.tmp'.format(INDEX_FILENAME, os.getpid()))
+            with open(tmp_filepath, 'wb') as f:
+                pickle.dump(index, f)
+            os.replace(tmp_filepath, os.path.join(self.folder, INDEX_FILENAME))
+        self._images = None
+        return index
+
+    def _decode(self, path):
+        img = open_image(path, self.draft_size)
+        if self.augmentation_pipeline:
+            img = self.augmentation_pipeline.perform_operations(img)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if img.size != self.target_size:
+            raise ValueError(
+                'Image {} has size {} after augmentation but the cache expects {}'
+                .format(path, img.size, self.target_size)
+            )
+        return np.asarray(img, dtype=np.uint8)
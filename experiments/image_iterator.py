@@ -13,11 +13,37 @@ import numpy as np
 import os
 import warnings
 import io
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow.keras.backend as K
 from PIL import Image
-from tensorflow.keras.preprocessing.image import Iterator, img_to_array
-from Augmentor import Pipeline
+from tensorflow.keras.preprocessing.image import Iterator
+from Augmentor import Pipeline, Operations
 from tqdm import trange
+from augmented_image_store import AugmentedImageStore
+from image_cache import DecodedImageCache
+from shared_batch_ring import SharedBatchRing
+from data.augmentations import get_draft_size, get_source_operations, open_image
+from data.batch_augmentations import BatchAugmenter, supports as supports_batch_augmentation
+from data.geometric_warp import FusedWarpPipeline, supports as supports_fused_warp
+from data.image_shards import ImageShards
+
+# Decoding thread pools by number of threads, shared by the iterators of a process
+_thread_pools = {}
+_thread_pools_pid = None
+
+
+def _get_thread_pool(threads):
+    """Thread pool of `threads` threads shared by the iterators of this process. Iterators are created
+    for every prediction, so they would leak their threads if every iterator had its own pool."""
+    global _thread_pools_pid
+    # Threads do not survive a fork, so every worker process creates its own pools
+    if _thread_pools_pid != os.getpid():
+        _thread_pools.clear()
+        _thread_pools_pid = os.getpid()
+    if threads not in _thread_pools:
+        _thread_pools[threads] = ThreadPoolExecutor(max_workers=threads)
+    return _thread_pools[threads]
+
 
 class ImageIterator(Iterator):
     """Iterator yielding data from image file paths. This is an infinite generator.
@@ -39,13 +65,31 @@ class ImageIterator(Iterator):
                  save_prefix='',
                  save_format='png',
                  subset=None,
-                 dtype='float32'):
+                 dtype='float32',
+                 target_size=None,
+                 cache_folder=None,
+                 decode_threads=0,
+                 pregen_max_bytes=None,
+                 pregen_spill_folder=None,
+                 shared_memory_slots=0,
+                 batch_augmentation=False,
+                 image_format='jpeg',
+                 index_sampler=None):
 
         self.image_paths = image_paths
         self.rescale = rescale
         self.pregen_augmented_images = pregen_augmented_images
+        self.pregen_max_bytes = pregen_max_bytes
+        self.pregen_spill_folder = pregen_spill_folder
         self.preprocessing_function = preprocessing_function
         self.dtype = dtype
+        self.target_size = target_size
+        self.decode_threads = decode_threads
+
+        # Images of shard folders are read from memory-mapped uint8 shards instead of being decoded
+        self.image_shards = ImageShards(image_paths) if image_format == 'shards' else None
+        if self.image_shards is not None:
+            cache_folder = None
 
         if labels is not None and len(image_paths) != len(labels):
             raise ValueError('`image_paths` and `labels` '
@@ -70,6 +114,19 @@ class ImageIterator(Iterator):
             self.sample_weight = None
 
         self.augmentation_pipeline = augmentation_pipeline
+        # Decode JPEG files at reduced scale whenever the pipeline resizes them anyway
+        self.draft_size = get_draft_size(get_source_operations(augmentation_pipeline)) if augmentation_pipeline else None
+        if isinstance(augmentation_pipeline, FusedWarpPipeline) and supports_fused_warp(get_source_operations(augmentation_pipeline)):
+            # The fused warp picks the decoding scale of every image from its own sampled crop
+            self.draft_size = None
+        # Augment whole uint8 batches instead of running the pipeline image by image
+        self.batch_augmenter = None
+        if batch_augmentation and not pregen_augmented_images and cache_folder is None:
+            if supports_batch_augmentation(augmentation_pipeline):
+                self.batch_augmenter = BatchAugmenter(augmentation_pipeline)
+            else:
+                warnings.warn('The augmentation pipeline is not supported by the batch augmentation engine, '
+                              'images are augmented one by one.')
         if data_format is None:
             self.data_format = K.image_data_format()
         else:
@@ -80,44 +137,61 @@ class ImageIterator(Iterator):
         self.save_prefix = save_prefix
         self.save_format = save_format
 
-        if self.pregen_augmented_images:
+        # Deterministic pipelines can be served from a persistent decoded image cache
+        self.image_cache = None
+        if cache_folder is not None:
+            if target_size is None:
+                raise ValueError('`target_size` is required to cache decoded images.')
+            self.image_cache = DecodedImageCache(cache_folder, image_paths, target_size, augmentation_pipeline)
+
+        if self.pregen_augmented_images and self.image_cache is None:
             self.augmented_images = self._generate_augmented_images()
 
-        super(ImageIterator, self).__init__(len(image_paths), batch_size, shuffle, seed)
+        # Batches are assembled in preallocated arrays, see `_get_batch_buffer`
+        self._owner_pid = os.getpid()
+        self._batch_buffer = None
 
-    def _get_batches_of_transformed_samples(self, index_array):
-        batch_x = [None] * len(index_array)
+        # Worker processes write their batches into shared memory instead of pickling them
+        self.shared_batches = None
+        if shared_memory_slots:
+            image_shape = self._get_image_shape()
+            if image_shape is None:
+                raise ValueError('Shared memory batches require a `target_size` the augmentation pipeline resizes to.')
+            self.shared_batches = SharedBatchRing(shared_memory_slots, (batch_size,) + image_shape, dtype)
 
-        if self.pregen_augmented_images:
-            # Use augmented images directly
-            for i, j in enumerate(index_array):
-                batch_x[i] = self.augmented_images[j]
+        # Epochs draw their indices from the sampling policy instead of going over every image once
+        self.index_sampler = index_sampler
+        n = len(image_paths) if index_sampler is None else index_sampler.epoch_length
+
+        super(ImageIterator, self).__init__(n, batch_size, shuffle, seed)
+
+    def _set_index_array(self):
+        if self.index_sampler is None:
+            super(ImageIterator, self)._set_index_array()
         else:
-            for i, j in enumerate(index_array):
-                x = Image.open(self.image_paths[j]) # PIL Image
-                if self.augmentation_pipeline:
-                    x = self.augmentation_pipeline.perform_operations(x)
-                batch_x[i] = x
+            self.index_array = self.index_sampler.sample()
 
-        if self.save_to_dir:
-            for i, j in enumerate(index_array):
-                img = batch_x[i]
-                fname = '{prefix}_{index}_{hash}.{format}'.format(
-                    prefix=self.save_prefix,
-                    index=j,
-                    hash=np.random.randint(1e4),
-                    format=self.save_format)
-                img.save(os.path.join(self.save_to_dir, fname))
-
-        # Converts each PIL Image instance to a Numpy array.
-        for i in range(len(batch_x)):
-            img = batch_x[i]
-            img = img_to_array(img, data_format=self.data_format, dtype=self.dtype)
-            img = self._standardize(img)
-            batch_x[i] = np.expand_dims(img, axis=0)
-
-        # All images dimensions in the batch match exactly
-        output = (np.vstack(batch_x),)
+    def reset(self):
+        super(ImageIterator, self).reset()
+        self._reclaim_shared_batches()
+
+    def on_epoch_end(self):
+        super(ImageIterator, self).on_epoch_end()
+        # Keras calls it once every batch of the epoch was received
+        self._reclaim_shared_batches()
+
+    def _reclaim_shared_batches(self):
+        if self.shared_batches is not None:
+            self.shared_batches.reclaim()
+
+    def _get_batches_of_transformed_samples(self, index_array):
+        batch = self._fill_batch(index_array)
+        batch_x = self._standardize(batch)
+        if batch_x is not batch and getattr(batch, 'slot', None) is not None:
+            # The preprocessing function did not work in place, so the shared slot is not returned
+            self.shared_batches.release(batch.slot)
+
+        output = (batch_x,)
         if self.labels is None:
             return output[0]
         output += (self.labels[index_array],)
@@ -125,6 +199,158 @@ class ImageIterator(Iterator):
             output += (self.sample_weight[index_array],)
         return output
 
+    def _fill_batch(self, index_array, out=None):
+        """Writes the (augmented) images of `index_array` straight into a single batch array.
+        # Arguments
+            index_array: Indices of the images in the batch.
+            out: Optional array of shape `(len(index_array),) + image_shape` to write the images into.
+        # Returns
+            The batch array, not normalized yet.
+        """
+        if self.batch_augmenter is not None:
+            return self._fill_augmented_batch(index_array, out)
+
+        start = 0
+        if out is None:
+            image_shape = self._get_image_shape()
+            if image_shape is None:
+                # All images dimensions in the batch match exactly, so the first image gives the shape
+                x = self._load_array(index_array[0])
+                image_shape = x.shape
+                out = self._get_batch_buffer(len(index_array), image_shape)
+                out[0] = x
+                start = 1
+            else:
+                out = self._get_batch_buffer(len(index_array), image_shape)
+
+        def fill(i):
+            out[i] = self._load_array(index_array[i])
+
+        if self.decode_threads:
+            # PIL releases the GIL while decoding and resampling, so the images of a batch are processed concurrently
+            list(_get_thread_pool(self.decode_threads).map(fill, range(start, len(index_array))))
+        else:
+            for i in range(start, len(index_array)):
+                fill(i)
+
+        return out
+
+    def _fill_augmented_batch(self, index_array, out=None):
+        """`_fill_batch` with the batch augmentation engine: every image is cropped and resized once,
+        the other operations run on the whole uint8 batch."""
+        n = len(index_array)
+        width, height = self.batch_augmenter.target_size
+        params = self.batch_augmenter.sample(n)
+
+        if out is None and self.data_format == 'channels_last' and np.dtype(self.dtype) == np.uint8:
+            # uint8 batches are augmented directly in the batch buffer
+            images = out = self._get_batch_buffer(n, (height, width, 3))
+        else:
+            images = np.empty((n, height, width, 3), dtype=np.uint8)
+        means = [None] * n
+
+        def load(i):
+            j = index_array[i]
+            source = self.image_paths[j] if self.image_shards is None else self._open_image(j)
+            images[i], means[i] = self.batch_augmenter.load(source, params, i)
+
+        if self.decode_threads:
+            list(_get_thread_pool(self.decode_threads).map(load, range(n)))
+        else:
+            for i in range(n):
+                load(i)
+
+        self.batch_augmenter.apply(images, params, means)
+        if self.save_to_dir:
+            for i, j in enumerate(index_array):
+                self._save_image(images[i], j)
+
+        if images is out:
+            return out
+        if self.data_format == 'channels_first':
+            images = images.transpose(0, 3, 1, 2)
+        if out is None:
+            out = self._get_batch_buffer(n, images.shape[1:])
+        out[...] = images
+        return out
+
+    def _get_image_shape(self):
+        """Shape of the images in the iterator's data format if the pipeline output size is known."""
+        if self.target_size is None or self.image_cache is None and not self._resizes():
+            return None
+        if self.data_format == 'channels_first':
+            return (3, self.target_size[1], self.target_size[0])
+        return (self.target_size[1], self.target_size[0], 3)
+
+    def _resizes(self):
+        return self.augmentation_pipeline is not None and any(
+            isinstance(operation, Operations.Resize) and operation.probability >= 1
+            for operation in self.augmentation_pipeline.operations
+        )
+
+    def _load_array(self, j):
+        img = self._load_image(j)
+        if self.save_to_dir:
+            self._save_image(img, j)
+        return self._image_to_array(img)
+
+    def _load_image(self, j):
+        """Returns the augmented image `j` as a PIL Image or a uint8 array."""
+        if self.image_cache is not None:
+            # Use the decoded images of the memory-mapped cache directly
+            return self.image_cache[j]
+        if self.pregen_augmented_images:
+            # Use augmented images directly, evicted images are generated again
+            return self.augmented_images[j]
+
+        if self.image_shards is not None and not self.augmentation_pipeline:
+            return self.image_shards[j]
+
+        x = self._open_image(j) # PIL Image
+        if self.augmentation_pipeline:
+            x = self.augmentation_pipeline.perform_operations(x)
+        return x
+
+    def _open_image(self, j):
+        if self.image_shards is not None:
+            return Image.fromarray(self.image_shards[j])
+        return open_image(self.image_paths[j], self.draft_size)
+
+    def _image_to_array(self, img):
+        """Zero-copy (for arrays) uint8 view of an image in the iterator's data format."""
+        x = np.asarray(img)
+        if x.ndim == 2:
+            x = x[..., np.newaxis]
+        if self.data_format == 'channels_first':
+            x = x.transpose(2, 0, 1)
+        return x
+
+    def _get_batch_buffer(self, n, image_shape):
+        shape = (n,) + tuple(image_shape)
+        if os.getpid() == self._owner_pid:
+            # Keras' thread enqueuer may still hold previous batches, so each batch gets its own array
+            return np.empty(shape, dtype=self.dtype)
+
+        if self.shared_batches is not None:
+            batch = self.shared_batches.acquire(n)
+            if batch is not None:
+                return batch
+
+        # Batches of worker processes are pickled back to the trainer, so their buffer can be reused
+        if self._batch_buffer is None or self._batch_buffer.shape[1:] != shape[1:] or len(self._batch_buffer) < n:
+            self._batch_buffer = np.empty((max(n, self.batch_size),) + shape[1:], dtype=self.dtype)
+        return self._batch_buffer[:n]
+
+    def _save_image(self, img, j):
+        if isinstance(img, np.ndarray):
+            img = Image.fromarray(img)
+        fname = '{prefix}_{index}_{hash}.{format}'.format(
+            prefix=self.save_prefix,
+            index=j,
+            hash=np.random.randint(1e4),
+            format=self.save_format)
+        img.save(os.path.join(self.save_to_dir, fname))
+
     def _standardize(self, x):
         """Applies the normalization configuration in-place to a batch of inputs.
         `x` is changed in-place since the function is mainly used internally
@@ -146,15 +372,32 @@ class ImageIterator(Iterator):
 
         return x
 
+    def _generate_augmented_image(self, i):
+        img = self._open_image(i)
+        img2 = img.copy()
+        img.close()
+        if self.augmentation_pipeline:
+            img2 = self.augmentation_pipeline.perform_operations(img2)
+        return img2
+
     def _generate_augmented_images(self):
-        augmented_images = []
-
-        for i in trange(len(self.image_paths), desc='Pre-generate augmented images'):
-            img = Image.open(self.image_paths[i])
-            img2 = img.copy()
-            img.close()
-            if self.augmentation_pipeline:
-                img2 = self.augmentation_pipeline.perform_operations(img2)
-            augmented_images.append(img2)
-        
-        return augmented_images
+        """Generates the augmented images into an `AugmentedImageStore`, up to its byte budget."""
+        # All augmented images have the same shape, given by the first one
+        first = np.asarray(self._generate_augmented_image(0))
+        store = AugmentedImageStore(
+            len(self.image_paths),
+            first.shape,
+            self._generate_augmented_image,
+            max_bytes=self.pregen_max_bytes,
+            spill_folder=self.pregen_spill_folder
+        )
+        store.put(0, first)
+
+        indices = trange(1, store.capacity, desc='Pre-generate augmented images')
+        if self.decode_threads:
+            images = _get_thread_pool(self.decode_threads).map(self._generate_augmented_image, indices)
+        else:
+            images = (self._generate_augmented_image(i) for i in indices)
+        for i, img in enumerate(images, start=1):
+            store.put(i, img)
+        return store
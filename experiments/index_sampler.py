@@ -0,0 +1,66 @@
+"""Sampling policies over dataset indices for online class balancing.
+
+Instead of materializing oversampled, augmented copies of the minority classes on disk
+(`data_sampler.py --class-balance`), every epoch draws the indices of the original images
+with per-class target proportions and the online augmentation pipeline makes the copies differ.
+"""
+import numpy as np
+
+
+class WeightedIndexSampler():
+    """Draws the indices of an epoch with per-class target proportions.
+
+    # Arguments
+        labels: Integer class labels or one-hot labels of the dataset.
+        class_proportions: Target proportion of every class (normalized), equal proportions if None.
+        replacement: Whether indices are drawn with replacement. Without replacement, the images of
+            a class are only repeated after all of them were drawn (in a new random order).
+        epoch_length: Number of indices per epoch, the dataset size if None.
+    """
+
+    def __init__(self, labels, class_proportions=None, replacement=True, epoch_length=None):
+        labels = np.asarray(labels)
+        if labels.ndim > 1:
+            labels = np.argmax(labels, axis=1)
+        num_classes = int(labels.max()) + 1
+        if class_proportions is None:
+            class_proportions = np.ones(num_classes)
+        class_proportions = np.asarray(class_proportions, dtype=np.float64)
+        if len(class_proportions) != num_classes:
+            raise ValueError('`class_proportions` should have one value per class. '
+                             'Found: %s values for %s classes' % (len(class_proportions), num_classes))
+
+        self.class_indices = [np.flatnonzero(labels == c) for c in range(num_classes)]
+        # Classes without images cannot be drawn
+        class_proportions[[len(indices) == 0 for indices in self.class_indices]] = 0
+        self.class_proportions = class_proportions / class_proportions.sum()
+        self.replacement = replacement
+        self.epoch_length = len(labels) if epoch_length is None else epoch_length
+        self.class_counts = self._allocate(self.epoch_length)
+
+    def _allocate(self, n):
+        """Number of indices of every class, the largest remainders get the rounding leftovers."""
+        expected = self.class_proportions * n
+        counts = np.floor(expected).astype(np.int64)
+        leftovers = np.argsort(counts - expected)[:n - counts.sum()]
+        counts[leftovers] += 1
+        return counts
+
+    def sample(self, random_state=np.random):
+        """Shuffled indices of an epoch.
+        # Arguments
+            random_state: `np.random` or a `np.random.RandomState`.
+        # Returns
+            Integer array of `epoch_length` dataset indices.
+        """
+        epoch = []
+        for indices, count in zip(self.class_indices, self.class_counts):
+            if count == 0:
+                continue
+            if self.replacement:
+                epoch.append(random_state.choice(indices, count, replace=True))
+            else:
+                # Whole permutations of the class, then a part of another one
+                repeats = -(-count // len(indices))
+                epoch.append(np.concatenate([random_state.permutation(indices) for _ in range(repeats)])[:count])
+        return random_state.permutation(np.concatenate(epoch))
@@ -0,0 +1,527 @@
+"""Benchmarks of the image input pipeline.
+
+Example:
+    python3 input_pipeline_benchmark.py batch-assembly --batch-sizes 16 32 64 --image-size 224
+    python3 input_pipeline_benchmark.py decode-modes --images ./data/isic2019/sampled/ISIC_2019_Training_Input
+    python3 input_pipeline_benchmark.py throughput --groups 0 1 2 3 4 --workers 0 8 --backends iterator tfdata --output baseline.json
+    python3 input_pipeline_benchmark.py reordering --groups 2 4 --image-count 64 --repeats 16
+    python3 input_pipeline_benchmark.py batch-augmentation --groups 0 1 2 --repeats 4
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from PIL import Image
+from tensorflow.keras.preprocessing.image import img_to_array
+from tensorflow.keras.utils import OrderedEnqueuer
+from base_model_param import get_transfer_model_param_map
+from data.augmentations import CustomPipeline, get_augmentation_group
+from data.geometric_warp import FusedWarpPipeline
+from data.pipeline_validation import check_distortion_pool, compare_batch_augmenter, compare_pipelines
+from image_iterator import ImageIterator
+from tf_data_pipeline import create_dataset
+from utils import preprocess_input
+
+
+def create_synthetic_images(folder, count, size=(1024, 768), seed=0):
+    """Writes `count` random JPEG images of `size` to `folder` and returns their paths."""
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(count):
+        # Smooth random images compress like dermoscopic pictures rather than pure noise
+        small = rng.randint(0, 256, size=(size[1] // 32, size[0] // 32, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize(size, Image.BICUBIC)
+        path = os.path.join(folder, 'SYNTHETIC_{:07d}.jpg'.format(i))
+        img.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def create_pipeline(data_aug_group, input_size, fused_warp=False, reorder_operations=False, distortion_pool_size=0):
+    """Same pipeline as `LesionClassifier.create_aug_pipeline` without creating a TensorFlow session."""
+    pipeline_class = FusedWarpPipeline if fused_warp else CustomPipeline
+    pipeline = pipeline_class(reorder_operations=reorder_operations, distortion_pool_size=distortion_pool_size)
+    for aug in get_augmentation_group(data_aug_group, input_size, center=True, resize=True):
+        pipeline.add_operation(aug)
+    return pipeline
+
+
+def legacy_batch_assembly(images, preprocessing_function, data_format='channels_last', dtype='float32'):
+    """Batch assembly of ImageIterator before the preallocated buffers, kept as the benchmark reference."""
+    batch_x = [None] * len(images)
+    for i, img in enumerate(images):
+        x = img_to_array(img, data_format=data_format, dtype=dtype)
+        x = preprocessing_function(x, data_format=data_format)
+        batch_x[i] = np.expand_dims(x, axis=0)
+    return np.vstack(batch_x)
+
+
+def _measure_allocations(fn, repeats):
+    """Runs `fn` `repeats` times and returns the mean wall time and the peak of newly allocated bytes per call."""
+    fn()  # Warm up (e.g. allocate reusable buffers)
+    peak = 0
+    elapsed = 0.0
+    for _ in range(repeats):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = fn()
+        elapsed += time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        del result
+    return {
+        'seconds_per_batch': elapsed / repeats,
+        'peak_bytes_per_batch': peak,
+    }
+
+
+def benchmark_batch_assembly(batch_sizes=(16, 32, 64), image_size=(224, 224), repeats=20):
+    """Compares the memory traffic of the legacy list/vstack batch assembly with ImageIterator's
+    preallocated batches, both in the trainer process and in a multiprocessing worker (reused buffer)."""
+    folder = tempfile.mkdtemp(prefix='batch_assembly_')
+    results = []
+    try:
+        paths = create_synthetic_images(folder, max(batch_sizes), size=image_size)
+        for batch_size in batch_sizes:
+            iterator = ImageIterator(
+                image_paths=paths[:batch_size],
+                augmentation_pipeline=create_pipeline(0, image_size),
+                batch_size=batch_size,
+                preprocessing_function=preprocess_input,
+                pregen_augmented_images=True,
+                target_size=image_size
+            )
+            index_array = np.arange(batch_size)
+            images = [iterator.augmented_images[j] for j in index_array]
+            batch_bytes = batch_size * image_size[0] * image_size[1] * 3 * np.dtype('float32').itemsize
+
+            legacy = _measure_allocations(
+                lambda: legacy_batch_assembly(images, preprocess_input),
+                repeats
+            )
+            preallocated = _measure_allocations(
+                lambda: iterator._get_batches_of_transformed_samples(index_array),
+                repeats
+            )
+            # Pretend to be a forked worker so the batch buffer is reused
+            iterator._owner_pid = -1
+            reused = _measure_allocations(
+                lambda: iterator._get_batches_of_transformed_samples(index_array),
+                repeats
+            )
+
+            for name, stats in [('legacy', legacy), ('preallocated', preallocated), ('reused_buffer', reused)]:
+                stats.update({
+                    'mode': name,
+                    'batch_size': batch_size,
+                    'batch_bytes': batch_bytes,
+                    'peak_batches_per_batch': stats['peak_bytes_per_batch'] / batch_bytes,
+                })
+                results.append(stats)
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def _rss_bytes(pid):
+    with open('/proc/{}/statm'.format(pid)) as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def total_rss_bytes():
+    """Resident memory of this process and its live worker processes."""
+    pids = [os.getpid()] + [p.pid for p in multiprocessing.active_children()]
+    total = 0
+    for pid in pids:
+        try:
+            total += _rss_bytes(pid)
+        except (IOError, OSError):
+            pass  # Worker exited meanwhile
+    return total
+
+
+def measure_batches(batches, steps):
+    """Pulls `steps` batches from the `batches` iterator and reports the throughput, the batch
+    latency percentiles and the peak resident memory of this process and its workers."""
+    next(batches)  # Exclude start-up, e.g. forking workers or tracing tf.data functions
+    latencies = []
+    images = 0
+    peak_rss = total_rss_bytes()
+    start = time.perf_counter()
+    for _ in range(steps):
+        batch_start = time.perf_counter()
+        batch = next(batches)
+        latencies.append(time.perf_counter() - batch_start)
+        images += len(batch[0] if isinstance(batch, tuple) else batch)
+        peak_rss = max(peak_rss, total_rss_bytes())
+    elapsed = time.perf_counter() - start
+    return {
+        'images_per_second': images / elapsed,
+        'p50_batch_latency_ms': float(np.percentile(latencies, 50)) * 1000,
+        'p99_batch_latency_ms': float(np.percentile(latencies, 99)) * 1000,
+        'peak_rss_bytes': peak_rss,
+    }
+
+
+def benchmark_enqueued_iterator(iterator, workers, use_multiprocessing, max_queue_size=10, steps=50):
+    """Consumes `steps` batches the way Keras `fit` does (OrderedEnqueuer), see `measure_batches`."""
+    enqueuer = OrderedEnqueuer(iterator, use_multiprocessing=use_multiprocessing, shuffle=False)
+    enqueuer.start(workers=workers, max_queue_size=max_queue_size)
+    try:
+        return measure_batches(enqueuer.get(), steps)
+    finally:
+        enqueuer.stop()
+
+
+def benchmark_decode_modes(
+    image_paths,
+    data_aug_group=1,
+    image_size=(224, 224),
+    batch_size=32,
+    workers=None,
+    decode_threads=None,
+    max_queue_size=10,
+    steps=50
+):
+    """Compares the multiprocessing workers used by `main.py --training`, with pickled batches and
+    with shared memory batches (`--shared-memory-batches`), and the in-process intra-batch thread
+    pool (`--decode-threads`)."""
+    workers = workers or os.cpu_count()
+    decode_threads = decode_threads or os.cpu_count()
+    labels = np.zeros((len(image_paths), 8), dtype=np.float32)
+    results = []
+    for mode, iterator_threads, enqueuer_workers, use_multiprocessing, shared_memory_slots in [
+        ('multiprocessing', 0, workers, True, 0),
+        ('multiprocessing_shared_memory', 0, workers, True, max_queue_size + 2),
+        ('threads', decode_threads, 1, False, 0),
+    ]:
+        iterator = ImageIterator(
+            image_paths=image_paths,
+            labels=labels,
+            augmentation_pipeline=create_pipeline(data_aug_group, image_size),
+            batch_size=batch_size,
+            shuffle=True,
+            preprocessing_function=preprocess_input,
+            target_size=image_size,
+            decode_threads=iterator_threads,
+            shared_memory_slots=shared_memory_slots
+        )
+        stats = benchmark_enqueued_iterator(
+            iterator,
+            workers=enqueuer_workers,
+            use_multiprocessing=use_multiprocessing,
+            max_queue_size=max_queue_size,
+            steps=steps
+        )
+        stats.update({
+            'mode': mode,
+            'workers': enqueuer_workers,
+            'decode_threads': iterator_threads,
+            'data_augmentation_group': data_aug_group,
+            'image_size': image_size[0],
+            'batch_size': batch_size,
+        })
+        results.append(stats)
+    return results
+
+
+def get_input_sizes():
+    """Every input size of the transfer learning models."""
+    return sorted(set(param.input_size for param in get_transfer_model_param_map().values()))
+
+
+def benchmark_throughput(
+    image_paths,
+    data_aug_groups=(0, 1, 2, 3, 4),
+    input_sizes=None,
+    batch_sizes=(32,),
+    workers_list=(0, os.cpu_count()),
+    backends=('iterator', 'tfdata'),
+    max_queue_size=10,
+    steps=20,
+    batch_augmentation=False,
+    fused_warp=False,
+    reorder_operations=False,
+    distortion_pool_size=0
+):
+    """Throughput of the training input pipeline for every combination of augmentation group,
+    input size, batch size, worker count and backend.
+
+    # Arguments
+        image_paths: List of image file paths.
+        data_aug_groups: Augmentation groups of `get_augmentation_group`.
+        input_sizes: Tuples `(width, height)`, every size of `get_transfer_model_param_map` if None.
+        batch_sizes: Batch sizes.
+        workers_list: Worker processes of the `iterator` backend, 0 runs the iterator in this process.
+            The `tfdata` backend tunes its own parallelism and runs once per combination.
+        backends: 'iterator' (ImageIterator through Keras' OrderedEnqueuer) and/or 'tfdata'.
+        max_queue_size: Maximum size of the enqueuer queue.
+        steps: Number of measured batches.
+        batch_augmentation: Boolean, whether the `iterator` backend uses the batch augmentation engine.
+        fused_warp: Boolean, whether the geometric operations are resampled in a single warp.
+        reorder_operations: Boolean, whether the pixel operations run after the final resize.
+        distortion_pool_size: Integer, number of precomputed distortions, disabled if 0.
+    # Returns
+        A list of dicts, one per combination.
+    """
+    labels = np.zeros((len(image_paths), 8), dtype=np.float32)
+    results = []
+    for data_aug_group in data_aug_groups:
+        for input_size in input_sizes or get_input_sizes():
+            pipeline = create_pipeline(
+                data_aug_group,
+                input_size,
+                fused_warp=fused_warp,
+                reorder_operations=reorder_operations,
+                distortion_pool_size=distortion_pool_size
+            )
+            for batch_size in batch_sizes:
+                for backend in backends:
+                    for workers in (workers_list if backend == 'iterator' else [None]):
+                        if backend == 'tfdata':
+                            dataset = create_dataset(
+                                image_paths=image_paths,
+                                labels=labels,
+                                augmentation_pipeline=pipeline,
+                                target_size=input_size,
+                                batch_size=batch_size,
+                                shuffle=True,
+                                repeat=True,
+                                preprocessing_function=preprocess_input
+                            )
+                            stats = measure_batches(iter(dataset), steps)
+                        else:
+                            iterator = ImageIterator(
+                                image_paths=image_paths,
+                                labels=labels,
+                                augmentation_pipeline=pipeline,
+                                batch_size=batch_size,
+                                shuffle=True,
+                                preprocessing_function=preprocess_input,
+                                target_size=input_size,
+                                batch_augmentation=batch_augmentation
+                            )
+                            if workers:
+                                stats = benchmark_enqueued_iterator(
+                                    iterator,
+                                    workers=workers,
+                                    use_multiprocessing=True,
+                                    max_queue_size=max_queue_size,
+                                    steps=steps
+                                )
+                            else:
+                                stats = measure_batches(iterator, steps)
+                        stats.update({
+                            'backend': backend,
+                            'workers': workers,
+                            'batch_augmentation': batch_augmentation and backend == 'iterator',
+                            'fused_warp': fused_warp,
+                            'reorder_operations': reorder_operations,
+                            'distortion_pool_size': distortion_pool_size,
+                            'data_augmentation_group': data_aug_group,
+                            'input_size': input_size[0],
+                            'batch_size': batch_size,
+                        })
+                        print(json.dumps(stats), file=sys.stderr)
+                        results.append(stats)
+    return results
+
+
+def validate_reordering(image_paths, data_aug_groups=(2, 4), input_size=(224, 224), repeats=16, fused_warp=False, distortion_pool_size=0):
+    """Statistical equivalence and speed of `reorder_operations` against the original operation order.
+
+    # Arguments
+        image_paths: List of image file paths.
+        data_aug_groups: Augmentation groups of `get_augmentation_group`.
+        input_size: Tuple `(width, height)`.
+        repeats: Integer, number of augmentations of every image by each pipeline.
+        fused_warp: Boolean, whether the reordered pipeline also resamples its geometric operations in a single warp.
+        distortion_pool_size: Integer, number of precomputed distortions of the reordered pipeline, disabled if 0.
+    # Returns
+        A list of dicts, one per augmentation group, see `compare_pipelines` and `check_distortion_pool`.
+    """
+    results = []
+    for data_aug_group in data_aug_groups:
+        candidate = create_pipeline(
+            data_aug_group,
+            input_size,
+            fused_warp=fused_warp,
+            reorder_operations=True,
+            distortion_pool_size=distortion_pool_size
+        )
+        report = compare_pipelines(create_pipeline(data_aug_group, input_size), candidate, image_paths, repeats=repeats)
+        report.update({
+            'data_augmentation_group': data_aug_group,
+            'input_size': input_size[0],
+            'fused_warp': fused_warp,
+            'distortion_pool_size': distortion_pool_size,
+            # Whether the Distort operations of the group run with their precomputed distortions
+            'distortion_pool_used': check_distortion_pool(candidate, image_paths) if distortion_pool_size else None,
+        })
+        print(json.dumps(report), file=sys.stderr)
+        results.append(report)
+    return results
+
+
+def validate_batch_augmentation(image_paths, data_aug_groups=(0, 1, 2), input_size=(224, 224), repeats=4, fire_all=True):
+    """Per-image differences between the batch augmentation engine and `CustomPipeline` with the same parameters.
+
+    # Arguments
+        image_paths: List of image file paths.
+        data_aug_groups: Augmentation groups of `get_augmentation_group` supported by `BatchAugmenter`.
+        input_size: Tuple `(width, height)`.
+        repeats: Integer, number of augmentations of every image.
+        fire_all: Boolean, whether every operation fires.
+    # Returns
+        A list of dicts, one per augmentation group, see `compare_batch_augmenter`.
+    """
+    results = []
+    for data_aug_group in data_aug_groups:
+        report = compare_batch_augmenter(create_pipeline(data_aug_group, input_size), image_paths, repeats=repeats, fire_all=fire_all)
+        report.update({
+            'data_augmentation_group': data_aug_group,
+            'input_size': input_size[0],
+            'fire_all': fire_all,
+        })
+        print(json.dumps(report), file=sys.stderr)
+        results.append(report)
+    return results
+
+
+def get_image_paths(images_folder, synthetic_count, synthetic_folder):
+    if images_folder is not None:
+        return sorted(glob.glob(os.path.join(images_folder, '**', '*.jpg'), recursive=True))
+    return create_synthetic_images(synthetic_folder, synthetic_count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Input pipeline benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    parser_batch = subparsers.add_parser('batch-assembly', help='Allocations and copies per batch')
+    parser_batch.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 32, 64])
+    parser_batch.add_argument('--image-size', type=int, default=224)
+    parser_batch.add_argument('--repeats', type=int, default=20)
+
+    parser_decode = subparsers.add_parser('decode-modes', help='Multiprocessing workers against the intra-batch thread pool')
+    parser_decode.add_argument('--images', default=None, help='Image folder, synthetic 1024x768 images are used if not set')
+    parser_decode.add_argument('--synthetic-count', type=int, default=512)
+    parser_decode.add_argument('--data-augmentation-group', dest='dggroup', type=int, default=1)
+    parser_decode.add_argument('--image-size', type=int, default=224)
+    parser_decode.add_argument('--batch-size', type=int, default=32)
+    parser_decode.add_argument('--workers', type=int, default=None)
+    parser_decode.add_argument('--decode-threads', type=int, default=None)
+    parser_decode.add_argument('--steps', type=int, default=50)
+
+    parser_throughput = subparsers.add_parser('throughput', help='Images/sec, batch latency and peak RSS of the training input pipeline')
+    parser_throughput.add_argument('--images', default=None, help='Image folder, synthetic 1024x768 images are used if not set')
+    parser_throughput.add_argument('--synthetic-count', type=int, default=512)
+    parser_throughput.add_argument('--groups', type=int, nargs='+', default=[0, 1, 2, 3, 4], help='Data augmentation groups')
+    parser_throughput.add_argument('--input-sizes', type=int, nargs='+', default=None, help='Input sizes, every model input size if not set')
+    parser_throughput.add_argument('--batch-sizes', type=int, nargs='+', default=[32])
+    parser_throughput.add_argument('--workers', type=int, nargs='+', default=[0, os.cpu_count()], help='Worker processes of the iterator backend, 0 runs it in process')
+    parser_throughput.add_argument('--backends', nargs='+', choices=['iterator', 'tfdata'], default=['iterator', 'tfdata'])
+    parser_throughput.add_argument('--steps', type=int, default=20)
+    parser_throughput.add_argument('--batch-augmentation', dest='batch_augmentation', action='store_true', help='Use the batch augmentation engine in the iterator backend')
+    parser_throughput.add_argument('--fused-warp', dest='fused_warp', action='store_true', help='Resample the geometric operations of each image in a single warp')
+    parser_throughput.add_argument('--reorder-operations', dest='reorder_operations', action='store_true', help='Run the pixel operations after the final resize')
+    parser_throughput.add_argument('--distortion-pool-size', dest='distortion_pool_size', type=int, default=0, help='Precomputed distortions of the Distort operations')
+    parser_throughput.add_argument('--output', default=None, help='JSON file of the results')
+
+    parser_reordering = subparsers.add_parser('reordering', help='Statistical equivalence and speed of the reordered augmentation pipelines')
+    parser_reordering.add_argument('--images', default=None, help='Image folder, synthetic 1024x768 images are used if not set')
+    parser_reordering.add_argument('--synthetic-count', type=int, default=64)
+    parser_reordering.add_argument('--groups', type=int, nargs='+', default=[2, 4], help='Data augmentation groups')
+    parser_reordering.add_argument('--input-size', type=int, default=224)
+    parser_reordering.add_argument('--repeats', type=int, default=16, help='Augmentations of every image, rare operations such as erasing need many to differ significantly')
+    parser_reordering.add_argument('--fused-warp', dest='fused_warp', action='store_true', help='Also resample the geometric operations in a single warp')
+    parser_reordering.add_argument('--distortion-pool-size', dest='distortion_pool_size', type=int, default=0, help='Also precompute the distortions')
+
+    parser_batch_augmentation = subparsers.add_parser('batch-augmentation', help='Per-image differences between the batch augmentation engine and the per-image pipeline')
+    parser_batch_augmentation.add_argument('--images', default=None, help='Image folder, synthetic 1024x768 images are used if not set')
+    parser_batch_augmentation.add_argument('--synthetic-count', type=int, default=16)
+    parser_batch_augmentation.add_argument('--groups', type=int, nargs='+', default=[0, 1, 2], help='Data augmentation groups')
+    parser_batch_augmentation.add_argument('--input-size', type=int, default=224)
+    parser_batch_augmentation.add_argument('--repeats', type=int, default=4)
+    parser_batch_augmentation.add_argument('--random-firing', dest='random_firing', action='store_true', help='Fire the operations with their probabilities instead of all of them')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'batch-assembly':
+        results = benchmark_batch_assembly(
+            batch_sizes=args.batch_sizes,
+            image_size=(args.image_size, args.image_size),
+            repeats=args.repeats
+        )
+    elif args.benchmark == 'decode-modes':
+        synthetic_folder = tempfile.mkdtemp(prefix='decode_modes_')
+        try:
+            results = benchmark_decode_modes(
+                get_image_paths(args.images, args.synthetic_count, synthetic_folder),
+                data_aug_group=args.dggroup,
+                image_size=(args.image_size, args.image_size),
+                batch_size=args.batch_size,
+                workers=args.workers,
+                decode_threads=args.decode_threads,
+                steps=args.steps
+            )
+        finally:
+            shutil.rmtree(synthetic_folder)
+    elif args.benchmark == 'throughput':
+        synthetic_folder = tempfile.mkdtemp(prefix='throughput_')
+        try:
+            results = benchmark_throughput(
+                get_image_paths(args.images, args.synthetic_count, synthetic_folder),
+                data_aug_groups=args.groups,
+                input_sizes=None if args.input_sizes is None else [(size, size) for size in args.input_sizes],
+                batch_sizes=args.batch_sizes,
+                workers_list=args.workers,
+                backends=args.backends,
+                steps=args.steps,
+                batch_augmentation=args.batch_augmentation,
+                fused_warp=args.fused_warp,
+                reorder_operations=args.reorder_operations,
+                distortion_pool_size=args.distortion_pool_size
+            )
+        finally:
+            shutil.rmtree(synthetic_folder)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=4)
+    elif args.benchmark == 'reordering':
+        synthetic_folder = tempfile.mkdtemp(prefix='reordering_')
+        try:
+            results = validate_reordering(
+                get_image_paths(args.images, args.synthetic_count, synthetic_folder),
+                data_aug_groups=args.groups,
+                input_size=(args.input_size, args.input_size),
+                repeats=args.repeats,
+                fused_warp=args.fused_warp,
+                distortion_pool_size=args.distortion_pool_size
+            )
+        finally:
+            shutil.rmtree(synthetic_folder)
+    elif args.benchmark == 'batch-augmentation':
+        synthetic_folder = tempfile.mkdtemp(prefix='batch_augmentation_')
+        try:
+            results = validate_batch_augmentation(
+                get_image_paths(args.images, args.synthetic_count, synthetic_folder),
+                data_aug_groups=args.groups,
+                input_size=(args.input_size, args.input_size),
+                repeats=args.repeats,
+                fire_all=not args.random_firing
+            )
+        finally:
+            shutil.rmtree(synthetic_folder)
+    else:
+        parser.error('Choose a benchmark')
+
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,50 @@
+import tensorflow as tf
+import tensorflow.keras.backend as K
+from tensorflow.keras.layers import Layer
+import utils
+
+
+class PreprocessInput(Layer):
+    """Normalizes uint8 images channel-wise inside the model: (x / 255 - mean) / std.
+    Same normalization as `utils.preprocess_input`, so the input pipeline can transfer uint8
+    batches, four times smaller than the float32 batches.
+
+    # Arguments
+        mean: Per-channel mean of the pixels scaled to [0, 1], `utils.TRAINSET_MEAN` if None.
+        std: Per-channel standard deviation of the pixels scaled to [0, 1], `utils.TRAINSET_STD` if None.
+        data_format: String, either 'channels_first' or 'channels_last'.
+    """
+
+    def __init__(self, mean=None, std=None, data_format=None, **kwargs):
+        super(PreprocessInput, self).__init__(**kwargs)
+        # The statistics in use when the layer is created are saved with the model
+        self.mean = tuple(utils.TRAINSET_MEAN if mean is None else mean)
+        self.std = tuple(utils.TRAINSET_STD if std is None else std)
+        self.data_format = K.image_data_format() if data_format is None else data_format
+
+    def call(self, inputs):
+        if self.data_format == 'channels_first':
+            shape = (1, len(self.mean), 1, 1)
+        else:
+            shape = (1, 1, 1, len(self.mean))
+        mean = K.constant(self.mean, shape=shape)
+        std = K.constant(self.std, shape=shape)
+        x = K.cast(inputs, K.floatx()) / 255.
+        return (x - mean) / std
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = {
+            'mean': self.mean,
+            'std': self.std,
+            'data_format': self.data_format
+        }
+        base_config = super(PreprocessInput, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def takes_uint8_input(model):
+    """Whether `model` normalizes its input itself and expects raw uint8 images."""
+    return tf.as_dtype(model.inputs[0].dtype) == tf.uint8
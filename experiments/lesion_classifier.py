@@ -4,13 +4,19 @@ import tempfile
 import pandas as pd
 import numpy as np
 from data.augmentations import CustomPipeline, get_augmentation_group
+from data.geometric_warp import FusedWarpPipeline
 from image_iterator import ImageIterator
+from tf_data_pipeline import create_dataset
+from tta import create_tta_model
+from index_sampler import WeightedIndexSampler
 import tensorflow.keras.backend as K
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import ModelCheckpoint, CSVLogger, TensorBoard
 from tensorflow.keras.models import Model, model_from_json
 from tensorflow.keras.regularizers import l2
 from keras_numpy_backend import softmax
+from layers import PreprocessInput, takes_uint8_input
+from augmentation_profiler import AugmentationProfilerCallback
 
 import random
 import datetime
@@ -53,22 +59,51 @@ class LesionClassifier():
         else:
             self.image_data_format = image_data_format
         self.parameters = parameters
-        self.preprocessing_func = preprocessing_func
+        if parameters.uint8_batches:
+            # Batches stay uint8 and are normalized by the model (see `layers.PreprocessInput`)
+            self.preprocessing_func = None
+            self.batch_dtype = 'uint8'
+        else:
+            self.preprocessing_func = preprocessing_func
+            self.batch_dtype = K.floatx()
         self.class_weight = class_weight
         self.num_classes = num_classes
+
+        # Online class balancing draws the training images of every epoch with the target class proportions
+        self.index_sampler = None
+        if parameters.online_balance:
+            self.index_sampler = WeightedIndexSampler(
+                categories_train,
+                class_proportions=parameters.class_proportions,
+                replacement=parameters.sample_replacement,
+                epoch_length=parameters.epoch_samples
+            )
+            # The sampled epochs are balanced already
+            self.class_weight = None
+        self.train_samples_per_epoch = len(image_paths_train) if self.index_sampler is None else self.index_sampler.epoch_length
         self.image_paths_train = image_paths_train
         self.categories_train = categories_train
         self.image_paths_val = image_paths_val
         self.categories_val = categories_val
         
+        # Batches in flight: the enqueuer's queue plus the ones the trainer still holds
+        self.shared_memory_slots = parameters.max_queue_size + 2 if parameters.shared_memory_batches else 0
+
         self.log_date = datetime.datetime.now().isoformat()
 
         self.aug_pipeline_train = LesionClassifier.create_aug_pipeline(
             self.parameters.online_dg_group,
             self.input_size,
-            rescale
+            rescale,
+            fused_warp=self.parameters.fused_warp,
+            reorder_operations=self.parameters.reorder_operations,
+            distortion_pool_size=self.parameters.distortion_pool_size
         )
 
+        if self.parameters.profile_augmentations:
+            # Before the data workers are forked, so they share the counters
+            self.aug_pipeline_train.enable_profiling()
+
         print('Image Augmentation Pipeline for Training Set')
         self.aug_pipeline_train.status()
 
@@ -99,7 +134,7 @@ class LesionClassifier():
         model.save_weights(tmp_weights_path)
 
         # load the model from the config
-        model = model_from_json(model_json)
+        model = model_from_json(model_json, custom_objects={'PreprocessInput': PreprocessInput})
         
         # Reload the model weights
         model.load_weights(tmp_weights_path, by_name=True)
@@ -107,10 +142,14 @@ class LesionClassifier():
 
 
     @staticmethod
-    def create_aug_pipeline(data_aug_group, input_size, rescale):
-        """Image Augmentation Pipeline for Training Set."""
+    def create_aug_pipeline(data_aug_group, input_size, rescale, fused_warp=False, reorder_operations=False, distortion_pool_size=0):
+        """Image Augmentation Pipeline for Training Set.
+        With `fused_warp`, the geometric operations of each image are resampled at once (see `FusedWarpPipeline`),
+        with `reorder_operations`, the pixel operations run after the final resize (see `plan_operations`)
+        and `distortion_pool_size` precomputes the distortions of `Distort` (see `DistortionPool`)."""
 
-        pipeline = CustomPipeline()
+        pipeline_class = FusedWarpPipeline if fused_warp else CustomPipeline
+        pipeline = pipeline_class(reorder_operations=reorder_operations, distortion_pool_size=distortion_pool_size)
 
         data_aug_list = get_augmentation_group(
             data_aug_group, 
@@ -136,19 +175,25 @@ class LesionClassifier():
         augmentation_pipeline=None, 
         preprocessing_function=None,
         batch_size=32, 
-        workers=1
+        workers=1,
+        target_size=None,
+        cache_folder=None,
+        data_backend='iterator',
+        decode_threads=0,
+        tta_views=1,
+        tta_crops=0,
+        image_format='jpeg'
     ):
-        
-        generator = ImageIterator(
-            image_paths=df[x_col].tolist(),
-            labels=None,
-            augmentation_pipeline=augmentation_pipeline,
-            batch_size=batch_size,
-            shuffle=False,  # shuffle must be False otherwise will get a wrong balanced accuracy
-            preprocessing_function=preprocessing_function,
-            pregen_augmented_images=False,  # Only 1 epoch.
-            data_format=K.image_data_format()
-        )
+        """Softmax probabilities of the images of a dataframe.
+        With `tta_views` > 1 or `tta_crops` > 0, every image is decoded once and its dihedral views
+        and crops are made within the batch, see `tta.create_tta_model`. Their logits are averaged
+        before the softmax and the decoded batches are `tta_views + tta_crops` times smaller.
+        """
+        dtype = K.floatx()
+        if takes_uint8_input(model):
+            # The model normalizes raw uint8 images itself
+            preprocessing_function = None
+            dtype = 'uint8'
 
         # Predict
         # https://keras.io/getting-started/faq/#how-can-i-obtain-the-output-of-an-intermediate-layer
@@ -156,11 +201,48 @@ class LesionClassifier():
             inputs=model.input,
             outputs=model.get_layer('dense_pred').output
         )
-        logits = intermediate_layer_model.predict_generator(
-            generator, 
-            verbose=1, 
-            workers=workers
-        )
+
+        num_views = tta_views + tta_crops
+        if num_views > 1:
+            intermediate_layer_model = create_tta_model(intermediate_layer_model, views=tta_views, crops=tta_crops)
+            # Keep the number of images per forward pass about batch_size
+            batch_size = max(1, batch_size // num_views)
+
+        # Image shards are only read by the ImageIterator, the tfdata backend decodes image files
+        if data_backend == 'tfdata' and image_format != 'shards':
+            dataset = create_dataset(
+                image_paths=df[x_col].tolist(),
+                augmentation_pipeline=augmentation_pipeline,
+                target_size=target_size,
+                batch_size=batch_size,
+                shuffle=False,  # shuffle must be False otherwise will get a wrong balanced accuracy
+                preprocessing_function=preprocessing_function,
+                data_format=K.image_data_format(),
+                dtype=dtype,
+                cache_folder=cache_folder  # Decoded images are reused by later predictions on the same data
+            )
+            logits = intermediate_layer_model.predict(dataset, verbose=1)
+        else:
+            generator = ImageIterator(
+                image_paths=df[x_col].tolist(),
+                labels=None,
+                augmentation_pipeline=augmentation_pipeline,
+                batch_size=batch_size,
+                shuffle=False,  # shuffle must be False otherwise will get a wrong balanced accuracy
+                preprocessing_function=preprocessing_function,
+                pregen_augmented_images=False,  # Only 1 epoch.
+                data_format=K.image_data_format(),
+                dtype=dtype,
+                target_size=target_size,
+                cache_folder=cache_folder,  # Decoded images are reused by later predictions on the same data
+                decode_threads=decode_threads,
+                image_format=image_format
+            )
+            logits = intermediate_layer_model.predict_generator(
+                generator, 
+                verbose=1, 
+                workers=1 if decode_threads > 0 else workers
+            )
 
         softmax_probs = softmax(logits).astype(float) # explicitly convert softmax values to floating point because 0 and 1 are invalid, but 0.0 and 1.0 are valid
 
@@ -174,6 +256,13 @@ class LesionClassifier():
         return df_softmax
 
     def _create_image_generator(self):
+        if self.parameters.data_backend == 'tfdata':
+            if self.parameters.image_format == 'shards':
+                raise ValueError('The tfdata backend decodes image files, use the iterator backend with image shards.')
+            if self.index_sampler is not None:
+                raise ValueError('Online class balancing requires the iterator backend.')
+            return self._create_tf_datasets()
+
         ### Training Image Generator
         generator_train = ImageIterator(
             image_paths=self.image_paths_train,
@@ -183,7 +272,14 @@ class LesionClassifier():
             shuffle=True,
             preprocessing_function=self.preprocessing_func,
             pregen_augmented_images=False,
-            data_format=self.image_data_format
+            data_format=self.image_data_format,
+            dtype=self.batch_dtype,
+            target_size=self.input_size,
+            decode_threads=self.parameters.decode_threads,
+            shared_memory_slots=self.shared_memory_slots,
+            batch_augmentation=self.parameters.batch_augmentation,
+            image_format=self.parameters.image_format,
+            index_sampler=self.index_sampler
         )
 
         ### Validation Image Generator
@@ -195,13 +291,62 @@ class LesionClassifier():
             shuffle=True,
             preprocessing_function=self.preprocessing_func,
             pregen_augmented_images=True, # Since there is no randomness in the augmentation pipeline.
-            data_format=self.image_data_format
+            data_format=self.image_data_format,
+            dtype=self.batch_dtype,
+            target_size=self.input_size,
+            cache_folder=self.parameters.cache_folder, # Replaces the pre-generated images when set
+            decode_threads=self.parameters.decode_threads,
+            pregen_max_bytes=self.parameters.pregen_max_bytes,
+            pregen_spill_folder=self.parameters.pregen_spill_folder,
+            shared_memory_slots=self.shared_memory_slots,
+            image_format=self.parameters.image_format
         )
 
         return generator_train, generator_val
 
-    def _create_checkpoint_callbacks(self, subdir):
-        """Create the functions to be applied at given stages of the training procedure."""
+    def _create_tf_datasets(self):
+        """tf.data equivalents of the training and validation image generators."""
+        ### Training Dataset
+        dataset_train = create_dataset(
+            image_paths=self.image_paths_train,
+            labels=self.categories_train,
+            augmentation_pipeline=self.aug_pipeline_train,
+            target_size=self.input_size,
+            batch_size=self.parameters.batch_size,
+            shuffle=True,
+            repeat=True,
+            preprocessing_function=self.preprocessing_func,
+            data_format=self.image_data_format,
+            dtype=self.batch_dtype
+        )
+
+        ### Validation Dataset
+        dataset_val = create_dataset(
+            image_paths=self.image_paths_val,
+            labels=self.categories_val,
+            augmentation_pipeline=self.aug_pipeline_val,
+            target_size=self.input_size,
+            batch_size=self.parameters.batch_size,
+            shuffle=True,
+            cache=True, # Since there is no randomness in the augmentation pipeline.
+            repeat=True,
+            preprocessing_function=self.preprocessing_func,
+            data_format=self.image_data_format,
+            dtype=self.batch_dtype
+        )
+
+        return dataset_train, dataset_val
+
+    def _reset_generators(self):
+        """Resets the image generators (tf.data datasets need no reset)."""
+        for generator in [self.generator_train, self.generator_val]:
+            if isinstance(generator, ImageIterator):
+                generator.reset()
+
+    def _create_checkpoint_callbacks(self, subdir, bests=None):
+        """Create the functions to be applied at given stages of the training procedure.
+        `bests` maps checkpoint filenames to the best monitored values saved so far (see `_get_checkpoint_bests`),
+        so the checkpoints only overwrite them with better models."""
 
         model_path = os.path.join(self.model_folder, self.model_name, subdir)
 
@@ -236,7 +381,17 @@ class LesionClassifier():
             save_best_only=True
         )
         
-        return [checkpoint_balanced_acc, checkpoint_balanced_acc_weights, checkpoint_latest, checkpoint_loss]
+        checkpoints = [checkpoint_balanced_acc, checkpoint_balanced_acc_weights, checkpoint_latest, checkpoint_loss]
+        if bests is not None:
+            for checkpoint in checkpoints:
+                if checkpoint.save_best_only and os.path.basename(checkpoint.filepath) in bests:
+                    checkpoint.best = bests[os.path.basename(checkpoint.filepath)]
+        return checkpoints
+
+    @staticmethod
+    def _get_checkpoint_bests(checkpoints):
+        """Best monitored values of the checkpoints saving the best model only, by checkpoint filename."""
+        return {os.path.basename(checkpoint.filepath): float(checkpoint.best) for checkpoint in checkpoints if checkpoint.save_best_only}
 
     def _create_csvlogger_callback(self, subdir):
         """Create csv logger callback for logging train and validation metrics to a csv file"""
@@ -253,6 +408,19 @@ class LesionClassifier():
             append=True
         )
 
+    def _create_augmentation_profiler_callbacks(self, subdir):
+        """Create callback for logging the per-operation counters of the training augmentations to a csv file and tensorboard, if profiling is enabled"""
+        if self.aug_pipeline_train.profiler is None:
+            return []
+        log_dir = os.path.join(self.history_folder, self.model_name, subdir)
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        return [AugmentationProfilerCallback(
+            self.aug_pipeline_train.profiler,
+            filename=os.path.join(log_dir, "augmentation_profile.csv"),
+            log_dir=os.path.join(log_dir, "augmentation")
+        )]
+
     def _create_tensorboard_logger(self, subdir):
         """Create csv logger callback for logging train and validation metrics to tensorboard"""
         if not os.path.exists(self.history_folder):
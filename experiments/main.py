@@ -1,5 +1,5 @@
 import os
-from utils import ensemble_predictions, ensemble_predictions_k_fold, get_gpu_index, save_prediction_results, apply_unknown_threshold, formated_hyperparameters
+from utils import ensemble_predictions, ensemble_predictions_k_fold, get_gpu_index, save_prediction_results, apply_unknown_threshold, formated_hyperparameters, set_dataset_statistics, load_dataset_statistics
 print("GPU DEVICE: " + str(get_gpu_index()))
 os.environ["CUDA_VISIBLE_DEVICES"]=str(get_gpu_index())
 import json
@@ -10,8 +10,11 @@ from tensorflow.keras import backend as K
 from tensorflow.keras.models import load_model
 from tensorflow.keras import utils
 from data.data_loader import load_isic_training_data, load_isic_training_and_out_dist_data, train_validation_split, compute_class_weight_dict, get_dataframe_from_img_folder
+from data.image_shards import get_dataframe_from_shard_folder, is_shard_folder
 from transfer_learn_classifier import TransferLearnClassifier
+from fe_checkpoint_cache import FeatureExtractionCache
 from metrics import balanced_accuracy
+from layers import PreprocessInput
 from base_model_param import get_transfer_model_param_map
 from lesion_classifier import LesionClassifier
 from sklearn.model_selection import KFold, StratifiedKFold
@@ -37,7 +40,28 @@ ModelParameters = NamedTuple('ModelParameters', [
     ('online_dg_group', int),
     ('samples', int),
     ('balanced', int),
-    ('unknown_train', bool)
+    ('unknown_train', bool),
+    ('cache_folder', str),
+    ('data_backend', str),
+    ('decode_threads', int),
+    ('pregen_max_bytes', int),
+    ('pregen_spill_folder', str),
+    ('uint8_batches', bool),
+    ('shared_memory_batches', bool),
+    ('batch_augmentation', bool),
+    ('fused_warp', bool),
+    ('reorder_operations', bool),
+    ('distortion_pool_size', int),
+    ('profile_augmentations', bool),
+    ('tta_views', int),
+    ('tta_crops', int),
+    ('image_format', str),
+    ('online_balance', bool),
+    ('class_proportions', list),
+    ('epoch_samples', int),
+    ('sample_replacement', bool),
+    ('feature_cache_folder', str),
+    ('feature_cache_views', int)
 ])
 
 def train_transfer_learning(
@@ -49,7 +73,8 @@ def train_transfer_learning(
     model_folder,
     history_folder,
     parameters,
-    k_split=0
+    k_split=0,
+    fe_cache=None
 ):
     # Create classifier
     classifier = TransferLearnClassifier(
@@ -68,7 +93,7 @@ def train_transfer_learning(
         parameters=parameters
     )
     print("Begin to train {}".format(model_param.class_name))
-    classifier.train(k_split=k_split, workers=os.cpu_count())
+    classifier.train(k_split=k_split, workers=os.cpu_count(), fe_cache=fe_cache)
     del classifier
     K.clear_session()
 
@@ -82,8 +107,11 @@ def train(
     model_folder,
     history_folder,
     parameters,
-    df_val=None
+    df_val=None,
+    fe_cache_folder=None
 ):    
+    # Runs with the same feature extraction phase restore its end-of-phase checkpoint
+    fe_cache = None if fe_cache_folder is None else FeatureExtractionCache(fe_cache_folder)
     for model_param in base_model_params:
         if k_folds > 0:
             # K fold cross validation (stratified per category)
@@ -102,7 +130,8 @@ def train(
                     model_folder,
                     history_folder,
                     parameters,
-                    k_split=k_split
+                    k_split=k_split,
+                    fe_cache=fe_cache
                 )
                 k_split=k_split+1
         else:
@@ -117,9 +146,13 @@ def train(
                 class_weight_dict, 
                 model_folder,
                 history_folder,
-                parameters
+                parameters,
+                fe_cache=fe_cache
             )
 
+    if fe_cache is not None:
+        fe_cache.report()
+
 
 def handle_unknown(
     model,
@@ -185,7 +218,9 @@ def handle_unknown(
             model_params, 
             df_test, 
             len(category_names), 
-            parameters
+            parameters,
+            tta_views=parameters.tta_views,
+            tta_crops=parameters.tta_crops
         )
         # Merge ensemble predictions with out-of-Distribution scores
         df_softmax.insert(
@@ -226,7 +261,11 @@ def predidct_test(
     k_folds=0
 ):
     os.makedirs(pred_result_folder_test, exist_ok=True)
-    df_test = get_dataframe_from_img_folder(test_image_folder, has_path_col=True)
+    test_image_format = 'shards' if is_shard_folder(test_image_folder) else 'jpeg'
+    if test_image_format == 'shards':
+        df_test = get_dataframe_from_shard_folder(test_image_folder, has_path_col=True)
+    else:
+        df_test = get_dataframe_from_img_folder(test_image_folder, has_path_col=True)
     df_test.drop(columns=['path']).to_csv(os.path.join(pred_result_folder_test, 'ISIC_2019_Test.csv'), index=False)
     
     hyperparameter_str = formated_hyperparameters(parameters)
@@ -256,10 +295,12 @@ def predidct_test(
 
             if os.path.exists(model_filepath):
                 print("===== Predict test data using \"{}_{}\" with \"{}\" model =====".format(model_to_predict.class_name, k_fold, postfix))
+                # Normalize as the model was trained, not with the statistics of the current data folder
+                load_dataset_statistics(os.path.dirname(model_filepath))
                 
                 model = load_model(
                     filepath=model_filepath, 
-                    custom_objects={'balanced_accuracy': balanced_accuracy(len(category_names))}
+                    custom_objects={'balanced_accuracy': balanced_accuracy(len(category_names)), 'PreprocessInput': PreprocessInput}
                 )
 
                 df_softmax = LesionClassifier.predict_dataframe(
@@ -270,6 +311,13 @@ def predidct_test(
                     preprocessing_function=model_to_predict.preprocessing_func,
                     batch_size=parameters.batch_size,
                     workers=os.cpu_count(),
+                    target_size=model_to_predict.input_size,
+                    cache_folder=parameters.cache_folder,
+                    data_backend=parameters.data_backend,
+                    decode_threads=parameters.decode_threads,
+                    tta_views=parameters.tta_views,
+                    tta_crops=parameters.tta_crops,
+                    image_format=test_image_format
                 )
 
                 df_softmax = handle_unknown(
@@ -375,6 +423,27 @@ if __name__ == '__main__':
     parser.add_argument('--predtestresultfolder', help='Name of the prediction result folder for test data (default: %(default)s)', default='test_predict_results')
     parser.add_argument('--modelfolder', help='Name of the model folder (default: %(default)s)', default='models')
     parser.add_argument('--historyfolder', help='Name of the history log folder (default: %(default)s)', default='history')
+    parser.add_argument('--data-backend', dest='data_backend', choices=['iterator', 'tfdata'], help='Input pipeline backend (default: %(default)s)', default='iterator')
+    parser.add_argument('--decode-threads', dest='decode_threads', type=int, help='Threads decoding the images of each batch in the training process instead of multiprocessing workers, disabled if 0 (default: %(default)s)', default=0)
+    parser.add_argument('--pregen-max-mb', dest='pregen_max_mb', type=int, help='Memory budget in MB of the pre-generated validation images, least recently used images are evicted beyond it (default: %(default)s)', default=None)
+    parser.add_argument('--pregen-spill-folder', dest='pregen_spill_folder', help='Folder of a memory-mapped file holding the pre-generated validation images instead of RAM (default: %(default)s)', default=None)
+    parser.add_argument('--uint8-batches', dest='uint8_batches', action='store_true', help='Transfer uint8 batches and normalize them inside the trained models')
+    parser.add_argument('--shared-memory-batches', dest='shared_memory_batches', action='store_true', help='Multiprocessing workers pass batches through shared memory instead of pickling them')
+    parser.add_argument('--batch-augmentation', dest='batch_augmentation', action='store_true', help='Augment whole training batches with the batch augmentation engine (data augmentation groups 0 to 2)')
+    parser.add_argument('--fused-warp', dest='fused_warp', action='store_true', help='Resample the geometric augmentations of each training image in a single warp (data augmentation groups 0, 1 and 3)')
+    parser.add_argument('--reorder-operations', dest='reorder_operations', action='store_true', help='Run the pixel operations of the training augmentations (brightness, color, contrast, distortions, erasing) after the final resize')
+    parser.add_argument('--distortion-pool-size', dest='distortion_pool_size', type=int, help='Number of precomputed random distortions of every Distort operation of the training augmentations (e.g. group 4), disabled if 0 (default: %(default)s)', default=0)
+    parser.add_argument('--profile-augmentations', dest='profile_augmentations', action='store_true', help='Log the call count, fired count, wall time and image sizes of every training augmentation operation at the end of each epoch')
+    parser.add_argument('--tta-views', dest='tta_views', type=int, choices=range(1, 9), help='Number of dihedral views (90 degree rotations and flips) of every test image whose logits are averaged, each image is decoded once (default: %(default)s)', default=1)
+    parser.add_argument('--tta-crops', dest='tta_crops', type=int, choices=range(0, 6), help='Number of crops (center, then corners) of every test image added to the test-time augmentation views (default: %(default)s)', default=0)
+    parser.add_argument('--online-balance', dest='online_balance', action='store_true', help='Balance the classes of every training epoch by sampling the original images instead of oversampled copies written by data_sampler.py')
+    parser.add_argument('--class-proportions', dest='class_proportions', type=float, nargs='*', help='Target proportion of every class with --online-balance, equal proportions if not set (default: %(default)s)', default=None)
+    parser.add_argument('--epoch-samples', dest='epoch_samples', type=int, help='Number of training images per epoch with --online-balance, the training set size if not set (default: %(default)s)', default=None)
+    parser.add_argument('--sample-without-replacement', dest='sample_without_replacement', action='store_true', help='With --online-balance, only repeat the images of a class once all of them were drawn')
+    parser.add_argument('--feature-cache-folder', dest='feature_cache_folder', help='Folder of the stored features of the frozen base models, the feature extraction epochs train the classification head on them if set (default: %(default)s)', default=None)
+    parser.add_argument('--feature-cache-views', dest='feature_cache_views', type=int, help='Number of augmented views of every training image stored with --feature-cache-folder (default: %(default)s)', default=4)
+    parser.add_argument('--fe-cache-folder', dest='fe_cache_folder', help='Folder of the end-of-feature-extraction checkpoints restored by runs with the same backbone, fold, data and feature extraction hyperparameters, disabled if not set (default: %(default)s)', default=None)
+    parser.add_argument('--cachefolder', help='Name of the decoded image cache folder for validation and test data, disabled if not set (default: %(default)s)', default=None)
     parser.add_argument('--postfix', help='Postfix name (default: %(default)s)', default='best_balanced_acc', choices=['best_balanced_acc', 'best_loss', 'latest'])
 
     args = parser.parse_args()
@@ -401,11 +470,17 @@ if __name__ == '__main__':
 
     offline_dg_group = 1
     unknown_train=False
+    image_format='jpeg'
     # Read Data METADATA File
     with open(os.path.join(data_folder, 'metadata.json')) as f:
         data_metadata = json.load(f)
         offline_dg_group = int(data_metadata["data_augmentation_group"])
         unknown_train = bool(data_metadata["unknown_train"])
+        # Image folders written as packed uint8 shards by data_sampler.py --image-format shards
+        image_format = data_metadata.get("image_format", "jpeg")
+        # Statistics written by dataset_statistics.py replace the hard-coded training set statistics
+        if "statistics" in data_metadata:
+            set_dataset_statistics(data_metadata["statistics"]["mean"], data_metadata["statistics"]["std"])
 
     # Set parameters object
     parameters = ModelParameters(
@@ -420,9 +495,31 @@ if __name__ == '__main__':
         max_queue_size = args.maxqueuesize,
         offline_dg_group=offline_dg_group,
         online_dg_group=args.online_dg_group,
-        samples=len(df_ground_truth['path'].tolist()),
-        balanced=all(round(value, 2) == 1 for value in class_weight_dict.values()),
-        unknown_train=unknown_train
+        # Online class balancing trains on epochs of the sampled size and class proportions
+        samples=args.epoch_samples if args.online_balance and args.epoch_samples else len(df_ground_truth['path'].tolist()),
+        balanced=(args.online_balance and args.class_proportions is None) or all(round(value, 2) == 1 for value in class_weight_dict.values()),
+        unknown_train=unknown_train,
+        cache_folder=args.cachefolder,
+        data_backend=args.data_backend,
+        decode_threads=args.decode_threads,
+        pregen_max_bytes=None if args.pregen_max_mb is None else args.pregen_max_mb * 1024 * 1024,
+        pregen_spill_folder=args.pregen_spill_folder,
+        uint8_batches=args.uint8_batches,
+        shared_memory_batches=args.shared_memory_batches,
+        batch_augmentation=args.batch_augmentation,
+        fused_warp=args.fused_warp,
+        reorder_operations=args.reorder_operations,
+        distortion_pool_size=args.distortion_pool_size,
+        profile_augmentations=args.profile_augmentations,
+        tta_views=args.tta_views,
+        tta_crops=args.tta_crops,
+        image_format=image_format,
+        online_balance=args.online_balance,
+        class_proportions=args.class_proportions,
+        epoch_samples=args.epoch_samples,
+        sample_replacement=not args.sample_without_replacement,
+        feature_cache_folder=args.feature_cache_folder,
+        feature_cache_views=args.feature_cache_views
     )
 
     print("PARAMETERS>>>>>>>>>>>>"+str(parameters))
@@ -446,7 +543,8 @@ if __name__ == '__main__':
             args.modelfolder,
             args.historyfolder,
             parameters,
-            df_val=df_val
+            df_val=df_val,
+            fe_cache_folder=args.fe_cache_folder
         )
 
     # Predict Test Data
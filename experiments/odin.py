@@ -10,10 +10,14 @@ from tensorflow.keras import backend as K
 from base_model_param import get_transfer_model_param_map
 from image_iterator import ImageIterator
 from metrics import balanced_accuracy
+from layers import PreprocessInput, takes_uint8_input
 from keras_numpy_backend import softmax
 from lesion_classifier import LesionClassifier
+from data.image_shards import is_shard_folder
+from tta import average_views, stack_views
 from tqdm import trange
 from sklearn.metrics import roc_auc_score
+import utils
 from utils import logistic
 
 ModelAttr = NamedTuple('ModelAttr', [('model_name', str), ('postfix', str)])
@@ -51,7 +55,9 @@ def compute_odin_softmax_scores(
     model_folder, 
     softmax_score_folder, 
     num_classes, 
-    batch_size
+    batch_size,
+    pregen_max_bytes=None,
+    pregen_spill_folder=None
 ):
     """ Calculate softmax scores for different combinations of ODIN parameters. """
     print('Begin to compute ODIN softmax scores')
@@ -89,7 +95,10 @@ def compute_odin_softmax_scores(
                 shuffle=False,
                 rescale=None,
                 pregen_augmented_images=True,
-                data_format=image_data_format)
+                data_format=image_data_format,
+                pregen_max_bytes=pregen_max_bytes,
+                pregen_spill_folder=pregen_spill_folder,
+                image_format='shards' if is_shard_folder(in_dist_image_folder) else 'jpeg')
 
         # Out-distribution data
         df['Out'] = pd.read_csv(os.path.join(out_dist_pred_result_folder, "{}_{}.csv".format(modelattr.model_name, modelattr.postfix)))
@@ -103,12 +112,15 @@ def compute_odin_softmax_scores(
                 shuffle=False,
                 rescale=None,
                 pregen_augmented_images=True,
-                data_format=image_data_format)
+                data_format=image_data_format,
+                pregen_max_bytes=pregen_max_bytes,
+                pregen_spill_folder=pregen_spill_folder,
+                image_format='shards' if is_shard_folder(out_dist_image_folder) else 'jpeg')
 
         # Load model
         model_filepath = os.path.join(model_folder, "{}_{}.hdf5".format(modelattr.model_name, modelattr.postfix))
         print('Loading model: ', model_filepath)
-        model = load_model(filepath=model_filepath, custom_objects={'balanced_accuracy': balanced_accuracy(num_classes)})
+        model = load_model(filepath=model_filepath, custom_objects={'balanced_accuracy': balanced_accuracy(num_classes), 'PreprocessInput': PreprocessInput})
         need_norm_perturbations = ('DenseNet' in modelattr.model_name or modelattr.model_name == 'ResNeXt50')
 
         for temperature in temperatures:
@@ -160,8 +172,19 @@ def compute_odin_softmax_scores(
         K.clear_session()
 
 
+def get_normalized_input(model):
+    """ Return the tensor of the normalized images and the `PreprocessInput` layer computing it from uint8 images (None if the model takes normalized images). """
+    if takes_uint8_input(model):
+        layer = next(layer for layer in model.layers if isinstance(layer, PreprocessInput))
+        return layer.output, layer
+    return model.inputs[0], None
+
+
 def get_perturbation_helper_func(model, temperature, num_classes):
-    """ Return Keras functions for calculating perturbations. """
+    """ Return Keras functions for calculating perturbations. Both take normalized images, which
+    models trained with uint8 batches compute in their `PreprocessInput` layer, see `get_normalized_input`. """
+    normalized_input, _ = get_normalized_input(model)
+
     # Compute loss based on the second last layer's output and temperature scaling
     dense_pred_layer_output = model.get_layer('dense_pred').output
     scaled_dense_pred_output = dense_pred_layer_output / temperature
@@ -170,21 +193,23 @@ def get_perturbation_helper_func(model, temperature, num_classes):
     # Keras will call tf.nn.softmax_cross_entropy_with_logits when from_logits is True
     loss = K.categorical_crossentropy(label_tensor, scaled_dense_pred_output, from_logits=True)
 
-    print(model.inputs)
-    # Compute gradient of loss with respect to inputs
-    grad_loss = K.gradients(loss, model.inputs)
+    print(normalized_input)
+    # Compute gradient of loss with respect to the normalized inputs
+    grad_loss = K.gradients(loss, [normalized_input])
 
     # The learning phase flag is a bool tensor (0 = test, 1 = train)
-    compute_perturbations = K.function(model.inputs + [K.learning_phase()], grad_loss)
+    compute_perturbations = K.function([normalized_input, K.learning_phase()], grad_loss)
 
     # https://keras.io/getting-started/faq/#how-can-i-obtain-the-output-of-an-intermediate-layer
-    get_scaled_dense_pred_output = K.function(model.inputs + [K.learning_phase()], [scaled_dense_pred_output])
+    get_scaled_dense_pred_output = K.function([normalized_input, K.learning_phase()], [scaled_dense_pred_output])
 
     return compute_perturbations, get_scaled_dense_pred_output
 
 
-def norm_perturbations(x, image_data_format):
-    std = [0.2422, 0.2235, 0.2315]
+def norm_perturbations(x, image_data_format, std=None):
+    # Training set STD, see `utils.set_dataset_statistics`
+    if std is None:
+        std = utils.TRAINSET_STD
 
     if image_data_format == 'channels_first':
         if x.ndim == 3:
@@ -265,11 +290,29 @@ def compute_out_of_distribution_score(
     parameters, 
     temperature=2, 
     magnitude=0.0001, 
-    delta=0.90385
+    delta=0.90385,
+    tta_views=1,
+    tta_crops=0
 ):
+    """ ODIN scores of the images of a dataframe, the scaled logits of the same test-time augmentation views
+    as the predictions (`tta_views` dihedral views and `tta_crops` crops) of every image are averaged. """
     tf.compat.v1.disable_eager_execution()
 
+    # Every decoded batch is expanded to tta_views + tta_crops times more images
+    num_views = tta_views + tta_crops
+    batch_size = max(1, parameters.batch_size // num_views)
+
     image_data_format = K.image_data_format()
+
+    # Models trained with uint8 batches get uint8 images and are perturbed past their normalization layer
+    normalized_input, preprocess_layer = get_normalized_input(model)
+    if preprocess_layer is not None:
+        preprocessing_function, dtype, std = None, 'uint8', preprocess_layer.std
+        normalize = K.function(model.inputs, [normalized_input])
+    else:
+        preprocessing_function, dtype, std = model_params.preprocessing_func, K.floatx(), None
+        normalize = None
+
     generator = ImageIterator(
         image_paths=df['path'].tolist(),
         labels=None,
@@ -278,12 +321,16 @@ def compute_out_of_distribution_score(
             model_params.input_size,
             True
         ),
-        preprocessing_function=model_params.preprocessing_func,
-        batch_size=parameters.batch_size,
+        preprocessing_function=preprocessing_function,
+        batch_size=batch_size,
         shuffle=False,
         rescale=None,
         pregen_augmented_images=False,
-        data_format=image_data_format
+        data_format=image_data_format,
+        dtype=dtype,
+        target_size=model_params.input_size,
+        cache_folder=parameters.cache_folder,
+        image_format='shards' if is_shard_folder(os.path.dirname(df['path'].iloc[0])) else 'jpeg'
     )
 
     compute_perturbations, get_scaled_dense_pred_output = get_perturbation_helper_func(
@@ -295,18 +342,24 @@ def compute_out_of_distribution_score(
     df_score = df[['image']].copy()
     softmax_scores = []
     learning_phase = 0 # 0 = test, 1 = train
-    steps = math.ceil(df.shape[0] / parameters.batch_size)
+    steps = math.ceil(df.shape[0] / batch_size)
     for _ in trange(steps):
         images = next(generator)
+        if num_views > 1:
+            images = stack_views(images, tta_views, tta_crops, data_format=image_data_format)
+        if normalize is not None:
+            images = normalize([images])[0]
         perturbations = compute_perturbations([images, learning_phase])[0]
         # Get sign of perturbations
         perturbations = np.sign(perturbations)
         # DenseNet201 need normalization
-        perturbations = norm_perturbations(perturbations, image_data_format)
+        perturbations = norm_perturbations(perturbations, image_data_format, std)
         # Add perturbations to images
         perturbative_images = images - magnitude * perturbations
         # Calculate the confidence after adding perturbations
         dense_pred_outputs = get_scaled_dense_pred_output([perturbative_images, learning_phase])[0]
+        if num_views > 1:
+            dense_pred_outputs = average_views(dense_pred_outputs, num_views)
         softmax_probs = softmax(dense_pred_outputs)
         softmax_scores.extend(np.max(softmax_probs, axis=-1).tolist())
 
@@ -0,0 +1,123 @@
+"""Ring buffer of batches shared between the trainer and its forked data workers.
+
+Keras' OrderedEnqueuer pickles every batch a worker process returns. Batches written into a
+`SharedBatchRing` only pickle their slot index instead, and the trainer reads the pixels
+zero-copy from the shared memory.
+
+The ring is an anonymous shared memory map, so it must be created before the workers are
+forked (which Keras does at the start of every epoch) and nothing is left behind if a process dies.
+"""
+import itertools
+import mmap
+import multiprocessing
+import os
+import weakref
+import numpy as np
+
+FREE = 0
+BUSY = 1
+
+# Rings of this process by id, so unpickled batches find the memory map inherited from the trainer
+_RINGS = weakref.WeakValueDictionary()
+_RING_IDS = itertools.count()
+
+
+class SharedBatch(np.ndarray):
+    """Batch written into a slot of a `SharedBatchRing`, pickled as a reference to the slot."""
+
+    def __array_finalize__(self, obj):
+        # Arrays derived from a shared batch (e.g. copies) are plain batches
+        self.ring_id = None
+        self.slot = None
+
+    def __reduce__(self):
+        if self.slot is None:
+            return np.asarray(self).__reduce__()
+        return (_attach_shared_batch, (self.ring_id, self.slot, len(self)))
+
+
+class _SlotOwner(np.ndarray):
+    """Slot view held by every array handed to the trainer, the slot is released once it is garbage collected."""
+
+
+def _attach_shared_batch(ring_id, slot, n):
+    return _RINGS[ring_id].attach(slot, n)
+
+
+class SharedBatchRing():
+    """Fixed number of batch slots in shared memory.
+
+    Worker processes `acquire` a free slot and write their batch into it, the trainer `attach`es
+    the slot when unpickling the batch and frees it when its array is garbage collected.
+    Workers fall back to regular (pickled) batches when every slot is busy.
+
+    # Arguments
+        num_slots: Integer, number of batches the ring holds, e.g. `max_queue_size` + 2.
+        batch_shape: Shape of a full batch.
+        dtype: Dtype of the batches.
+    """
+
+    def __init__(self, num_slots, batch_shape, dtype):
+        self.num_slots = num_slots
+        self.batch_shape = tuple(batch_shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_nbytes = int(np.prod(self.batch_shape)) * self.dtype.itemsize
+
+        # Pages of an anonymous map are only allocated when written to
+        self._mmap = mmap.mmap(-1, num_slots * self.slot_nbytes)
+        self._states = multiprocessing.RawArray('b', num_slots)
+        self._lock = multiprocessing.Lock()
+        self._owner_pid = os.getpid()
+        self._attached = {} # slot -> weakref.finalize of the trainer's view
+
+        self.id = next(_RING_IDS)
+        _RINGS[self.id] = self
+
+    def acquire(self, n):
+        """Returns a `SharedBatch` of `n` samples in a free slot, or None if every slot is busy."""
+        # Never wait on a lock a crashed worker may still hold
+        if not self._lock.acquire(timeout=1):
+            return None
+        try:
+            for slot in range(self.num_slots):
+                if self._states[slot] == FREE:
+                    self._states[slot] = BUSY
+                    break
+            else:
+                return None
+        finally:
+            self._lock.release()
+
+        batch = self._slot_array(slot, n, SharedBatch)
+        batch.ring_id = self.id
+        batch.slot = slot
+        return batch
+
+    def attach(self, slot, n):
+        """Zero-copy array of the batch in `slot`, the slot is released once the array is garbage collected."""
+        owner = self._slot_array(slot, n, _SlotOwner)
+        self._attached[slot] = weakref.finalize(owner, self.release, slot)
+        # Views of a plain array keep the owner alive, however they are sliced
+        return owner.view(np.ndarray)
+
+    def release(self, slot):
+        self._attached.pop(slot, None)
+        self._states[slot] = FREE
+
+    def reclaim(self):
+        """Frees the slots of batches that never reached the trainer, e.g. after a worker crash.
+        Only call it when no worker is running, e.g. at the end of an epoch."""
+        if os.getpid() != self._owner_pid:
+            return
+        for slot in range(self.num_slots):
+            if slot not in self._attached:
+                self._states[slot] = FREE
+
+    def _slot_array(self, slot, n, cls):
+        # Created as `cls` directly so the array's base is the memory map itself
+        return cls(
+            (n,) + self.batch_shape[1:],
+            dtype=self.dtype,
+            buffer=self._mmap,
+            offset=slot * self.slot_nbytes
+        )
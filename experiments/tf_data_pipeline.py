@@ -0,0 +1,292 @@
+"""tf.data input pipeline, an alternative backend to `ImageIterator`.
+
+Files are read with parallel interleaved reads, decoded and augmented by a parallel map
+and batches are prefetched with autotuning, all inside the TensorFlow runtime instead of
+forked Keras workers. Augmentation groups made of operations with a TensorFlow equivalent
+(groups 0 to 2) run as graph operations; the other groups run the Augmentor pipeline through
+`tf.numpy_function` so every group keeps its semantics.
+"""
+import io
+import os
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.backend as K
+from PIL import Image
+from Augmentor import Operations
+from data.augmentations import CropCenter, get_draft_size, get_source_operations
+from image_cache import DecodedImageCache
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# ITU-R 601-2 luma transform used by PIL to convert RGB images to grayscale
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+def _fires(probability):
+    """Same test as `CustomPipeline.perform_operations`: round(uniform(0, 1), 1) <= probability."""
+    r = tf.round(tf.random.uniform([]) * 10.) / 10.
+    return r <= probability
+
+
+def _random_factor(min_factor, max_factor):
+    return tf.random.uniform([], min_factor, max_factor)
+
+
+def _luma(img):
+    return tf.reduce_sum(img * tf.constant(LUMA_WEIGHTS), axis=-1, keepdims=True)
+
+
+def _blend(degenerate, img, factor):
+    """Same blend as PIL's ImageEnhance: degenerate + factor * (img - degenerate)."""
+    return tf.clip_by_value(degenerate + factor * (img - degenerate), 0., 255.)
+
+
+def _center_crop(img):
+    shape = tf.shape(img)
+    height, width = shape[0], shape[1]
+    length = tf.minimum(height, width)
+    top = (height - length) // 2
+    left = (width - length) // 2
+    return img[top:top + length, left:left + length]
+
+
+def _crop_percentage(operation):
+    def fn(img):
+        if operation.randomise_percentage_area:
+            # Augmentor samples the area between 10% and `percentage_area`, rounded to 2 decimals
+            percentage = tf.round(tf.random.uniform([], 0.1, operation.percentage_area) * 100.) / 100.
+        else:
+            percentage = tf.constant(operation.percentage_area, tf.float32)
+        shape = tf.shape(img)
+        height, width = shape[0], shape[1]
+        new_height = tf.cast(tf.floor(tf.cast(height, tf.float32) * percentage), tf.int32)
+        new_width = tf.cast(tf.floor(tf.cast(width, tf.float32) * percentage), tf.int32)
+        if operation.centre:
+            top = (height - new_height) // 2
+            left = (width - new_width) // 2
+        else:
+            top = tf.random.uniform([], 0, height - new_height + 1, dtype=tf.int32)
+            left = tf.random.uniform([], 0, width - new_width + 1, dtype=tf.int32)
+        return img[top:top + new_height, left:left + new_width]
+    return fn
+
+
+def _rotate(operation):
+    def fn(img):
+        if operation.rotation == -1:
+            # Random rotation of 90, 180 or 270 degrees counter clockwise, like PIL's rotate
+            k = tf.random.uniform([], 1, 4, dtype=tf.int32)
+        else:
+            k = operation.rotation // 90
+        return tf.image.rot90(img, k)
+    return fn
+
+
+def _flip(operation):
+    def fn(img):
+        if operation.top_bottom_left_right == 'LEFT_RIGHT':
+            return tf.image.flip_left_right(img)
+        if operation.top_bottom_left_right == 'TOP_BOTTOM':
+            return tf.image.flip_up_down(img)
+        return tf.cond(
+            tf.random.uniform([]) < 0.5,
+            lambda: tf.image.flip_left_right(img),
+            lambda: tf.image.flip_up_down(img)
+        )
+    return fn
+
+
+def _brightness(operation):
+    def fn(img):
+        return _blend(tf.zeros_like(img), img, _random_factor(operation.min_factor, operation.max_factor))
+    return fn
+
+
+def _color(operation):
+    def fn(img):
+        return _blend(_luma(img), img, _random_factor(operation.min_factor, operation.max_factor))
+    return fn
+
+
+def _contrast(operation):
+    def fn(img):
+        mean = tf.floor(tf.reduce_mean(_luma(img)) + 0.5)
+        return _blend(mean, img, _random_factor(operation.min_factor, operation.max_factor))
+    return fn
+
+
+def _resize(operation):
+    def fn(img):
+        method = {'BICUBIC': 'bicubic', 'BILINEAR': 'bilinear', 'NEAREST': 'nearest'}.get(operation.resample_filter, 'bicubic')
+        img = tf.image.resize(img, [operation.height, operation.width], method=method, antialias=True)
+        return tf.clip_by_value(img, 0., 255.)
+    return fn
+
+
+def _to_tf_operation(operation):
+    """Returns the TensorFlow function of an Augmentor operation or None if there is none."""
+    if isinstance(operation, CropCenter):
+        return _center_crop
+    if isinstance(operation, Operations.CropPercentage):
+        return _crop_percentage(operation)
+    if isinstance(operation, Operations.Rotate) and operation.rotation in (-1, 90, 180, 270):
+        return _rotate(operation)
+    if isinstance(operation, Operations.Flip):
+        return _flip(operation)
+    if isinstance(operation, Operations.RandomBrightness):
+        return _brightness(operation)
+    if isinstance(operation, Operations.RandomColor):
+        return _color(operation)
+    if isinstance(operation, Operations.RandomContrast):
+        return _contrast(operation)
+    if isinstance(operation, Operations.Resize):
+        return _resize(operation)
+    return None
+
+
+def _create_graph_augmentation(operations):
+    """Graph version of `CustomPipeline.perform_operations`, or None if an operation has no TensorFlow equivalent."""
+    tf_operations = [(operation.probability, _to_tf_operation(operation)) for operation in operations]
+    if any(fn is None for _, fn in tf_operations):
+        return None
+
+    def augment(contents):
+        img = tf.cast(tf.image.decode_jpeg(contents, channels=3), tf.float32)
+        for probability, fn in tf_operations:
+            if probability >= 1:
+                img = fn(img)
+            elif probability > 0:
+                img = tf.cond(_fires(probability), lambda: fn(img), lambda: img)
+        return tf.cast(tf.round(img), tf.uint8)
+    return augment
+
+
+def _create_numpy_augmentation(augmentation_pipeline, target_size):
+    """Runs the Augmentor pipeline on the file contents through `tf.numpy_function`."""
+    draft_size = get_draft_size(get_source_operations(augmentation_pipeline)) if augmentation_pipeline else None
+
+    def augment_numpy(contents):
+        img = Image.open(io.BytesIO(contents))
+        if draft_size is not None:
+            img.draft(img.mode, draft_size)
+        if augmentation_pipeline:
+            img = augmentation_pipeline.perform_operations(img)
+        return np.asarray(img.convert('RGB'), dtype=np.uint8)
+
+    def augment(contents):
+        img = tf.numpy_function(augment_numpy, [contents], tf.uint8)
+        if target_size is not None:
+            img.set_shape([target_size[1], target_size[0], 3])
+        return img
+    return augment
+
+
+def create_dataset(
+    image_paths,
+    labels=None,
+    augmentation_pipeline=None,
+    target_size=None,
+    batch_size=32,
+    shuffle=False,
+    cache=False,
+    repeat=False,
+    preprocessing_function=None,
+    data_format=None,
+    dtype='float32',
+    seed=None,
+    cache_folder=None
+):
+    """Creates a `tf.data.Dataset` yielding the same batches as `ImageIterator`.
+
+    # Arguments
+        image_paths: List of image file paths.
+        labels: Optional array of (one-hot) labels.
+        augmentation_pipeline: `CustomPipeline` applied to every image.
+        target_size: Tuple `(width, height)` of the augmented images, required for batching
+            pipelines without a TensorFlow equivalent.
+        batch_size: Integer, size of a batch.
+        shuffle: Boolean, whether to reshuffle the images at every epoch.
+        cache: Boolean, whether to keep the augmented images in memory after the first epoch,
+            like `pregen_augmented_images` of `ImageIterator` (deterministic pipelines only).
+        repeat: Boolean, whether to repeat the dataset indefinitely (Keras `fit` with `steps_per_epoch`).
+        preprocessing_function: Function applied to every float32 batch, e.g. `utils.preprocess_input`.
+        data_format: String, either 'channels_first' or 'channels_last'.
+        dtype: Dtype of the batches without `preprocessing_function`, e.g. 'uint8' for models
+            normalizing their input.
+        seed: Optional random seed for shuffling.
+        cache_folder: Optional folder of a `DecodedImageCache`, the images of deterministic pipelines
+            (e.g. for predictions) are then read from the cache instead of being decoded, as `ImageIterator` does.
+    # Returns
+        A `tf.data.Dataset` of `x` batches or `(x, y)` batches if `labels` is given.
+    """
+    if data_format is None:
+        data_format = K.image_data_format()
+
+    paths = tf.constant(image_paths)
+    operations = []
+    if augmentation_pipeline:
+        # Operations deferred by `reorder_operations` run after the resize in the graph as well
+        source_operations, deferred = augmentation_pipeline.plan_operations()
+        operations = list(source_operations) + list(deferred)
+    augment = _create_graph_augmentation(operations)
+    if augment is None:
+        augment = _create_numpy_augmentation(augmentation_pipeline, target_size)
+
+    image_cache = None
+    if cache_folder is not None:
+        if target_size is None:
+            raise ValueError('`target_size` is required to cache decoded images.')
+        image_cache = DecodedImageCache(cache_folder, image_paths, target_size, augmentation_pipeline)
+
+    dataset = tf.data.Dataset.range(len(image_paths))
+    if shuffle and not cache:
+        dataset = dataset.shuffle(len(image_paths), seed=seed, reshuffle_each_iteration=True)
+
+    if image_cache is not None:
+        # Zero-copy reads of the memory-mapped cache instead of decoding and augmenting the files
+        def load_cached(i):
+            x = tf.numpy_function(lambda j: np.asarray(image_cache[j]), [i], tf.uint8)
+            x.set_shape(image_cache.image_shape)
+            return x, i
+        dataset = dataset.map(load_cached, num_parallel_calls=AUTOTUNE)
+    else:
+        # Parallel interleaved file reads
+        dataset = dataset.interleave(
+            lambda i: tf.data.Dataset.from_tensors((tf.io.read_file(tf.gather(paths, i)), i)),
+            cycle_length=os.cpu_count(),
+            num_parallel_calls=AUTOTUNE
+        )
+        # Parallel decode and augmentation
+        dataset = dataset.map(lambda contents, i: (augment(contents), i), num_parallel_calls=AUTOTUNE)
+
+    if cache:
+        dataset = dataset.cache()
+        if shuffle:
+            dataset = dataset.shuffle(len(image_paths), seed=seed, reshuffle_each_iteration=True)
+
+    dataset = dataset.batch(batch_size)
+
+    if labels is not None:
+        labels = tf.constant(np.asarray(labels))
+
+    def preprocess(x, i):
+        if data_format == 'channels_first':
+            x = tf.transpose(x, [0, 3, 1, 2])
+        if preprocessing_function:
+            shape = x.shape
+            x = tf.numpy_function(
+                lambda batch: preprocessing_function(batch, data_format=data_format).astype(np.float32, copy=False),
+                [x],
+                tf.float32
+            )
+            x.set_shape(shape)
+        else:
+            x = tf.cast(x, dtype)
+        if labels is None:
+            return x
+        return x, tf.gather(labels, i)
+
+    dataset = dataset.map(preprocess, num_parallel_calls=AUTOTUNE)
+    if repeat:
+        dataset = dataset.repeat()
+    return dataset.prefetch(AUTOTUNE)
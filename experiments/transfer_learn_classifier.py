@@ -2,12 +2,17 @@ from importlib import import_module
 from lesion_classifier import LesionClassifier
 from base_model_param import BaseModelParam
 import tensorflow.keras.backend as K
-from tensorflow.keras.layers import Dense, Activation, GlobalAveragePooling2D, Dropout
+from tensorflow.keras.layers import Dense, Activation, GlobalAveragePooling2D, Dropout, Input
 from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import ReduceLROnPlateau, EarlyStopping
 #from tensorflow import distribute
 from utils import formated_hyperparameters
+from layers import PreprocessInput
+from image_iterator import ImageIterator
+from feature_store import feature_cache_key, cache_features, CachedFeatureSequence, ModelCallbackProxy
+import utils
+import numpy as np
 import os
 
 
@@ -54,9 +59,15 @@ class TransferLearnClassifier(LesionClassifier):
         module = import_module(base_model_param.module_name)
         class_ = getattr(module, base_model_param.class_name)
 
+        input_tensor = None
+        if self.parameters.uint8_batches:
+            # The model normalizes the raw uint8 batches itself
+            inputs = Input(shape=input_shape, dtype='uint8')
+            input_tensor = PreprocessInput(data_format=image_data_format)(inputs)
+
         #with self.mirrored_strategy.scope():
         # create an instance of base model which is pre-trained on the ImageNet dataset.
-        self._base_model = class_(include_top=False, weights='imagenet', input_shape=input_shape)
+        self._base_model = class_(include_top=False, weights='imagenet', input_shape=input_shape, input_tensor=input_tensor)
 
         # Freeze all layers in the base model
         for layer in self._base_model.layers:
@@ -105,12 +116,18 @@ class TransferLearnClassifier(LesionClassifier):
         )
 
 
-    def train(self, k_split=0, workers=1):
+    def train(self, k_split=0, workers=1, fe_cache=None):
+        """Trains the model, the feature extraction phase is restored from `fe_cache` (a `FeatureExtractionCache`)
+        when a run with the same feature extraction hyperparameters and data stored it there."""
         # Sub pre-trained model folder
         model_subdir = os.path.join(formated_hyperparameters(self.parameters), str(k_split))
+        model_path = os.path.join(self.model_folder, self.model_name, model_subdir)
+        history_path = os.path.join(self.history_folder, self.model_name, model_subdir)
 
         # Checkpoint Callbacks
         checkpoints = super()._create_checkpoint_callbacks(model_subdir)
+        # Predictions normalize the images with the statistics the model was trained with
+        utils.save_dataset_statistics(model_path)
 
         # Reduce learning rate when the validation loss has stopped improving.
         reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.1, patience=self.parameters.patience, min_lr=1e-7, verbose=1)
@@ -124,18 +141,47 @@ class TransferLearnClassifier(LesionClassifier):
         # Callback that streams epoch results to tensorboard
         tensorboard_logger = super()._create_tensorboard_logger(model_subdir)
 
-        if(self.parameters.fe_epochs>0):
+        # Callback that logs the per-operation counters of the training augmentations
+        augmentation_profiler = super()._create_augmentation_profiler_callbacks(model_subdir)
+
+        use_multiprocessing = True
+        if self.parameters.decode_threads > 0:
+            # The images of each batch are decoded by the iterator's thread pool inside this process
+            workers = 1
+            use_multiprocessing = False
+
+        fe_cache_key = None
+        if fe_cache is not None and self.parameters.fe_epochs>0:
+            fe_cache_key = fe_cache.key(self._model_name, self.parameters, self.image_paths_train, self.image_paths_val, k_split)
+
+        # The model trained by the feature extraction phase, its optimizer state is cached
+        fe_model = self._model
+        checkpoint_bests = None
+        if fe_cache_key is not None:
+            checkpoint_bests = fe_cache.restore(fe_cache_key, self._model, model_path, history_path)
+        if checkpoint_bests is not None:
+            print('===== Feature extraction restored from cache =====')
+            fe_cache_key = None
+        elif(self.parameters.fe_epochs>0 and self.parameters.feature_cache_folder is not None):
+            ### Feature extraction on the stored features of the frozen base model
+            fe_model = self._train_head_on_cached_features(
+                checkpoints,
+                [reduce_lr, early_stop, csv_logger, tensorboard_logger],
+                workers=workers,
+                use_multiprocessing=use_multiprocessing
+            )
+        elif(self.parameters.fe_epochs>0):
             ### Feature extraction
             self._model.fit(
                 self.generator_train,
                 class_weight=self.class_weight,
                 max_queue_size=self.parameters.max_queue_size,
                 workers=workers,
-                use_multiprocessing=True,
-                steps_per_epoch=len(self.image_paths_train)//self.parameters.batch_size,
+                use_multiprocessing=use_multiprocessing,
+                steps_per_epoch=self.train_samples_per_epoch//self.parameters.batch_size,
                 epochs=self.parameters.fe_epochs,
                 verbose=1,
-                callbacks=(checkpoints + [reduce_lr, early_stop, csv_logger, tensorboard_logger]),
+                callbacks=(checkpoints + [reduce_lr, early_stop, csv_logger, tensorboard_logger] + augmentation_profiler),
                 validation_data=self.generator_val,
                 validation_steps=len(self.image_paths_val)//self.parameters.batch_size,
                 shuffle=False
@@ -143,6 +189,11 @@ class TransferLearnClassifier(LesionClassifier):
         else:
             print('===== No weight initialization =====')
 
+        if checkpoint_bests is None:
+            checkpoint_bests = super()._get_checkpoint_bests(checkpoints)
+        if fe_cache_key is not None:
+            fe_cache.store(fe_cache_key, self._model, fe_model.optimizer, model_path, history_path, checkpoint_bests)
+
         if(self.parameters.ft_epochs>0):
             ### Fine tuning. It should only be attempted after you have trained the top-level classifier with the pre-trained model set to non-trainable.
             print('===== Unfreeze the base model =====')
@@ -158,22 +209,21 @@ class TransferLearnClassifier(LesionClassifier):
             )
             self._model.summary()
 
-            # Re-create Checkpoint Callbacks
-            checkpoints = super()._create_checkpoint_callbacks(model_subdir)
+            # Re-create Checkpoint Callbacks, they only overwrite the best feature extraction checkpoints with better models
+            checkpoints = super()._create_checkpoint_callbacks(model_subdir, bests=checkpoint_bests)
 
-            self.generator_train.reset()
-            self.generator_val.reset()
+            self._reset_generators()
             
             self._model.fit(
                 self.generator_train,
                 class_weight=self.class_weight,
                 max_queue_size=self.parameters.max_queue_size,
                 workers=workers,
-                use_multiprocessing=True,
-                steps_per_epoch=len(self.image_paths_train)//self.parameters.batch_size,
+                use_multiprocessing=use_multiprocessing,
+                steps_per_epoch=self.train_samples_per_epoch//self.parameters.batch_size,
                 epochs=self.parameters.ft_epochs,
                 verbose=1,
-                callbacks=(checkpoints + [reduce_lr, early_stop, csv_logger, tensorboard_logger]),
+                callbacks=(checkpoints + [reduce_lr, early_stop, csv_logger, tensorboard_logger] + augmentation_profiler),
                 validation_data=self.generator_val,
                 validation_steps=len(self.image_paths_val)//self.parameters.batch_size,
                 initial_epoch=self.parameters.fe_epochs,
@@ -182,6 +232,82 @@ class TransferLearnClassifier(LesionClassifier):
         else:
             print('===== No fine tuning =====')
 
+    def _create_feature_model(self):
+        """The frozen base model and its pooling layer, and the head of the model on the pooled features.
+        The head shares its layers (and weights) with `self._model`."""
+        layers = self._model.layers
+        pooling_index = next(i for i, layer in enumerate(layers) if isinstance(layer, GlobalAveragePooling2D))
+        feature_model = Model(inputs=self._model.input, outputs=layers[pooling_index].output)
+
+        features = Input(shape=K.int_shape(feature_model.output)[1:])
+        x = features
+        for layer in layers[pooling_index + 1:]:
+            x = layer(x)
+        head_model = Model(inputs=features, outputs=x)
+        return feature_model, head_model
+
+    def _cache_features(self, feature_model, image_paths, augmentation_pipeline, views, workers=1, use_multiprocessing=False):
+        """Stored pooled features of `views` passes of the images through the augmentation pipeline."""
+        normalization = (np.asarray(utils.TRAINSET_MEAN).tolist(), np.asarray(utils.TRAINSET_STD).tolist())
+        key = feature_cache_key(self._model_name, image_paths, augmentation_pipeline, self.input_size, views, normalization)
+        filepath = os.path.join(self.parameters.feature_cache_folder, self._model_name, key + '.npy')
+        if os.path.exists(filepath):
+            print('Loading stored features from {}'.format(filepath))
+        else:
+            print('Storing features of {} views of {} images in {}'.format(views, len(image_paths), filepath))
+
+        def create_generator():
+            return ImageIterator(
+                image_paths=image_paths,
+                labels=None,
+                augmentation_pipeline=augmentation_pipeline,
+                batch_size=self.parameters.batch_size,
+                shuffle=False,  # The features are stored in the order of the images
+                preprocessing_function=self.preprocessing_func,
+                pregen_augmented_images=False,
+                data_format=self.image_data_format,
+                dtype=self.batch_dtype,
+                target_size=self.input_size,
+                decode_threads=self.parameters.decode_threads,
+                image_format=self.parameters.image_format
+            )
+
+        return cache_features(feature_model, create_generator, views, filepath, workers=workers, use_multiprocessing=use_multiprocessing)
+
+    def _train_head_on_cached_features(self, checkpoints, callbacks, workers=1, use_multiprocessing=False):
+        """Trains the fully connected layers and `dense_pred` on stored features of the frozen base model.
+        The base model runs once per stored view of the training images (`feature_cache_views`) and once on
+        the validation images, instead of once per image and epoch. As the head shares its layers with
+        `self._model`, the trained weights are in place for fine tuning. The checkpoints save the whole model.
+        # Returns
+            The trained head model.
+        """
+        feature_model, head_model = self._create_feature_model()
+        features_train = self._cache_features(
+            feature_model, self.image_paths_train, self.aug_pipeline_train, self.parameters.feature_cache_views,
+            workers=workers, use_multiprocessing=use_multiprocessing)
+        features_val = self._cache_features(
+            feature_model, self.image_paths_val, self.aug_pipeline_val, 1,
+            workers=workers, use_multiprocessing=use_multiprocessing)
+
+        head_model.compile(
+            optimizer=Adam(lr=self.parameters.felr),
+            loss='categorical_crossentropy',
+            metrics=self.metrics
+        )
+
+        head_model.fit(
+            CachedFeatureSequence(features_train, self.categories_train, self.parameters.batch_size, index_sampler=self.index_sampler),
+            class_weight=self.class_weight,
+            steps_per_epoch=self.train_samples_per_epoch//self.parameters.batch_size,
+            epochs=self.parameters.fe_epochs,
+            verbose=1,
+            callbacks=[ModelCallbackProxy(checkpoints, self._model)] + callbacks,
+            validation_data=CachedFeatureSequence(features_val, self.categories_val, self.parameters.batch_size, shuffle=False),
+            shuffle=False
+        )
+        return head_model
+
     @property
     def model(self):
         return self._model
@@ -0,0 +1,135 @@
+"""Test-time augmentation (TTA) of decoded batches.
+
+Every image is decoded and preprocessed once. Its views, the dihedral transformations (90 degree
+rotations and flips) and optionally crops, are produced from the batch with array operations and
+the logits of the views are averaged before the softmax.
+"""
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.backend as K
+from tensorflow.keras.layers import Input, Lambda
+from tensorflow.keras.models import Model
+
+# (counter clockwise 90 degree rotations, left/right flip) of the 8 dihedral views, identity first
+DIHEDRAL_VIEWS = [(k, flip) for flip in (False, True) for k in range(4)]
+
+# Center crop first, then the corners, as (top, left) fractions of the free margin
+CROP_POSITIONS = [(0.5, 0.5), (0., 0.), (0., 1.), (1., 0.), (1., 1.)]
+
+
+def dihedral_views(x, views, data_format=None):
+    """Stacks the first `views` dihedral views of a batch of square images, view after view.
+    # Arguments
+        x: Numpy array of shape `(n, height, width, channels)` (or channels first).
+        views: Integer between 1 and 8.
+        data_format: String, either 'channels_first' or 'channels_last'.
+    # Returns
+        Numpy array of `views * n` images.
+    """
+    if data_format is None:
+        data_format = K.image_data_format()
+    axes = (2, 3) if data_format == 'channels_first' else (1, 2)
+    batches = []
+    for k, flip in DIHEDRAL_VIEWS[:views]:
+        view = np.rot90(x, k, axes=axes)
+        if flip:
+            view = np.flip(view, axis=axes[1])
+        batches.append(view)
+    return np.concatenate(batches)
+
+
+def crop_views(x, crops, crop_fraction=0.875, data_format=None):
+    """Stacks the first `crops` crops of a batch of images resized back to the image size, crop after crop.
+    Same bilinear interpolation as `tf.image.crop_and_resize` in `create_tta_model`.
+    # Arguments
+        x: Numpy array of shape `(n, height, width, channels)` (or channels first).
+        crops: Integer between 1 and 5, number of crops (center, then corners).
+        crop_fraction: Side of the crops as a fraction of the image side.
+        data_format: String, either 'channels_first' or 'channels_last'.
+    # Returns
+        Numpy array of `crops * n` images of the dtype of `x`.
+    """
+    if data_format is None:
+        data_format = K.image_data_format()
+    axes = (2, 3) if data_format == 'channels_first' else (1, 2)
+    margin = 1. - crop_fraction
+    batches = []
+    for top, left in CROP_POSITIONS[:crops]:
+        view = x.astype(np.float32)
+        for axis, start in zip(axes, (top, left)):
+            size = x.shape[axis]
+            # Sampling positions of the crop in pixels of the image
+            position = start * margin * (size - 1) + np.arange(size) * crop_fraction
+            lower = np.floor(position).astype(np.int64)
+            upper = np.minimum(lower + 1, size - 1)
+            shape = [1] * x.ndim
+            shape[axis] = size
+            weight = (position - lower).astype(np.float32).reshape(shape)
+            low = np.take(view, lower, axis=axis)
+            view = low + (np.take(view, upper, axis=axis) - low) * weight
+        if np.issubdtype(x.dtype, np.integer):
+            view = np.round(view)
+        batches.append(view.astype(x.dtype))
+    return np.concatenate(batches)
+
+
+def stack_views(x, views, crops=0, crop_fraction=0.875, data_format=None):
+    """Stacks the same views of a batch as `create_tta_model`: `views` dihedral views, then `crops` crops."""
+    batches = [dihedral_views(x, views, data_format)]
+    if crops:
+        batches.append(crop_views(x, crops, crop_fraction, data_format))
+    return np.concatenate(batches)
+
+
+def average_views(logits, views):
+    """Averages the logits of the views stacked by `dihedral_views`, `stack_views` (or `create_tta_model`)."""
+    return logits.reshape((views, -1) + logits.shape[1:]).mean(axis=0)
+
+
+def _tf_views(x, views, crops, crop_fraction, data_format):
+    if data_format == 'channels_first':
+        x = tf.transpose(x, (0, 2, 3, 1))
+    batches = []
+    for k, flip in DIHEDRAL_VIEWS[:views]:
+        view = tf.image.rot90(x, k)
+        if flip:
+            view = tf.image.flip_left_right(view)
+        batches.append(view)
+    if crops:
+        n = tf.shape(x)[0]
+        margin = 1. - crop_fraction
+        crop_size = tf.shape(x)[1:3]
+        for top, left in CROP_POSITIONS[:crops]:
+            box = [top * margin, left * margin, top * margin + crop_fraction, left * margin + crop_fraction]
+            view = tf.image.crop_and_resize(tf.cast(x, 'float32'), tf.tile([box], [n, 1]), tf.range(n), crop_size)
+            if x.dtype.is_integer:
+                view = tf.round(view)
+            batches.append(tf.cast(view, x.dtype))
+    x = tf.concat(batches, axis=0)
+    if data_format == 'channels_first':
+        x = tf.transpose(x, (0, 3, 1, 2))
+    return x
+
+
+def create_tta_model(model, views=8, crops=0, crop_fraction=0.875, data_format=None):
+    """Model averaging the outputs of `model` over views of every input image.
+    # Arguments
+        model: Keras model of square images, e.g. the logits (`dense_pred`) of a classifier.
+        views: Integer between 1 and 8, number of dihedral views, the first one is the image itself.
+        crops: Integer between 0 and 5, number of crops resized back to the input size (center, then corners).
+        crop_fraction: Side of the crops as a fraction of the image side.
+        data_format: String, either 'channels_first' or 'channels_last'.
+    # Returns
+        A Keras model with the same input and output shapes as `model`.
+    """
+    if data_format is None:
+        data_format = K.image_data_format()
+    num_views = views + crops
+    inputs = Input(shape=model.input_shape[1:], dtype=model.inputs[0].dtype)
+    x = Lambda(lambda x: _tf_views(x, views, crops, crop_fraction, data_format), name='tta_views')(inputs)
+    x = model(x)
+    outputs = Lambda(
+        lambda y: tf.reduce_mean(tf.reshape(y, tf.concat([[num_views, -1], tf.shape(y)[1:]], axis=0)), axis=0),
+        name='tta_average'
+    )(x)
+    return Model(inputs=inputs, outputs=outputs)
@@ -2,9 +2,9 @@ from tensorflow.keras.preprocessing import image
 from tensorflow.keras import backend as K
 import numpy as np
 import pandas as pd
+import json
 import os
 import subprocess as sp
-import cv2
 from keras_numpy_backend import softmax
 
 
@@ -104,96 +104,114 @@ def paths_to_tensor(img_paths, size=(224, 224)):
     return np.vstack(list_of_tensors)
 
 
-def calculate_mean_std(img_paths):
+def calculate_mean_std(img_paths, **kwargs):
     """
     Calculate the image per channel mean and standard deviation.
+    Keyword arguments (workers, max_side, sample_size, ...) are passed to `dataset_statistics.compute_statistics`.
 
     # References
         https://gist.github.com/jdhao/9a86d4b9e4f79c5330d54de991461fd6
     """
-    
-    # Number of channels of the dataset image, 3 for color jpg, 1 for grayscale img
-    channel_num = 3
-    pixel_num = 0 # store all pixel number in the dataset
-    channel_sum = np.zeros(channel_num)
-    channel_sum_squared = np.zeros(channel_num)
-
-    for path in img_paths:
-        im = cv2.imread(path) # image in M*N*CHANNEL_NUM shape, channel in BGR order
-        im = im/255.
-        pixel_num += (im.size/channel_num)
-        channel_sum += np.sum(im, axis=(0, 1))
-        channel_sum_squared += np.sum(np.square(im), axis=(0, 1))
-
-    bgr_mean = channel_sum / pixel_num
-    bgr_std = np.sqrt(channel_sum_squared / pixel_num - np.square(bgr_mean))
-    
-    # change the format from bgr to rgb
-    rgb_mean = list(bgr_mean)[::-1]
-    rgb_std = list(bgr_std)[::-1]
-    
-    return rgb_mean, rgb_std
+    from dataset_statistics import compute_statistics
+    statistics = compute_statistics(img_paths, **kwargs)
+    return statistics['mean'], statistics['std']
+
+
+# Mean and STD from ImageNet
+# mean = [0.485, 0.456, 0.406]
+# std = [0.229, 0.224, 0.225]
+
+# Mean and STD calculated over the Training Set
+# Mean:[0.6236094091893962, 0.5198354883713194, 0.5038435406338101]
+# STD:[0.2421814437693499, 0.22354427793687906, 0.2314805420919389]
+DEFAULT_TRAINSET_MEAN = (0.6236, 0.5198, 0.5038)
+DEFAULT_TRAINSET_STD = (0.2422, 0.2235, 0.2315)
+# Replaced at runtime by the statistics of the dataset metadata file, see `set_dataset_statistics`
+TRAINSET_MEAN = DEFAULT_TRAINSET_MEAN
+TRAINSET_STD = DEFAULT_TRAINSET_STD
+# Statistics a model was trained with, saved next to its checkpoints
+DATASET_STATISTICS_FILENAME = 'dataset_statistics.json'
+
+
+def set_dataset_statistics(mean, std):
+    """Uses the per-channel mean and standard deviation of a dataset (e.g. written by `dataset_statistics.py`)
+    in `preprocess_input`, `layers.PreprocessInput` and the ODIN perturbations."""
+    global TRAINSET_MEAN, TRAINSET_STD
+    TRAINSET_MEAN = tuple(mean)
+    TRAINSET_STD = tuple(std)
+
+
+def save_dataset_statistics(model_path):
+    """Saves the statistics in use to the folder of a model's checkpoints, see `load_dataset_statistics`."""
+    with open(os.path.join(model_path, DATASET_STATISTICS_FILENAME), 'w') as f:
+        json.dump({'mean': list(TRAINSET_MEAN), 'std': list(TRAINSET_STD)}, f, indent=4)
+
+
+def load_dataset_statistics(model_path):
+    """Uses the statistics a model was trained with, saved by `save_dataset_statistics` in the folder of
+    its checkpoints. Models saved without them were trained with the hard-coded training set statistics.
+    # Returns
+        Tuple of the per-channel mean and standard deviation.
+    """
+    filepath = os.path.join(model_path, DATASET_STATISTICS_FILENAME)
+    if os.path.exists(filepath):
+        with open(filepath) as f:
+            statistics = json.load(f)
+        set_dataset_statistics(statistics['mean'], statistics['std'])
+    else:
+        set_dataset_statistics(DEFAULT_TRAINSET_MEAN, DEFAULT_TRAINSET_STD)
+    return TRAINSET_MEAN, TRAINSET_STD
+
+
+def normalize_batch(x, mean, std, data_format=None, out=None):
+    """Normalizes a batch of images channel-wise: (x / 255 - mean) / std.
+    Every operation runs in place over a whole channel of the batch, so normalizing a batch
+    costs one call instead of one call per image.
+
+    # Arguments
+        x: a 3D or 4D numpy array consists of RGB values within [0, 255], e.g. a uint8 batch.
+        mean: Per-channel mean of the pixels scaled to [0, 1].
+        std: Per-channel standard deviation of the pixels scaled to [0, 1].
+        data_format: data format of the image tensor.
+        out: Optional floating point array of the shape of `x` receiving the result, so uint8 batches
+            are converted while being scaled. If None, floating point `x` is normalized in place and
+            other arrays are converted to `K.floatx()` first.
+    # Returns
+        Normalized array.
+    """
+    if data_format is None:
+        data_format = K.image_data_format()
+
+    if out is None:
+        out = x if issubclass(x.dtype.type, np.floating) else np.empty(x.shape, dtype=K.floatx())
+    np.divide(x, out.dtype.type(255.), out=out)
+
+    for c in range(len(mean)):
+        if data_format == 'channels_first':
+            channel = out[c] if out.ndim == 3 else out[:, c]
+        else:
+            channel = out[..., c]
+        # Same operations as the former per-image slices, so the results are identical
+        channel -= mean[c]
+        if std is not None:
+            channel /= std[c]
+    return out
 
 
-def preprocess_input(x, data_format=None):
+def preprocess_input(x, data_format=None, out=None):
     """Preprocesses a numpy array encoding a batch of images. Each image is normalized by subtracting the mean and dividing by the standard deviation channel-wise.
     This function only implements the 'torch' mode which scale pixels between 0 and 1 and then will normalize each channel with respect to the training dataset of approach 1 (not include validation set).
 
     # Arguments
         x: a 3D or 4D numpy array consists of RGB values within [0, 255].
         data_format: data format of the image tensor.
+        out: Optional floating point array receiving the result, see `normalize_batch`.
     # Returns
         Preprocessed array.
     # References
         https://github.com/keras-team/keras-applications/blob/master/keras_applications/imagenet_utils.py
     """
-    if not issubclass(x.dtype.type, np.floating):
-        x = x.astype(K.floatx(), copy=False)
-
-    # Mean and STD from ImageNet
-    # mean = [0.485, 0.456, 0.406]
-    # std = [0.229, 0.224, 0.225]
-
-    # Mean and STD calculated over the Training Set
-    # Mean:[0.6236094091893962, 0.5198354883713194, 0.5038435406338101]
-    # STD:[0.2421814437693499, 0.22354427793687906, 0.2314805420919389]
-    x /= 255.
-    mean = [0.6236, 0.5198, 0.5038]
-    std = [0.2422, 0.2235, 0.2315]
-    
-    np.mean(x, axis=(0, 1))
-    np.std(x, axis=(0, 1))
-
-    if data_format is None:
-        data_format = K.image_data_format()
-
-    # Zero-center by mean pixel
-    if data_format == 'channels_first':
-        if x.ndim == 3:
-            x[0, :, :] -= mean[0]
-            x[1, :, :] -= mean[1]
-            x[2, :, :] -= mean[2]
-            if std is not None:
-                x[0, :, :] /= std[0]
-                x[1, :, :] /= std[1]
-                x[2, :, :] /= std[2]
-        else:
-            x[:, 0, :, :] -= mean[0]
-            x[:, 1, :, :] -= mean[1]
-            x[:, 2, :, :] -= mean[2]
-            if std is not None:
-                x[:, 0, :, :] /= std[0]
-                x[:, 1, :, :] /= std[1]
-                x[:, 2, :, :] /= std[2]
-    else:
-        x[..., 0] -= mean[0]
-        x[..., 1] -= mean[1]
-        x[..., 2] -= mean[2]
-        if std is not None:
-            x[..., 0] /= std[0]
-            x[..., 1] /= std[1]
-            x[..., 2] /= std[2]
-    return x
+    return normalize_batch(x, TRAINSET_MEAN, TRAINSET_STD, data_format=data_format, out=out)
 
 
 def apply_unknown_threshold(